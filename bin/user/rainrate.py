@@ -28,18 +28,30 @@ tipping bucket rain gauge and using a HyQuest Solutions TB7 (non-siphon)
 tipping bucket rain gauge as a reference (for rain rate).
 """
 
+import cProfile
+import glob
 import logging
+import os
+import signal
+import struct
 import sys
+import threading
 import time
+import tracemalloc
 
+from array import array
+from bisect import bisect_left
+from collections import deque
 from dataclasses import dataclass
-from typing import Any, Dict, List, Optional
+from typing import Any, Callable, Deque, Dict, Iterable, Iterator, List, Optional, Sequence, Tuple
 
 import weewx
 import weewx.manager
+import weewx.units
 import weeutil.logger
 
 
+from weeutil.weeutil import option_as_list
 from weeutil.weeutil import timestamp_to_string
 from weeutil.weeutil import to_bool
 from weeutil.weeutil import to_int
@@ -48,7 +60,7 @@ from weewx.engine import StdService
 # get a logger object
 log = logging.getLogger(__name__)
 
-RAINRATE_VERSION = '0.32'
+RAINRATE_VERSION = '0.33'
 
 if sys.version_info[0] < 3 or (sys.version_info[0] == 3 and sys.version_info[1] < 7):
     raise weewx.UnsupportedFeature(
@@ -66,11 +78,682 @@ class RainEntry:
     expiration: int   # timestamp at which this entry should be removed (30m later)
     dont_merge: bool  # Will be true if this rain entry is written as part of a merge
 
-@dataclass
-class LoopRainRate:
-    """A list of rain rates, used to compute rate for archive record."""
-    timestamp: int
-    rainRate : float
+@dataclass(frozen=True)
+class RainRateParams:
+    """Tuning parameters of the rain rate algorithm."""
+    tip_size            : float = 0.01      # amount of rain in a single tip
+    merge_window        : float = 2.5       # tips less than this many seconds apart are treated as a multi-tip
+    single_tip_threshold: float = 0.0100001 # rain amounts below this are a single tip
+    expiry              : int   = 1800      # seconds a tip is tracked
+    min_rate            : float = 0.035     # rain rates below this are reported as 0.0
+
+DEFAULT_PARAMS = RainRateParams()
+
+class RainEntries:
+    """The RainEntry objects currently being tracked, newest first.
+
+    Entries are kept in a bounded deque so that adding a tip, removing the
+    newest entry (when merging a double tip) and expiring the oldest entries
+    are all O(1).  The bound is a safety net; in practice entries expire
+    (30m after they were recorded) long before it is reached."""
+
+    MAX_ENTRIES = 10000
+
+    def __init__(self, max_entries: int = MAX_ENTRIES):
+        self._entries: Deque[RainEntry] = deque(maxlen=max_entries)
+        # Running counts of what has happened to the entries (for metrics).
+        self.tips       : int = 0 # packets with rain
+        self.spreads    : int = 0 # multi-tips spread between the previous tip and now
+        self.merges     : int = 0 # double tips merged
+        self.expirations: int = 0 # entries expired
+        # Rain rate between the two newest entries, computed when first needed after
+        # either of them changes (i.e., once per tip rather than once per packet).
+        self._tip_rate: Optional[float] = None
+
+    def __len__(self) -> int:
+        return len(self._entries)
+
+    def __iter__(self) -> Iterator[RainEntry]:
+        """Iterate over the entries, newest first."""
+        return iter(self._entries)
+
+    def add(self, entry: RainEntry) -> None:
+        """Add entry as the newest entry."""
+        self._entries.appendleft(entry)
+        self._tip_rate = None
+
+    def newest(self) -> RainEntry:
+        """The most recent entry."""
+        return self._entries[0]
+
+    def previous(self) -> RainEntry:
+        """The entry just before the most recent entry."""
+        return self._entries[1]
+
+    def pop_newest(self) -> RainEntry:
+        """Remove and return the most recent entry."""
+        self._tip_rate = None
+        return self._entries.popleft()
+
+    def tip_rate(self) -> float:
+        """The rain rate (per hour) between the two newest entries.  There must
+        be at least two entries."""
+        if self._tip_rate is None:
+            newest = self._entries[0]
+            self._tip_rate = 3600 * newest.amount / (newest.timestamp - self._entries[1].timestamp)
+        return self._tip_rate
+
+    def expire(self, ts: int) -> int:
+        """Remove entries that have matured as of ts.  Returns the number removed."""
+        entries = self._entries
+        count = 0
+        while entries and entries[-1].expiration <= ts:
+            entries.pop()
+            count += 1
+        self.expirations += count
+        return count
+
+class P2Quantile:
+    """Streaming estimate of a quantile in constant memory using the P-square
+    algorithm (Jain and Chlamtac, 1985).  Exact until five values are seen."""
+
+    def __init__(self, p: float):
+        self.p = p
+        self.count = 0
+        self.heights: List[float] = []
+        self.positions = [0, 1, 2, 3, 4]
+        self.desired = [0.0, 2.0 * p, 4.0 * p, 2.0 + 2.0 * p, 4.0]
+        self.increments = [0.0, p / 2.0, p, (1.0 + p) / 2.0, 1.0]
+
+    def add(self, x: float) -> None:
+        self.count += 1
+        q = self.heights
+        if self.count <= 5:
+            q.append(x)
+            q.sort()
+            return
+
+        n = self.positions
+        if x < q[0]:
+            q[0] = x
+            k = 0
+        elif x >= q[4]:
+            q[4] = x
+            k = 3
+        else:
+            k = 0
+            while x >= q[k + 1]:
+                k += 1
+        for i in range(k + 1, 5):
+            n[i] += 1
+        for i in range(5):
+            self.desired[i] += self.increments[i]
+
+        # Adjust the three middle markers if they are off their desired positions.
+        for i in range(1, 4):
+            d = self.desired[i] - n[i]
+            if (d >= 1.0 and n[i + 1] - n[i] > 1) or (d <= -1.0 and n[i - 1] - n[i] < -1):
+                step = 1 if d > 0.0 else -1
+                qp = q[i] + step / (n[i + 1] - n[i - 1]) * (
+                    (n[i] - n[i - 1] + step) * (q[i + 1] - q[i]) / (n[i + 1] - n[i]) +
+                    (n[i + 1] - n[i] - step) * (q[i] - q[i - 1]) / (n[i] - n[i - 1]))
+                if not q[i - 1] < qp < q[i + 1]:
+                    # Parabolic prediction is out of order, use linear instead.
+                    qp = q[i] + step * (q[i + step] - q[i]) / (n[i + step] - n[i])
+                q[i] = qp
+                n[i] += step
+
+    def value(self) -> Optional[float]:
+        if self.count == 0:
+            return None
+        if self.count <= 5:
+            return self.heights[min(len(self.heights) - 1, int(self.p * len(self.heights)))]
+        return self.heights[2]
+
+class PeriodRainRate:
+    """Running aggregate of the loop rain rates of a single archive period."""
+
+    def __init__(self, end_ts: int, method: str):
+        self.end_ts = end_ts
+        self.method = method
+        self.count = 0
+        self.high: float = 0.0
+        self.weighted_sum: float = 0.0
+        self.total_weight: float = 0.0
+        self.sum: float = 0.0
+        self.quantile: Optional[P2Quantile] = P2Quantile(0.95) if method == 'p95' else None
+
+    def add(self, rain_rate: float, weight: float) -> None:
+        if self.count == 0 or rain_rate > self.high:
+            self.high = rain_rate
+        self.count += 1
+        self.sum += rain_rate
+        self.weighted_sum += rain_rate * weight
+        self.total_weight += weight
+        if self.quantile is not None:
+            self.quantile.add(rain_rate)
+
+    def value(self) -> float:
+        if self.method == 'mean':
+            if self.total_weight > 0.0:
+                return self.weighted_sum / self.total_weight
+            return self.sum / self.count
+        if self.method == 'p95':
+            return self.quantile.value()
+        return self.high
+
+class ArchiveRainRates:
+    """Streaming aggregation of loop rain rates into archive record rain rates.
+
+    Loop rain rates are folded into a running aggregate for the archive period
+    they fall in (the period ending at or after the loop packet's dateTime), so
+    memory use is constant and an archive record gets its rain rate in O(1).
+    method is one of:
+      max : the highest loop rain rate of the period
+      mean: the mean of the loop rain rates, weighted by time between packets
+      p95 : an (approximate) 95th percentile of the loop rain rates
+    At most MAX_PERIODS periods are kept; should archive records stop arriving,
+    the oldest periods are dropped."""
+
+    METHODS = ('max', 'mean', 'p95')
+    MAX_PERIODS = 3
+
+    def __init__(self, archive_interval: int, method: str = 'max'):
+        if method not in ArchiveRainRates.METHODS:
+            raise ValueError("Unknown archive rain rate method: %s" % method)
+        self.archive_interval = archive_interval
+        self.method = method
+        self.periods: Deque[PeriodRainRate] = deque()
+        self.last_ts: Optional[int] = None
+
+    def add(self, ts: int, rain_rate: float) -> None:
+        """Fold the rain rate of a loop packet into its archive period."""
+        periods = self.periods
+        last_ts = self.last_ts
+        if periods and last_ts is not None:
+            period = periods[-1]
+            if last_ts <= ts <= period.end_ts and last_ts > period.end_ts - self.archive_interval:
+                # In the same archive period as the previous packet (the usual case).
+                period.add(rain_rate, ts - last_ts)
+                self.last_ts = ts
+                return
+        end_ts = -(-ts // self.archive_interval) * self.archive_interval
+        if not self.periods or self.periods[-1].end_ts < end_ts:
+            self.periods.append(PeriodRainRate(end_ts, self.method))
+            if len(self.periods) > ArchiveRainRates.MAX_PERIODS:
+                dropped = self.periods.popleft()
+                if log.isEnabledFor(logging.DEBUG):
+                    log.debug('Dropped loop rain rates of archive period ending %s (no archive record).',
+                              timestamp_to_string(dropped.end_ts))
+        period = self.periods[-1]
+        # Weight by the time since the previous packet (within this archive period).
+        start_ts = end_ts - self.archive_interval
+        since = start_ts if self.last_ts is None or self.last_ts < start_ts else self.last_ts
+        period.add(rain_rate, max(ts - since, 0))
+        self.last_ts = ts
+
+    def consume(self, ts: int) -> Optional[float]:
+        """Return the rain rate for an archive record with dateTime ts (None if
+        there are no loop rain rates for it) and discard the aggregates used.
+        Should more than one archive period be pending, the highest of their
+        values is returned."""
+        archive_rain_rate: Optional[float] = None
+        while self.periods and self.periods[0].end_ts <= ts:
+            value = self.periods.popleft().value()
+            if archive_rain_rate is None or value > archive_rain_rate:
+                archive_rain_rate = value
+        return archive_rain_rate
+
+class RollingTotals:
+    """Rain totals over sliding windows (e.g., the last 1, 5, 15 and 60 minutes).
+
+    Each window keeps the (timestamp, amount) of the packets with rain in it,
+    oldest first, and a running sum.  The sum only changes when rain arrives or
+    drops out of the window, so updating all windows costs O(1) (amortized)
+    per packet."""
+
+    def __init__(self, windows: Sequence[int]):
+        self.windows = list(windows)
+        self.amounts: List[Deque[Tuple[int, float]]] = [deque() for _ in self.windows]
+        self.sums: List[float] = [0.0] * len(self.windows)
+
+    def add(self, ts: int, rain: Optional[float]) -> None:
+        """Add the rain (if any) of a packet at ts and drop rain that has
+        slid out of each window."""
+        sums = self.sums
+        for i, amounts in enumerate(self.amounts):
+            if rain is not None and rain > 0.0:
+                amounts.append((ts, rain))
+                sums[i] += rain
+            start = ts - self.windows[i]
+            while amounts and amounts[0][0] <= start:
+                sums[i] -= amounts.popleft()[1]
+            if not amounts:
+                # Don't let float error accumulate across storms.
+                sums[i] = 0.0
+
+class Gauge:
+    """The state kept for one rain gauge, that is, for one rain observation in
+    the loop packets (rain_field) and the rain rate computed for it (rate_field)."""
+
+    def __init__(self, name: str, rain_field: str, rate_field: str, params: RainRateParams,
+            archive_interval: int, archive_rate_method: str):
+        self.name = name
+        self.rain_field = rain_field
+        self.rate_field = rate_field
+        self.params = params
+        # Rain events, including when they "expire" (30m later).
+        self.rain_entries = RainEntries()
+        # Aggregate computed loop rain rates (for determining archive record rain rate).
+        self.archive_rain_rates = ArchiveRainRates(archive_interval, archive_rate_method)
+        # Counts at the time of the last log summary.
+        self.logged_spreads: int = 0
+        self.logged_merges: int = 0
+        # Rolling rain totals (written to total_fields) and intensity (written to
+        # intensity_field, from the last of the rolling windows), if any.
+        self.rolling: Optional[RollingTotals] = None
+        self.total_fields: List[str] = []
+        self.intensity_field: Optional[str] = None
+        self.intensity_factor: float = 0.0
+        # The rain rate in the last loop packet before it was replaced (i.e., the
+        # driver's rain rate, if any), for RainRateRecorder.
+        self.original_rate: Optional[float] = None
+
+    def add_rolling_totals(self, windows: Sequence[int], intensity_window: int) -> None:
+        """Report rain totals over each of windows (seconds), in fields named after
+        rain_field and the window (e.g., rain_5m), and, if intensity_window, the
+        hourly rate of the rain in the last intensity_window seconds (e.g.,
+        rainIntensity)."""
+        windows = list(windows)
+        self.total_fields = [
+            '%s_%dm' % (self.rain_field, window // 60) if window % 60 == 0 else '%s_%ds' % (self.rain_field, window)
+            for window in windows]
+        if intensity_window:
+            windows.append(intensity_window)
+            self.intensity_field = '%sIntensity' % self.rain_field
+            self.intensity_factor = 3600.0 / intensity_window
+        if windows:
+            self.rolling = RollingTotals(windows)
+        # RainRate runs before StdConvert, which only converts fields with a unit group.
+        for field in self.total_fields:
+            weewx.units.obs_group_dict.setdefault(field, 'group_rain')
+        if self.intensity_field:
+            weewx.units.obs_group_dict.setdefault(self.intensity_field, 'group_rainrate')
+
+    @staticmethod
+    def from_config(name: str, gauge_dict: Dict[str, Any], archive_interval: int, archive_rate_method: str) -> 'Gauge':
+        tip_size = float(gauge_dict.get('tip_size', DEFAULT_PARAMS.tip_size))
+        params = RainRateParams(
+            tip_size             = tip_size,
+            merge_window         = float(gauge_dict.get('merge_window', DEFAULT_PARAMS.merge_window)),
+            single_tip_threshold = float(gauge_dict.get('single_tip_threshold', tip_size + 0.0000001)),
+            expiry               = to_int(gauge_dict.get('expiry', DEFAULT_PARAMS.expiry)),
+            min_rate             = float(gauge_dict.get('min_rate', DEFAULT_PARAMS.min_rate)))
+        rain_field = gauge_dict.get('rain_field', 'rain')
+        rate_field = gauge_dict.get('rate_field', 'rainRate')
+        # RainRate runs before StdConvert, which only converts fields with a unit group.
+        weewx.units.obs_group_dict.setdefault(rain_field, 'group_rain')
+        weewx.units.obs_group_dict.setdefault(rate_field, 'group_rainrate')
+        return Gauge(name, rain_field, rate_field, params, archive_interval, archive_rate_method)
+
+class LatencyHistogram:
+    """Fixed bucket histogram of durations (in seconds)."""
+
+    BUCKETS = (0.00001, 0.000025, 0.00005, 0.0001, 0.00025, 0.0005, 0.001, 0.0025, 0.005, 0.01, 0.1, 1.0, 10.0)
+
+    def __init__(self):
+        self.counts = [0] * (len(LatencyHistogram.BUCKETS) + 1)
+        self.count = 0
+        self.sum = 0.0
+
+    def observe(self, seconds: float) -> None:
+        self.counts[bisect_left(LatencyHistogram.BUCKETS, seconds)] += 1
+        self.count += 1
+        self.sum += seconds
+
+class RainRateMetrics:
+    """Counters and latency histograms of the RainRate service.  These are
+    periodically written to a file in the Prometheus text format (e.g., for
+    node_exporter's textfile collector)."""
+
+    def __init__(self, path: str, interval: int, loop_fields: bool):
+        self.path = path
+        self.interval = interval
+        self.loop_fields = loop_fields
+        self.next_write: float = 0.0
+        self.loop_packets = 0
+        self.archive_records = 0
+        self.latencies: Dict[str, LatencyHistogram] = {
+            'new_loop'          : LatencyHistogram(),
+            'new_archive_record': LatencyHistogram(),
+            'pre_loop'          : LatencyHistogram(),
+        }
+
+    def to_prometheus(self, gauges: List[Gauge]) -> str:
+        lines: List[str] = []
+        def metric(name: str, metric_type: str, help_text: str, value: Any) -> None:
+            lines.append('# HELP rainrate_%s %s' % (name, help_text))
+            lines.append('# TYPE rainrate_%s %s' % (name, metric_type))
+            lines.append('rainrate_%s %s' % (name, value))
+        def gauge_metric(name: str, metric_type: str, help_text: str, value: Callable[[Gauge], Any]) -> None:
+            lines.append('# HELP rainrate_%s %s' % (name, help_text))
+            lines.append('# TYPE rainrate_%s %s' % (name, metric_type))
+            for gauge in gauges:
+                lines.append('rainrate_%s{gauge="%s"} %s' % (name, gauge.name, value(gauge)))
+        lines.append('# HELP rainrate_info weewx-rainrate version.')
+        lines.append('# TYPE rainrate_info gauge')
+        lines.append('rainrate_info{version="%s"} 1' % RAINRATE_VERSION)
+        metric('loop_packets_total', 'counter', 'Loop packets processed.', self.loop_packets)
+        metric('archive_records_total', 'counter', 'Archive records processed.', self.archive_records)
+        gauge_metric('tips_total', 'counter', 'Loop packets with rain.', lambda g: g.rain_entries.tips)
+        gauge_metric('spreads_total', 'counter', 'Multi-tips spread between the previous tip and now.', lambda g: g.rain_entries.spreads)
+        gauge_metric('merges_total', 'counter', 'Tips in close succession merged into a multi-tip.', lambda g: g.rain_entries.merges)
+        gauge_metric('expirations_total', 'counter', 'Rain entries expired.', lambda g: g.rain_entries.expirations)
+        gauge_metric('rain_entries', 'gauge', 'Rain entries currently tracked.', lambda g: len(g.rain_entries))
+        gauge_metric('pending_archive_periods', 'gauge', 'Archive periods awaiting an archive record.',
+                     lambda g: len(g.archive_rain_rates.periods))
+        gauge_metric('pending_loop_rain_rates', 'gauge', 'Loop rain rates awaiting an archive record.',
+                     lambda g: sum(period.count for period in g.archive_rain_rates.periods))
+        for name, histogram in self.latencies.items():
+            lines.append('# HELP rainrate_%s_seconds Time spent in %s.' % (name, name))
+            lines.append('# TYPE rainrate_%s_seconds histogram' % name)
+            cumulative = 0
+            for bucket, count in zip(LatencyHistogram.BUCKETS, histogram.counts):
+                cumulative += count
+                lines.append('rainrate_%s_seconds_bucket{le="%g"} %d' % (name, bucket, cumulative))
+            lines.append('rainrate_%s_seconds_bucket{le="+Inf"} %d' % (name, histogram.count))
+            lines.append('rainrate_%s_seconds_sum %.9f' % (name, histogram.sum))
+            lines.append('rainrate_%s_seconds_count %d' % (name, histogram.count))
+        return '\n'.join(lines) + '\n'
+
+    def write(self, gauges: List[Gauge]) -> None:
+        """Write the metrics file (atomically, so a scrape never sees a partial file)."""
+        tmp = '%s.tmp' % self.path
+        with open(tmp, 'w') as f:
+            f.write(self.to_prometheus(gauges))
+        os.replace(tmp, self.path)
+
+class RainRateSnapshot:
+    """Binary snapshot of the live state of the gauges (their rain entries and
+    pending archive period aggregates), so that a restart picks up the actual
+    tips rather than rebuilding them from archive records.
+
+    The file is little endian:
+      header  : magic, version, time written, number of gauges
+      gauge   : name and archive rate method (each a length and utf-8 bytes),
+                archive interval, number of entries, number of periods, last_ts
+      entry   : timestamp, amount, expiration, dont_merge (oldest first)
+      period  : end_ts, count, high, weighted_sum, total_weight, sum
+      quantile: (p95 periods only) count, number of heights, heights, positions, desired
+
+    The engine thread only packs the snapshot (see submit); a background thread
+    writes and fsyncs it, so the engine never waits on the disk.  If the writer
+    falls behind, only the latest snapshot is written."""
+
+    MAGIC    = b'RRSS'
+    VERSION  = 1
+    HEADER   = struct.Struct('<4sHqH')
+    STRING   = struct.Struct('<H')
+    GAUGE    = struct.Struct('<III?q')
+    ENTRY    = struct.Struct('<qdq?')
+    PERIOD   = struct.Struct('<qIdddd')
+    QUANTILE = struct.Struct('<IB5d5q5d')
+
+    def __init__(self, path: str, interval: int, max_age: int):
+        self.path = path
+        self.interval = interval
+        self.max_age = max_age
+        self.next_write: int = 0
+        # The latest packed snapshot not yet written (by the writer thread).
+        self.pending: Deque[bytes] = deque(maxlen=1)
+        self.ready = threading.Event()
+        self.stopping = False
+        self.thread: Optional[threading.Thread] = None
+
+    @staticmethod
+    def pack(gauges: List[Gauge], written: int) -> bytes:
+        S = RainRateSnapshot
+        parts: List[bytes] = [S.HEADER.pack(S.MAGIC, S.VERSION, written, len(gauges))]
+        for gauge in gauges:
+            archive_rain_rates = gauge.archive_rain_rates
+            for string in (gauge.name, archive_rain_rates.method):
+                encoded = string.encode('utf-8')
+                parts.append(S.STRING.pack(len(encoded)))
+                parts.append(encoded)
+            entries = list(gauge.rain_entries)
+            last_ts = archive_rain_rates.last_ts
+            parts.append(S.GAUGE.pack(archive_rain_rates.archive_interval, len(entries), len(archive_rain_rates.periods),
+                                      last_ts is not None, last_ts or 0))
+            for entry in reversed(entries):
+                parts.append(S.ENTRY.pack(entry.timestamp, entry.amount, entry.expiration, entry.dont_merge))
+            for period in archive_rain_rates.periods:
+                parts.append(S.PERIOD.pack(period.end_ts, period.count, period.high, period.weighted_sum,
+                                           period.total_weight, period.sum))
+                q = period.quantile
+                if q is not None:
+                    heights = q.heights + [0.0] * (5 - len(q.heights))
+                    parts.append(S.QUANTILE.pack(q.count, len(q.heights), *heights, *q.positions, *q.desired))
+        return b''.join(parts)
+
+    @staticmethod
+    def unpack(data: bytes) -> Tuple[int, Dict[str, Tuple[RainEntries, ArchiveRainRates]]]:
+        """Return the time the snapshot was written and, by gauge name, the rain
+        entries and archive rain rates saved.  Raises ValueError if data is not
+        a valid snapshot."""
+        S = RainRateSnapshot
+        offset = 0
+        def read(fmt: struct.Struct) -> Tuple[Any, ...]:
+            nonlocal offset
+            values = fmt.unpack_from(data, offset)
+            offset += fmt.size
+            return values
+        def read_string() -> str:
+            nonlocal offset
+            length, = read(S.STRING)
+            if offset + length > len(data):
+                raise ValueError('Truncated snapshot.')
+            string = data[offset:offset + length].decode('utf-8')
+            offset += length
+            return string
+
+        try:
+            magic, version, written, gauge_count = read(S.HEADER)
+            if magic != S.MAGIC or version != S.VERSION:
+                raise ValueError('Not a version %d snapshot.' % S.VERSION)
+            states: Dict[str, Tuple[RainEntries, ArchiveRainRates]] = {}
+            for _ in range(gauge_count):
+                name = read_string()
+                method = read_string()
+                archive_interval, entry_count, period_count, has_last_ts, last_ts = read(S.GAUGE)
+                rain_entries = RainEntries()
+                for _ in range(entry_count):
+                    timestamp, amount, expiration, dont_merge = read(S.ENTRY)
+                    rain_entries.add(RainEntry(timestamp = timestamp, amount = amount, expiration = expiration, dont_merge = dont_merge))
+                archive_rain_rates = ArchiveRainRates(archive_interval, method)
+                archive_rain_rates.last_ts = last_ts if has_last_ts else None
+                for _ in range(period_count):
+                    period = PeriodRainRate(0, method)
+                    (period.end_ts, period.count, period.high, period.weighted_sum,
+                        period.total_weight, period.sum) = read(S.PERIOD)
+                    q = period.quantile
+                    if q is not None:
+                        values = read(S.QUANTILE)
+                        q.count = values[0]
+                        q.heights = list(values[2:2 + values[1]])
+                        q.positions = list(values[7:12])
+                        q.desired = list(values[12:17])
+                    archive_rain_rates.periods.append(period)
+                states[name] = (rain_entries, archive_rain_rates)
+        except (struct.error, UnicodeDecodeError) as e:
+            raise ValueError('Corrupt snapshot: %s' % e)
+        return written, states
+
+    def write(self, gauges: List[Gauge], written: int) -> None:
+        """Write the snapshot (atomically, so a crash never leaves a partial snapshot)."""
+        self.write_data(RainRateSnapshot.pack(gauges, written))
+
+    def write_data(self, data: bytes) -> None:
+        tmp = '%s.tmp' % self.path
+        with open(tmp, 'wb') as f:
+            f.write(data)
+            f.flush()
+            os.fsync(f.fileno())
+        os.replace(tmp, self.path)
+
+    def submit(self, gauges: List[Gauge], written: int) -> None:
+        """Pack the snapshot and hand it to the writer thread (started on first use)."""
+        self.pending.append(RainRateSnapshot.pack(gauges, written))
+        if self.thread is None:
+            self.thread = threading.Thread(target=self.run, name='RainRateSnapshot', daemon=True)
+            self.thread.start()
+        self.ready.set()
+
+    def run(self) -> None:
+        """The writer thread."""
+        while True:
+            self.ready.wait()
+            self.ready.clear()
+            # Read before writing, so a snapshot submitted before stop is never left behind.
+            stopping = self.stopping
+            while self.pending:
+                try:
+                    self.write_data(self.pending.popleft())
+                except OSError as e:
+                    log.error('Could not write snapshot to %s: %s' % (self.path, e))
+            if stopping:
+                return
+
+    def stop(self) -> None:
+        """Write what is pending and stop the writer thread."""
+        if self.thread is None:
+            return
+        self.stopping = True
+        self.ready.set()
+        self.thread.join()
+        self.thread = None
+
+    def read(self) -> Tuple[int, Dict[str, Tuple[RainEntries, ArchiveRainRates]]]:
+        with open(self.path, 'rb') as f:
+            return RainRateSnapshot.unpack(f.read())
+
+class WarmStart:
+    """State of a warm start (the fetch of recent archive rain) running in a
+    background thread."""
+    def __init__(self, deadline: float):
+        self.deadline = deadline      # time.time() after which the fetch is abandoned
+        self.done = threading.Event() # set when the fetch has finished (or failed)
+        self.elapsed: float = 0.0     # seconds taken by the fetch
+        self.error: Optional[Exception] = None
+        # (dateTime, rain of each gauge) of archive records with rain.
+        self.rows: List[Tuple[Any, ...]] = []
+        # (dateTime, rain of each gauge) of the loop packets received while waiting.
+        self.packets: List[Tuple[int, List[Optional[float]]]] = []
+        self.thread: Optional[threading.Thread] = None
+
+class RainRateProfiler:
+    """Periodically profile (cProfile) the WeeWX main thread over profile_packets
+    loop packets, and/or take a tracemalloc snapshot every tracemalloc_interval
+    seconds, writing them to files in directory (keeping the newest keep of each
+    kind).  A .prof file loads with pstats, a .tracemalloc file with
+    tracemalloc.Snapshot.load.
+
+    Sampling only happens while enabled (toggled with signal_name, if any) and,
+    if there is a sentinel, while the sentinel file exists.  Both are checked
+    every CHECK_INTERVAL seconds."""
+
+    CHECK_INTERVAL = 10
+    TRACEMALLOC_FRAMES = 10
+
+    def __init__(self, directory: str, profile_packets: int, profile_interval: int, tracemalloc_interval: int,
+            keep: int, sentinel: Optional[str], signal_name: Optional[str]):
+        self.directory = directory
+        self.profile_packets = profile_packets
+        self.profile_interval = profile_interval
+        self.tracemalloc_interval = tracemalloc_interval
+        self.keep = keep
+        self.sentinel = sentinel
+        self.enabled = True
+        self.active = False
+        self.next_check: int = 0
+        self.next_profile: int = 0
+        self.next_tracemalloc: int = 0
+        self.profile: Optional[cProfile.Profile] = None
+        self.profiled_packets: int = 0
+        self.tracing = False # tracemalloc was started by us
+        if signal_name:
+            try:
+                signal.signal(getattr(signal, signal_name), self.toggle)
+            except (AttributeError, ValueError) as e:
+                log.error('Cannot toggle profiling with signal %s: %s' % (signal_name, e))
+
+    def toggle(self, signum, frame) -> None:
+        """Signal handler, enable or disable sampling (from the next check)."""
+        self.enabled = not self.enabled
+        self.next_check = 0
+
+    def loop_packet(self, now: int) -> None:
+        """Called at the end of each loop packet at time now."""
+        if self.profile is not None:
+            self.profiled_packets += 1
+            if self.profiled_packets >= self.profile_packets:
+                self.stop_profile(now)
+        if now >= self.next_check:
+            self.check(now)
+
+    def check(self, now: int) -> None:
+        self.next_check = now + RainRateProfiler.CHECK_INTERVAL
+        active = self.enabled and (self.sentinel is None or os.path.exists(self.sentinel))
+        if active != self.active:
+            log.info('Profiling %s.' % ('enabled' if active else 'disabled'))
+            self.active = active
+            if not active:
+                self.stop(now)
+        if not active:
+            return
+        if self.profile_packets and self.profile is None and now >= self.next_profile:
+            self.next_profile = now + self.profile_interval
+            self.profiled_packets = 0
+            self.profile = cProfile.Profile()
+            self.profile.enable()
+        if self.tracemalloc_interval:
+            if not tracemalloc.is_tracing():
+                tracemalloc.start(RainRateProfiler.TRACEMALLOC_FRAMES)
+                self.tracing = True
+                self.next_tracemalloc = now + self.tracemalloc_interval
+            elif now >= self.next_tracemalloc:
+                self.next_tracemalloc = now + self.tracemalloc_interval
+                self.write_tracemalloc(now)
+
+    def stop_profile(self, now: int) -> None:
+        profile, self.profile = self.profile, None
+        profile.disable()
+        self.write(now, lambda path: profile.dump_stats(path), 'prof')
+
+    def write_tracemalloc(self, now: int) -> None:
+        snapshot = tracemalloc.take_snapshot()
+        self.write(now, lambda path: snapshot.dump(path), 'tracemalloc')
+        for stat in snapshot.statistics('lineno')[:3]:
+            log.info('tracemalloc: %s' % stat)
+
+    def write(self, now: int, dump: Callable[[str], None], suffix: str) -> None:
+        """Write a file with dump (as directory/rainrate-<now>.<suffix>) and
+        remove all but the newest keep such files."""
+        path = os.path.join(self.directory, 'rainrate-%s.%s' % (time.strftime('%Y%m%d-%H%M%S', time.localtime(now)), suffix))
+        try:
+            os.makedirs(self.directory, exist_ok=True)
+            dump(path)
+            for old in sorted(glob.glob(os.path.join(self.directory, 'rainrate-*.%s' % suffix)))[:-self.keep]:
+                os.remove(old)
+        except OSError as e:
+            log.error('Could not write %s: %s' % (path, e))
+
+    def stop(self, now: int) -> None:
+        """Stop sampling, writing any profile in progress."""
+        if self.profile is not None:
+            self.stop_profile(now)
+        if self.tracing:
+            self.tracing = False
+            tracemalloc.stop()
 
 class RainRate(StdService):
     """RainRate keep track of rain in loop pkts and updates each loop pkt with rainRate."""
@@ -95,192 +778,702 @@ class RainRate(StdService):
         # Get archive interval
         try:
             std_archive_dict = config_dict.get('StdArchive', {})
-            self.archive_interval = to_int(std_archive_dict.get('archive_interval'))
+            self.archive_interval = to_int(std_archive_dict.get('archive_interval', 300))
         except Exception as e:
             log.info("Cannot determine archive_interval.  Exiting. (%s)" % e)
             return
 
-        # List of rain events, including when they "expire" (15m later).
-        self.rain_entries : List[RainEntry] = []
+        # How far back to look for rain in the archive at startup.
+        self.warm_start_lookback: int = to_int(rainrate_config_dict.get('warm_start_lookback', 900))
+
+        # Fetch the warm start archive rain in a background thread (so a slow database does not
+        # hold up loop packets), giving up after warm_start_timeout seconds.
+        self.async_warm_start: bool = to_bool(rainrate_config_dict.get('async_warm_start', True))
+        self.warm_start_timeout: int = to_int(rainrate_config_dict.get('warm_start_timeout', 60))
+        self.warm_start: Optional[WarmStart] = None
 
-        # Save computed loop rain rates (for determining archive record rain rate).
-        self.loop_rain_rates: List[LoopRainRate] = []
+        # (dateTime, rain of each gauge) of the archive records caught up on (i.e., with no loop
+        # packets for their period, such as those a driver replays from its logger at startup)
+        # before the warm start rain is in place.  None once it is, as they are then already
+        # in the rain entries.
+        self.catch_up_rows: Optional[List[Tuple[Any, ...]]] = []
+
+        # How the loop rain rates of an archive period are combined into the archive record's rainRate.
+        archive_rate_method = rainrate_config_dict.get('archive_rate_method', 'max')
+        if archive_rate_method not in ArchiveRainRates.METHODS:
+            log.error("Unknown archive_rate_method: %s, using max." % archive_rate_method)
+            archive_rate_method = 'max'
+        log.info("archive_rate_method: %s" % archive_rate_method)
+
+        # The gauges to compute rain rates for.  Without a [[gauges]] section, there is a single
+        # gauge, with rain in the rain field and the rain rate written to the rainRate field.
+        self.gauges: List[Gauge] = []
+        gauges_dict = rainrate_config_dict.get('gauges', {})
+        for name in gauges_dict or ['rain']:
+            gauge = Gauge.from_config(name, gauges_dict.get(name, {}), self.archive_interval, archive_rate_method)
+            log.info("Gauge %s: %s => %s, %s" % (name, gauge.rain_field, gauge.rate_field, gauge.params))
+            self.gauges.append(gauge)
+
+        # Optional rolling rain totals (e.g., 60, 300, 900, 3600 seconds) and rain intensity
+        # (e.g., WMO style, over 600 seconds) added to loop packets.
+        rolling_windows = [to_int(window) for window in option_as_list(rainrate_config_dict.get('rolling_windows', []))]
+        intensity_window = to_int(rainrate_config_dict.get('intensity_window', 0))
+        for gauge in self.gauges:
+            gauge.add_rolling_totals(rolling_windows, intensity_window)
+            if gauge.rolling is not None:
+                log.info("Rolling totals of %s: %s" % (gauge.rain_field, ', '.join(
+                    gauge.total_fields + ([gauge.intensity_field] if gauge.intensity_field else []))))
 
         # Flag used to gather up archive records in pre_loop only once (at startup).
         self.initialized = False
 
-        self.bind(weewx.PRE_LOOP, self.pre_loop)
-        self.bind(weewx.NEW_LOOP_PACKET, self.new_loop)
-        self.bind(weewx.NEW_ARCHIVE_RECORD, self.new_archive_record)
+        # Multi-tips and merges are logged (at info) as a periodic summary rather than one at a time.
+        self.log_summary_interval: int = to_int(rainrate_config_dict.get('log_summary_interval', 300))
+        self.next_log_summary: int = 0
+
+        # For diagnosis, log (at info) one in log_sample_interval loop packets (0 to disable).
+        self.log_sample_interval: int = to_int(rainrate_config_dict.get('log_sample_interval', 0))
+        self.log_sample_countdown: int = self.log_sample_interval
+
+        # Optionally, snapshot the gauges' state periodically and at shutdown, for a quick warm restart.
+        self.snapshot: Optional[RainRateSnapshot] = None
+        snapshot_file = rainrate_config_dict.get('snapshot_file')
+        if snapshot_file:
+            self.snapshot = RainRateSnapshot(snapshot_file,
+                                             to_int(rainrate_config_dict.get('snapshot_interval', 60)),
+                                             to_int(rainrate_config_dict.get('snapshot_max_age', 300)))
+            log.info("Writing snapshots to %s every %d seconds." % (self.snapshot.path, self.snapshot.interval))
+
+        # Optionally, profile and/or trace memory allocations periodically (see RainRateProfiler).
+        self.profiler: Optional[RainRateProfiler] = None
+        profile_dir = rainrate_config_dict.get('profile_dir')
+        profile_packets = to_int(rainrate_config_dict.get('profile_packets', 0))
+        tracemalloc_interval = to_int(rainrate_config_dict.get('tracemalloc_interval', 0))
+        if profile_dir and (profile_packets or tracemalloc_interval):
+            self.profiler = RainRateProfiler(profile_dir, profile_packets,
+                                             to_int(rainrate_config_dict.get('profile_interval', 3600)),
+                                             tracemalloc_interval,
+                                             to_int(rainrate_config_dict.get('profile_keep', 10)),
+                                             rainrate_config_dict.get('profile_sentinel') or None,
+                                             rainrate_config_dict.get('profile_signal', 'SIGUSR2') or None)
+            log.info("Profiling %d loop packets every %d seconds and tracing memory every %d seconds to %s." % (
+                profile_packets, self.profiler.profile_interval, tracemalloc_interval, profile_dir))
+
+        # Metrics are only kept (and the events timed) if a metrics_file is specified.
+        self.metrics: Optional[RainRateMetrics] = None
+        metrics_file = rainrate_config_dict.get('metrics_file')
+        if metrics_file:
+            self.metrics = RainRateMetrics(metrics_file,
+                                           to_int(rainrate_config_dict.get('metrics_interval', 60)),
+                                           to_bool(rainrate_config_dict.get('metrics_loop_fields', False)))
+            log.info("Writing metrics to %s every %d seconds." % (self.metrics.path, self.metrics.interval))
+            self.bind(weewx.PRE_LOOP, self.timed_pre_loop)
+            self.bind(weewx.NEW_LOOP_PACKET, self.timed_new_loop)
+            self.bind(weewx.NEW_ARCHIVE_RECORD, self.timed_new_archive_record)
+        else:
+            self.bind(weewx.PRE_LOOP, self.pre_loop)
+            self.bind(weewx.NEW_LOOP_PACKET, self.new_loop)
+            self.bind(weewx.NEW_ARCHIVE_RECORD, self.new_archive_record)
+
+    def timed_pre_loop(self, event):
+        start = time.perf_counter()
+        self.pre_loop(event)
+        self.metrics.latencies['pre_loop'].observe(time.perf_counter() - start)
+
+    def timed_new_loop(self, event):
+        start = time.perf_counter()
+        self.new_loop(event)
+        elapsed = time.perf_counter() - start
+        metrics = self.metrics
+        metrics.loop_packets += 1
+        metrics.latencies['new_loop'].observe(elapsed)
+        if metrics.loop_fields:
+            event.packet['rainRateEntries'] = sum(len(gauge.rain_entries) for gauge in self.gauges)
+            event.packet['rainRateLoopSeconds'] = elapsed
+        if time.time() >= metrics.next_write:
+            self.write_metrics()
+
+    def timed_new_archive_record(self, event):
+        start = time.perf_counter()
+        self.new_archive_record(event)
+        self.metrics.archive_records += 1
+        self.metrics.latencies['new_archive_record'].observe(time.perf_counter() - start)
+
+    def write_metrics(self):
+        self.metrics.next_write = time.time() + self.metrics.interval
+        try:
+            self.metrics.write(self.gauges)
+        except OSError as e:
+            log.error('Could not write metrics to %s: %s' % (self.metrics.path, e))
+
+    def write_snapshot(self, now: int):
+        if self.warm_start is not None:
+            # The rain entries lack the archive rain until the warm start is done, a
+            # restart would take such a snapshot as fresh and skip the warm start.
+            return
+        self.snapshot.next_write = now + self.snapshot.interval
+        self.snapshot.submit(self.gauges, now)
+
+    def load_snapshot(self, now: int) -> bool:
+        """Restore the gauges from the snapshot.  Returns False (leaving the gauges
+        untouched) if there is no fresh snapshot of the configured gauges."""
+        try:
+            written, states = self.snapshot.read()
+        except FileNotFoundError:
+            log.info('No snapshot found at %s.' % self.snapshot.path)
+            return False
+        except (OSError, ValueError) as e:
+            log.error('Could not read snapshot %s: %s' % (self.snapshot.path, e))
+            return False
+        age = now - written
+        if age < 0 or age > self.snapshot.max_age:
+            log.info('Snapshot is %d seconds old (snapshot_max_age: %d), ignoring it.' % (age, self.snapshot.max_age))
+            return False
+        if sorted(states) != sorted(gauge.name for gauge in self.gauges):
+            log.info('Snapshot gauges (%s) differ from the configured gauges, ignoring it.' % ', '.join(states))
+            return False
+        for gauge in self.gauges:
+            rain_entries, archive_rain_rates = states[gauge.name]
+            rain_entries.expire(now)
+            gauge.rain_entries = rain_entries
+            if (archive_rain_rates.method == gauge.archive_rain_rates.method
+                    and archive_rain_rates.archive_interval == gauge.archive_rain_rates.archive_interval):
+                # Only the current archive period can still get an archive record.
+                while archive_rain_rates.periods and archive_rain_rates.periods[0].end_ts < now:
+                    archive_rain_rates.periods.popleft()
+                gauge.archive_rain_rates = archive_rain_rates
+        if self.catch_up_rows:
+            # Records caught up on (before pre_loop) since the snapshot was written.
+            self.add_archive_rain(iter([row for row in self.catch_up_rows if row[0] > written]),
+                                  [gauge.rain_entries for gauge in self.gauges])
+        log.info('Restored %d rain entries from the snapshot written %d seconds ago.' % (
+            sum(len(gauge.rain_entries) for gauge in self.gauges), age))
+        return True
+
+    def shutDown(self):
+        """Write the snapshot and metrics one last time."""
+        if getattr(self, 'profiler', None) is not None:
+            self.profiler.stop(to_int(time.time()))
+        if getattr(self, 'snapshot', None) is not None:
+            self.write_snapshot(to_int(time.time()))
+            self.snapshot.stop()
+        if getattr(self, 'metrics', None) is not None:
+            self.write_metrics()
 
     def pre_loop(self, event):
-        """At WeeWX start, gather up the rain in 15m of archive records and same them
-          in rain_entries."""
+        """At WeeWX start, restore the rain entries from a fresh snapshot or, failing
+        that, gather up the rain in the last warm_start_lookback seconds of archive
+        records and save it in rain_entries (by default, in a background thread,
+        see check_warm_start)."""
         if self.initialized:
             return
         self.initialized = True
 
-        try:
-            binder = weewx.manager.DBBinder(self.config_dict)
-            binding = self.config_dict.get('StdReport')['data_binding']
-            dbm = binder.get_manager(binding)
-            # Get the column names of the archive table.
-            archive_columns: List[str] = dbm.connection.columnsOf('archive')
+        if self.snapshot is not None and self.load_snapshot(to_int(time.time())):
+            self.catch_up_rows = None
+            return
 
-            # Get last n seconds of archive records.
-            earliest_time: int = to_int(time.time()) - 900
+        binding = self.config_dict.get('StdArchive', {}).get('data_binding', 'wx_binding')
 
-            log.debug('Earliest time selected is %s' % timestamp_to_string(earliest_time))
+        # Get last n seconds of archive records.
+        earliest_time: int = to_int(time.time()) - self.warm_start_lookback
+        log.debug('Earliest time selected is %s' % timestamp_to_string(earliest_time))
 
-            # Fetch the records.
+        if self.async_warm_start:
+            self.warm_start = WarmStart(time.time() + self.warm_start_timeout)
+            self.warm_start.thread = threading.Thread(target=self.fetch_warm_start, name='RainRateWarmStart',
+                                                      args=(self.warm_start, binding, earliest_time), daemon=True)
+            self.warm_start.thread.start()
+            return
+
+        try:
+            # Use the engine's (already open) database manager.
+            dbm = self.engine.db_binder.get_manager(binding)
+
+            # Fetch the records (in one query for all gauges) and save rain events (if any).
             start = time.time()
-            archive_recs: List[Dict[str, Any]] = RainRate.get_archive_records(
-                dbm, archive_columns, earliest_time)
-
-            # Save rain events (if any).
-            rec_count = 0
-            for rec in archive_recs:
-                if 'rain' in rec and rec['rain'] is not None and rec['rain'] > 0.0000001:
-                    rec_count += 1
-                    RainRate.archive_records_to_rain_entries(rec, self.archive_interval, self.rain_entries)
+            rain_fields = [gauge.rain_field for gauge in self.gauges]
+            rows = self.with_catch_up_rows(list(RainRate.get_archive_rain(dbm, earliest_time, rain_fields)))
+            rain_entries_list = [RainEntries() for _ in self.gauges]
+            rec_count = self.add_archive_rain(iter(rows), rain_entries_list)
+            for gauge, rain_entries in zip(self.gauges, rain_entries_list):
+                gauge.rain_entries = rain_entries
             log.debug('Collected %d archive records containing rain in %f seconds.' % (rec_count, time.time() - start))
         except Exception as e:
             # Print problem to log and give up.
             log.error('Error in RainRate setup.  RainRate is exiting. Exception: %s' % e)
             weeutil.logger.log_traceback(log.error, "    ****  ")
+        self.catch_up_rows = None
+
+    def with_catch_up_rows(self, rows: List[Tuple[Any, ...]]) -> List[Tuple[Any, ...]]:
+        """The warm start archive rain rows, with the records caught up on so far
+        in place of (or added to) the rows of the same dateTime, in ascending
+        dateTime order.  The records may have been saved to the archive before
+        rows were fetched, they must only be counted once."""
+        if not self.catch_up_rows:
+            return rows
+        rows_by_time = { row[0]: row for row in rows }
+        rows_by_time.update((row[0], row) for row in self.catch_up_rows)
+        return [rows_by_time[ts] for ts in sorted(rows_by_time)]
+
+    def add_archive_rain(self, rows: Iterator[Tuple[Any, ...]], rain_entries_list: List[RainEntries]) -> int:
+        """Add the rain of (dateTime, rain of each gauge) archive rows to the
+        rain entries of each gauge.  Returns the number of rows."""
+        rec_count = 0
+        for row in rows:
+            rec_count += 1
+            archive_time = row[0]
+            for gauge, rain_entries, archive_rain in zip(self.gauges, rain_entries_list, row[1:]):
+                if archive_rain is not None and archive_rain > 0.0000001:
+                    RainRate.archive_rain_to_rain_entries(archive_time, archive_rain, self.archive_interval, rain_entries, gauge.params)
+        return rec_count
+
+    def fetch_warm_start(self, warm_start: WarmStart, binding: str, earliest_time: int) -> None:
+        """Fetch the warm start archive rain (in a background thread).  SQLite
+        connections can't be shared across threads, so the thread opens its own
+        database manager."""
+        start = time.time()
+        try:
+            dbm = weewx.manager.open_manager_with_config(self.config_dict, binding)
+            try:
+                warm_start.rows = list(RainRate.get_archive_rain(dbm, earliest_time, [gauge.rain_field for gauge in self.gauges]))
+            finally:
+                dbm.close()
+        except Exception as e:
+            warm_start.error = e
+        finally:
+            warm_start.elapsed = time.time() - start
+            warm_start.done.set()
+
+    def check_warm_start(self, pkt_time: int, pkt: Dict[str, Any]) -> None:
+        """Called for each loop packet while a warm start is pending.  Once the
+        archive rain has been fetched, rebuild the gauges' rain entries from it
+        and the loop packets received meanwhile (in dateTime order).  Until
+        then, remember the packet."""
+        warm_start = self.warm_start
+        if warm_start.done.is_set():
+            self.warm_start = None
+            if warm_start.error is not None:
+                log.error('Warm start failed, continuing without archive rain: %s' % warm_start.error)
+                self.catch_up_rows = None
+                return
+            rain_entries_list = [RainEntries() for _ in self.gauges]
+            self.add_archive_rain(iter(self.with_catch_up_rows(warm_start.rows)), rain_entries_list)
+            self.catch_up_rows = None
+            for ts, rains in sorted(warm_start.packets, key=lambda packet: packet[0]):
+                for gauge, rain_entries, rain in zip(self.gauges, rain_entries_list, rains):
+                    RainRate.add_rain(ts, rain, rain_entries, params=gauge.params)
+            for gauge, rain_entries in zip(self.gauges, rain_entries_list):
+                gauge.rain_entries = rain_entries
+            log.info('Warm start: %d archive records containing rain fetched in %f seconds, merged with %d loop packets.' % (
+                len(warm_start.rows), warm_start.elapsed, len(warm_start.packets)))
+        elif time.time() > warm_start.deadline:
+            self.warm_start = None
+            self.catch_up_rows = None
+            log.error('Warm start did not finish within %d seconds, continuing without archive rain.' % self.warm_start_timeout)
+        else:
+            warm_start.packets.append((pkt_time, [pkt.get(gauge.rain_field) for gauge in self.gauges]))
 
     @staticmethod
-    def archive_records_to_rain_entries(rec: Dict[str, Any], archive_interval: int, rain_entries: List[RainEntry])->None:
-        archive_time = rec['dateTime']
-        archive_amt = rec['rain']
-        if archive_amt < 0.0100001:
+    def archive_records_to_rain_entries(rec: Dict[str, Any], archive_interval: int, rain_entries: RainEntries,
+            params: RainRateParams = DEFAULT_PARAMS)->None:
+        """Add the rain in an archive record to rain_entries.  Records must be
+        passed in ascending dateTime order."""
+        RainRate.archive_rain_to_rain_entries(rec['dateTime'], rec['rain'], archive_interval, rain_entries, params)
+
+    @staticmethod
+    def archive_rain_to_rain_entries(archive_time: int, archive_amt: float, archive_interval: int, rain_entries: RainEntries,
+            params: RainRateParams = DEFAULT_PARAMS)->None:
+        """Add rain_amt, the rain of the archive period ending at archive_time,
+        to rain_entries."""
+        if archive_amt < params.single_tip_threshold:
             # Add the single tip midway through archive period.
             rec_time = round(archive_time - (archive_interval / 2.0))
-            rain_entries.append(RainEntry(timestamp = rec_time, amount = archive_amt, expiration = rec_time + 1800, dont_merge=True))
+            rain_entries.add(RainEntry(timestamp = rec_time, amount = archive_amt, expiration = rec_time + params.expiry, dont_merge=True))
         else:
-            # Evenly space the tips
-            number_of_tips: int = round(archive_amt / 0.01)
-            interval: int = round(archive_interval / number_of_tips)
-            time_of_rain: int = archive_time
+            # Evenly space the tips (oldest first, as each one added becomes the newest).
+            number_of_tips: int = round(archive_amt / params.tip_size)
+            # At least 1s apart: tips at the same time would have an infinite rain rate.
+            interval: int = max(1, round(archive_interval / number_of_tips))
+            time_of_rain: int = archive_time - interval * number_of_tips
             for _ in range(number_of_tips):
-                time_of_rain -= interval
-                rain_entries.append(
-                    RainEntry(timestamp = time_of_rain, amount = archive_amt / number_of_tips, expiration = time_of_rain + 1800, dont_merge=True))
+                rain_entries.add(
+                    RainEntry(timestamp = time_of_rain, amount = archive_amt / number_of_tips, expiration = time_of_rain + params.expiry, dont_merge=True))
+                time_of_rain += interval
+
+    @staticmethod
+    def archive_rain_rate(archive_time: int, archive_rain: Optional[float], archive_interval: int, rain_entries: RainEntries,
+            params: RainRateParams = DEFAULT_PARAMS) -> float:
+        """Add the rain of an archive record (for which there are no loop packets)
+        to rain_entries and return the rain rate for the record.  Records must be
+        passed in ascending dateTime order."""
+        if archive_rain is not None and archive_rain > 0.0000001:
+            RainRate.archive_rain_to_rain_entries(archive_time, archive_rain, archive_interval, rain_entries, params)
+        rain_entries.expire(archive_time)
+        return RainRate.rain_rate(archive_time, rain_entries, params)
 
     @staticmethod
-    def get_archive_records(dbm, archive_columns: List[str],
-            earliest_time: int) -> List[Dict[str, Any]]:
-        """At startup, gather previous 15 of rain."""
-        records = []
-        for cols in dbm.genSql('SELECT * FROM archive' \
-                ' WHERE dateTime > %d ORDER BY dateTime ASC' % earliest_time):
-            rec: Dict[str, Any] = {}
-            for i in range(len(cols)):
-                rec[archive_columns[i]] = cols[i]
-            records.append(rec)
-            log.debug('get_archive_records: rec(%s): %s' % (
-                timestamp_to_string(rec['dateTime']), rec))
-        return records
+    def get_archive_rain(dbm, earliest_time: int, rain_fields: Sequence[str] = ('rain',)) -> Iterator[Tuple[Any, ...]]:
+        """At startup, gather previous rain.  Yields (dateTime, rain, ...), with one rain
+        value for each of rain_fields, for the archive records after earliest_time that
+        contain rain, in ascending dateTime order."""
+        return dbm.genSql('SELECT dateTime, %s FROM archive WHERE dateTime > ? AND (%s) ORDER BY dateTime ASC' % (
+            ', '.join(rain_fields), ' OR '.join('%s > 0.0000001' % field for field in rain_fields)), (earliest_time,))
 
     def new_loop(self, event):
         """ Record rain, compute rainRate and add/update rainRate in the pkt."""
         pkt: Dict[str, Any] = event.packet
 
         assert event.event_type == weewx.NEW_LOOP_PACKET
-        log.debug(pkt)
+        log.debug('new_loop: %s', pkt)
+
+        pkt_time: int = to_int(pkt['dateTime'])
+        if self.warm_start is not None:
+            self.check_warm_start(pkt_time, pkt)
+
+        for gauge in self.gauges:
+            rain = pkt.get(gauge.rain_field)
+            gauge.original_rate = pkt.get(gauge.rate_field)
+            if rain or gauge.rain_entries:
+                # Active: add rain (if any) to rain_entries, also delete expired entries.
+                RainRate.add_rain(pkt_time, rain, gauge.rain_entries, params=gauge.params)
+                # Compute a rainRate.
+                rain_rate = RainRate.rain_rate(pkt_time, gauge.rain_entries, gauge.params)
+            else:
+                # Idle: no rain and no rain entries, so no rain rate.
+                rain_rate = 0.0
+            pkt[gauge.rate_field] = rain_rate
+
+            # Aggregate the computed rain rates (to be used to compute archive rain rate).
+            gauge.archive_rain_rates.add(pkt_time, rain_rate)
+
+            rolling = gauge.rolling
+            if rolling is not None:
+                rolling.add(pkt_time, pkt.get(gauge.rain_field))
+                for field, total in zip(gauge.total_fields, rolling.sums):
+                    pkt[field] = total
+                if gauge.intensity_field:
+                    pkt[gauge.intensity_field] = rolling.sums[-1] * gauge.intensity_factor
 
-        # Add rain (if any) to rain_entries, also delete expired entries.
-        RainRate.add_packet(pkt, self.rain_entries)
+        if self.snapshot is not None and pkt_time >= self.snapshot.next_write:
+            self.write_snapshot(pkt_time)
 
-        # Compute a rainRate and add it to the pkt.
-        RainRate.compute_rain_rate(pkt, self.rain_entries)
+        if self.profiler is not None:
+            self.profiler.loop_packet(pkt_time)
 
-        # Save the computed rain rates (to be used to compute archive rain rate.
-        self.loop_rain_rates.append(LoopRainRate(
-            timestamp = pkt['dateTime'],
-            rainRate  = pkt['rainRate']))
+        if self.log_sample_interval:
+            self.log_sample_countdown -= 1
+            if self.log_sample_countdown <= 0:
+                self.log_sample_countdown = self.log_sample_interval
+                for gauge in self.gauges:
+                    log.info('Sampled pkt[%d] %s: %s, %s: %f, rain entries: %d', pkt['dateTime'], gauge.rain_field,
+                             pkt.get(gauge.rain_field), gauge.rate_field, pkt[gauge.rate_field], len(gauge.rain_entries))
+
+        if pkt['dateTime'] >= self.next_log_summary:
+            self.log_summary(pkt['dateTime'])
+
+    def log_summary(self, now: int) -> None:
+        """Log the multi-tips and merges since the last summary (if any)."""
+        for gauge in self.gauges:
+            if self.next_log_summary:
+                spreads = gauge.rain_entries.spreads - gauge.logged_spreads
+                merges = gauge.rain_entries.merges - gauge.logged_merges
+                if spreads or merges:
+                    log.info('In the last %d seconds, spread %d multi-tip(s) and merged %d double tip(s) of %s.',
+                             now - self.next_log_summary + self.log_summary_interval, spreads, merges, gauge.rain_field)
+            gauge.logged_spreads = gauge.rain_entries.spreads
+            gauge.logged_merges = gauge.rain_entries.merges
+        self.next_log_summary = now + self.log_summary_interval
 
     def new_archive_record(self, event):
         """ Overwrite archive rainRate with current rainRate."""
         record: Dict[str, Any] = event.record
 
         assert event.event_type == weewx.NEW_ARCHIVE_RECORD
-        log.debug(record)
-
-        # Consume the loop rain rates in loop_rain_rates that
-        # are for this archive record's period.
-        # Pick the highest rain rate for the archive record.
-        archive_rain_rate: Optional[float] = None
-        while len(self.loop_rain_rates) != 0 and self.loop_rain_rates[0].timestamp <= record['dateTime']:
-            if archive_rain_rate is None or self.loop_rain_rates[0].rainRate > archive_rain_rate:
-                archive_rain_rate = self.loop_rain_rates[0].rainRate
-            self.loop_rain_rates.pop(0)
-
-            if archive_rain_rate is None:
-                # We have no help from loop records--probably an archive record during catchup (when WeeWX restarted).
-                # We'll average the rain reported over the length of the archive period.
-                archive_rain_rate = record['rain'] / self.archive_interval
+        log.debug('new_archive_record: %s', record)
 
         # TODO: Verify that this archive record is received in the same units as loop data (i.e., before any conversion that might be needed).
 
-        record['rainRate'] = archive_rain_rate
+        # Consume the aggregated loop rain rates for this archive record's period.
+        # (None if there were no loop packets for the period.)
+        rain_rates = [gauge.archive_rain_rates.consume(record['dateTime']) for gauge in self.gauges]
+        if all(rain_rate is None for rain_rate in rain_rates):
+            self.catch_up(record)
+        else:
+            for gauge, rain_rate in zip(self.gauges, rain_rates):
+                record[gauge.rate_field] = rain_rate
+
+    def catch_up(self, record: Dict[str, Any]) -> None:
+        """Add the rain of an archive record with no loop packets for its period
+        (e.g., one a driver replays from its logger at startup) to the rain
+        entries, spread over the record's interval, and set the record's rain
+        rate from them in the same pass.  A record older than the newest rain
+        entry can't be added (the entries must stay in order), its rain rate is
+        left as None."""
+        archive_time = to_int(record['dateTime'])
+        interval = to_int(record['interval']) * 60 if record.get('interval') else self.archive_interval
+        for gauge in self.gauges:
+            rain_entries = gauge.rain_entries
+            if rain_entries and rain_entries.newest().timestamp > archive_time:
+                log.debug('Archive record %d is older than the newest rain entry, not catching up.', archive_time)
+                record[gauge.rate_field] = None
+                continue
+            record[gauge.rate_field] = RainRate.archive_rain_rate(
+                archive_time, record.get(gauge.rain_field), interval, rain_entries, gauge.params)
+        log.debug('Caught up on archive record %d: %s', archive_time,
+                  ', '.join('%s: %s' % (gauge.rate_field, record[gauge.rate_field]) for gauge in self.gauges))
+        if self.catch_up_rows is not None:
+            self.catch_up_rows.append(tuple([archive_time] + [record.get(gauge.rain_field) for gauge in self.gauges]))
 
     @staticmethod
-    def add_packet(pkt, rain_entries, dont_merge=False):
-        """If the pkt contains rain, add a new RainEntry to rain_entries (add to
-        the beginning) and include the timestamp and an expiration (30m later).
+    def add_packet(pkt, rain_entries: RainEntries, dont_merge=False, params: RainRateParams = DEFAULT_PARAMS):
+        """If the pkt contains rain, add a new RainEntry to rain_entries (as the
+        newest entry) and include the timestamp and an expiration (30m later).
         Also, delete any expired entries in rain_entries."""
 
-        # Process new packet.  Be careful, the first time through, pkt['rain'] may be None.
-        pkt_time: int       = to_int(pkt['dateTime'])
-        if 'rain' in pkt and pkt['rain'] is not None and pkt['rain'] > 0.0:
-            pkt_rain = pkt['rain']
-            if pkt_rain > 0.0100001:
-                log.info("Multi-tip pkt[%d] rain: %f" % (pkt['dateTime'], pkt['rain']))
-            if len(rain_entries) == 0:
-                # Record the first tip.  It doesn't matter if it is a multitip as we have no idea when the rain
-                # actually accumulated. As such, we'll record it as a single tip (0.01).
-                rain_entries.insert(0, RainEntry(timestamp = pkt_time, amount = 0.01, expiration = pkt_time + 1800, dont_merge = dont_merge))
-            elif pkt_rain < 0.0100001:
-                    # Record the single tip
-                    rain_entries.insert(0, RainEntry(timestamp = pkt_time, amount = pkt_rain, expiration = pkt_time + 1800, dont_merge = dont_merge))
-            else:
-                # Spread the rain over equally (between last tip and now).
-                number_of_tips: int = round(pkt_rain / 0.01)
-                interval: int = round((pkt_time - rain_entries[0].timestamp) / number_of_tips)
-                time_of_rain: int = pkt_time - (interval * (number_of_tips - 1))
-                for _ in range(number_of_tips):
-                    rain_entries.insert(
-                        0, RainEntry(timestamp = time_of_rain, amount = pkt_rain / number_of_tips, expiration = time_of_rain + 1800, dont_merge = dont_merge))
-                    time_of_rain += interval
+        # Be careful, the first time through, pkt['rain'] may be None.
+        RainRate.add_rain(to_int(pkt['dateTime']), pkt.get('rain'), rain_entries, dont_merge, params)
+
+    @staticmethod
+    def add_packets(pkts: Iterable[Dict[str, Any]], rain_entries: RainEntries, params: RainRateParams = DEFAULT_PARAMS,
+            compute_rates: bool = True) -> int:
+        """Add each of pkts (in dateTime order) as add_packet would and, if
+        compute_rates, add/update its rainRate as compute_rain_rate would.  Meant
+        for backlogs and replays; the per packet lookups are hoisted out of the
+        loop and dry packets with nothing to expire are skipped.  Returns the
+        number of packets."""
+
+        add_rain = RainRate.add_rain
+        rain_rate = RainRate.rain_rate
+        count = 0
+        for pkt in pkts:
+            count += 1
+            pkt_rain = pkt.get('rain')
+            if not pkt_rain and not rain_entries:
+                if compute_rates:
+                    pkt['rainRate'] = 0.0
+                continue
+            pkt_time = to_int(pkt['dateTime'])
+            add_rain(pkt_time, pkt_rain, rain_entries, False, params)
+            if compute_rates:
+                pkt['rainRate'] = rain_rate(pkt_time, rain_entries, params)
+        return count
+
+    @staticmethod
+    def add_rain(pkt_time: int, pkt_rain: Optional[float], rain_entries: RainEntries, dont_merge=False,
+            params: RainRateParams = DEFAULT_PARAMS):
+        """The work of add_packet, for the rain (which may be None) in a packet at pkt_time."""
+
+        if not pkt_rain and not rain_entries:
+            # Idle: no rain, and no entries to merge or expire.
+            return
+
+        # Process new packet.
+        if pkt_rain is not None and pkt_rain > 0.0:
+            if not dont_merge:
+                rain_entries.tips += 1
+            RainRate.record_rain(pkt_time, pkt_rain, rain_entries, dont_merge, params)
 
         # If we have rain entries extremely close together, treat as a multi-tip.
-        if len(rain_entries) > 1 and not dont_merge and not rain_entries[1].dont_merge and rain_entries[0].timestamp - rain_entries[1].timestamp < 2.5:
-            log.info("Merging pkt[%d]rain:%f and pkt[%d]rain:%f" % (rain_entries[1].timestamp, rain_entries[1].amount, rain_entries[0].timestamp, rain_entries[0].amount))
-            combined_pkt: Dict[str, Any] = { 'dateTime': pkt_time, 'rain': rain_entries[0].amount + rain_entries[1].amount }
-            del rain_entries[0]
-            del rain_entries[0]
-            RainRate.add_packet(combined_pkt, rain_entries, dont_merge=True)
+        # The combined rain is recorded as dont_merge, so at most one merge happens per packet.
+        if len(rain_entries) > 1 and not dont_merge:
+            newest = rain_entries.newest()
+            previous = rain_entries.previous()
+            if not previous.dont_merge and newest.timestamp - previous.timestamp < params.merge_window:
+                log.debug("Merging pkt[%d]rain:%f and pkt[%d]rain:%f", previous.timestamp, previous.amount, newest.timestamp, newest.amount)
+                rain_entries.merges += 1
+                combined_rain = newest.amount + previous.amount
+                rain_entries.pop_newest()
+                rain_entries.pop_newest()
+                RainRate.record_rain(pkt_time, combined_rain, rain_entries, True, params)
 
         # Delete any entries that have matured.
-        while len(rain_entries) > 0 and rain_entries[-1].expiration <= pkt_time:
-            del rain_entries[-1]
+        rain_entries.expire(pkt_time)
+
+    @staticmethod
+    def record_rain(pkt_time: int, pkt_rain: float, rain_entries: RainEntries, dont_merge: bool, params: RainRateParams):
+        """Add entries for pkt_rain (> 0.0) at pkt_time: a single tip, or a multi-tip
+        spread over equally between the newest entry and pkt_time."""
+
+        if pkt_rain > params.single_tip_threshold:
+            log.debug("Multi-tip pkt[%d] rain: %f", pkt_time, pkt_rain)
+        if len(rain_entries) == 0:
+            # Record the first tip.  It doesn't matter if it is a multitip as we have no idea when the rain
+            # actually accumulated. As such, we'll record it as a single tip (0.01).
+            rain_entries.add(RainEntry(timestamp = pkt_time, amount = params.tip_size, expiration = pkt_time + params.expiry, dont_merge = dont_merge))
+        elif pkt_rain < params.single_tip_threshold:
+                # Record the single tip
+                rain_entries.add(RainEntry(timestamp = pkt_time, amount = pkt_rain, expiration = pkt_time + params.expiry, dont_merge = dont_merge))
+        else:
+            # Spread the rain over equally (between last tip and now).
+            rain_entries.spreads += 1
+            number_of_tips: int = round(pkt_rain / params.tip_size)
+            interval: int = round((pkt_time - rain_entries.newest().timestamp) / number_of_tips)
+            time_of_rain: int = pkt_time - (interval * (number_of_tips - 1))
+            for _ in range(number_of_tips):
+                rain_entries.add(
+                    RainEntry(timestamp = time_of_rain, amount = pkt_rain / number_of_tips, expiration = time_of_rain + params.expiry, dont_merge = dont_merge))
+                time_of_rain += interval
 
     @staticmethod
-    def compute_rain_rate(pkt, rain_entries):
+    def compute_rain_rate(pkt, rain_entries: RainEntries, params: RainRateParams = DEFAULT_PARAMS):
         """Add/update rainRate in packet"""
 
+        pkt['rainRate'] = RainRate.rain_rate(pkt['dateTime'], rain_entries, params)
+        log.debug('new_loop(%d): Added/updated pkt[rainRate] of %f', pkt['dateTime'], pkt['rainRate'])
+
+    @staticmethod
+    def rain_rate(pkt_time: int, rain_entries: RainEntries, params: RainRateParams = DEFAULT_PARAMS) -> float:
+        """The work of compute_rain_rate, returns the rain rate at pkt_time."""
+
         if len(rain_entries) < 2:
-            pkt['rainRate'] = 0.0
-        else:
-            # Rain rate between the last two tips.
-            rainRate1 = 3600 * rain_entries[0].amount / (rain_entries[0].timestamp - rain_entries[1].timestamp)
-            # Rain rate imagining that there was a tip in the current packet (as such, between now and the actual last tip).
-            rainRate2 = 10000.0 # Pick a silly large number as we take the min below.
-            if pkt['dateTime'] != rain_entries[0].timestamp:
-                rainRate2 = 3600 * 0.01 / (pkt['dateTime'] - rain_entries[0].timestamp)
-            # Pick the lower of the two rates.
-            pkt['rainRate'] = min(rainRate1, rainRate2)
-            if pkt['rainRate'] < 0.035:
-                pkt['rainRate'] = 0.0
-        log.debug('new_loop(%d): Added/updated pkt[rainRate] of %f' % (pkt['dateTime'], pkt['rainRate']))
+            return 0.0
+        newest = rain_entries.newest()
+        # Rain rate between the last two tips (only recomputed after a tip).
+        rainRate1 = rain_entries.tip_rate()
+        # Rain rate imagining that there was a tip in the current packet (as such, between now and the actual last tip).
+        rainRate2 = 10000.0 # Pick a silly large number as we take the min below.
+        if pkt_time != newest.timestamp:
+            rainRate2 = 3600 * params.tip_size / (pkt_time - newest.timestamp)
+        # Pick the lower of the two rates.
+        rain_rate = min(rainRate1, rainRate2)
+        if rain_rate < params.min_rate:
+            rain_rate = 0.0
+        return rain_rate
+
+    @staticmethod
+    def compute_rain_rates(timestamps: Sequence[int], rains: Sequence[Optional[float]],
+            rain_entries: Optional[RainEntries] = None, params: RainRateParams = DEFAULT_PARAMS) -> array:
+        """Compute the rain rates for a whole time series at once.
+
+        timestamps and rains are equal length sequences (lists, array.array,
+        NumPy arrays, ...) in ascending time order.  The result is the same as
+        calling add_packet and compute_rain_rate for each packet, but no packet
+        dicts are built.  The rain rates are returned as an array('d'), which
+        NumPy can wrap without copying (numpy.frombuffer).  To continue
+        a series across calls, pass the same rain_entries each time."""
+
+        if len(timestamps) != len(rains):
+            raise ValueError('timestamps and rains differ in length (%d vs. %d)' % (len(timestamps), len(rains)))
+        if rain_entries is None:
+            rain_entries = RainEntries()
+        rates = array('d', bytes(8 * len(timestamps)))
+        add_rain = RainRate.add_rain
+        rain_rate = RainRate.rain_rate
+        for i, (ts, rain) in enumerate(zip(timestamps, rains)):
+            if not rain_entries and not (rain is not None and rain > 0.0):
+                # Dry, with nothing to expire, the rate is 0.0.
+                continue
+            ts = int(ts)
+            add_rain(ts, rain, rain_entries, False, params)
+            rates[i] = rain_rate(ts, rain_entries, params)
+        return rates
+
+class RainRateRecorder(StdService):
+    """Record, for every loop packet, dateTime and, for each RainRate gauge, the
+    raw rain, the driver's rain rate and the computed rain rate, to a csv file
+    per gauge and day (<directory>/<gauge>-YYYYMMDD.csv, appended to).  The
+    files are timestamp,rain,rainRate,computed rows, so rate_computer.py can
+    replay them as is.  Missing values are recorded as 0.0.
+
+    List it after RainRate in data_services.  new_loop only appends a tuple to
+    an in-memory buffer; a background thread writes the buffer every
+    flush_interval seconds, so the engine never waits on the disk.  If the
+    writer falls more than max_buffered_rows behind, rows are dropped (and
+    counted) rather than using unbounded memory."""
+
+    def __init__(self, engine, config_dict):
+        super(RainRateRecorder, self).__init__(engine, config_dict)
+
+        recorder_dict = config_dict.get('RainRateRecorder', {})
+        if not to_bool(recorder_dict.get('enable')):
+            log.info("RainRateRecorder is disabled. Enable it in the RainRateRecorder section of weewx.conf.")
+            return
+
+        # The gauges come from the RainRate service (which must be listed before the recorder).
+        rainrate = next((service for service in getattr(engine, 'service_obj', []) if isinstance(service, RainRate)), None)
+        self.gauges: List[Gauge] = getattr(rainrate, 'gauges', [])
+        if not self.gauges:
+            log.error("RainRateRecorder requires an enabled RainRate service listed before it.  Not recording.")
+            return
+
+        self.directory: str = recorder_dict.get('directory', '/var/lib/weewx/rainrate')
+        self.flush_interval: float = float(recorder_dict.get('flush_interval', 5))
+        self.max_buffered_rows: int = to_int(recorder_dict.get('max_buffered_rows', 100000))
+        # (dateTime, rain, original rate, computed rate of each gauge ...) of each loop packet.
+        self.buffer: Deque[Tuple[Any, ...]] = deque()
+        self.dropped: int = 0
+        self.written: int = 0
+        self.day_end: int = 0
+        self.files: List[Optional[Any]] = [None for _ in self.gauges]
+        self.stop = threading.Event()
+        self.thread = threading.Thread(target=self.run, name='RainRateRecorder', daemon=True)
+        self.thread.start()
+        log.info("Recording loop packets of gauges %s to %s." % (', '.join(gauge.name for gauge in self.gauges), self.directory))
+        self.bind(weewx.NEW_LOOP_PACKET, self.new_loop)
+
+    def new_loop(self, event):
+        pkt = event.packet
+        if len(self.buffer) >= self.max_buffered_rows:
+            self.dropped += 1
+            return
+        row: List[Any] = [pkt['dateTime']]
+        for gauge in self.gauges:
+            row += [pkt.get(gauge.rain_field), gauge.original_rate, pkt.get(gauge.rate_field)]
+        self.buffer.append(tuple(row))
+
+    def run(self) -> None:
+        """The writer thread."""
+        while not self.stop.wait(self.flush_interval):
+            self.flush()
+        self.flush()
+
+    def flush(self) -> None:
+        """Write the buffered rows (deque.popleft is safe against new_loop's appends)."""
+        lines: List[List[str]] = [[] for _ in self.gauges]
+        buffer = self.buffer
+        try:
+            while buffer:
+                row = buffer.popleft()
+                ts = to_int(row[0])
+                if ts >= self.day_end:
+                    self.write(lines)
+                    lines = [[] for _ in self.gauges]
+                    self.rotate(ts)
+                for i, gauge_lines in enumerate(lines):
+                    rain, original_rate, rate = row[1 + 3 * i:4 + 3 * i]
+                    gauge_lines.append('%d,%r,%r,%r\n' % (ts, rain or 0.0, original_rate or 0.0, rate or 0.0))
+                self.written += 1
+            self.write(lines)
+        except Exception as e:
+            log.error('RainRateRecorder could not write to %s: %s' % (self.directory, e))
+
+    def write(self, lines: List[List[str]]) -> None:
+        for f, gauge_lines in zip(self.files, lines):
+            if f is not None and gauge_lines:
+                f.write(''.join(gauge_lines))
+                f.flush()
+
+    def rotate(self, ts: int) -> None:
+        """Switch to the files of the day of ts."""
+        self.close_files()
+        local = time.localtime(ts)
+        self.day_end = int(time.mktime((local.tm_year, local.tm_mon, local.tm_mday + 1, 0, 0, 0, 0, 0, -1)))
+        os.makedirs(self.directory, exist_ok=True)
+        self.files = [open(os.path.join(self.directory, '%s-%s.csv' % (gauge.name, time.strftime('%Y%m%d', local))), 'a')
+                      for gauge in self.gauges]
+
+    def close_files(self) -> None:
+        for f in self.files:
+            if f is not None:
+                f.close()
+        self.files = [None for _ in self.gauges]
+
+    def shutDown(self):
+        """Write what is buffered and close the files."""
+        if getattr(self, 'thread', None) is None:
+            return
+        self.stop.set()
+        self.thread.join()
+        self.close_files()
+        log.info('RainRateRecorder wrote %d rows, dropped %d.' % (self.written, self.dropped))
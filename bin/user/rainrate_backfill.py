@@ -0,0 +1,263 @@
+"""
+rainrate_backfill.py
+
+Copyright (C)2023 by John A Kline (john@johnkline.com)
+Distributed under the terms of the GNU Public License (GPLv3)
+
+Recompute the rainRate of historical archive records (i.e., records written
+before weewx-rainrate was installed) with the weewx-rainrate algorithm.
+
+Each archive record's rain is recorded as tips spread over its archive
+interval (RainRate.archive_records_to_rain_entries) and the record's rainRate
+is then computed as it would be for a loop packet at the record's dateTime
+(RainRate.compute_rain_rate).  Only records whose rainRate changes are
+updated.  Records in metric units (usUnits METRIC or METRICWX) are converted to
+inches for the algorithm, and their rainRate is written in their own units.
+
+The archive is processed a day at a time (each day is warmed up with the
+preceding hour of records), so days can be computed in parallel by a pool of
+processes.  Updates are written by the main process with executemany, in
+transactions of at most --batch-size records.  With --checkpoint, the last
+day written is saved after each transaction, and a rerun with the same
+checkpoint file resumes after it.
+
+The daily summaries are not updated.  Rebuild them when the backfill is done
+(wee_database --rebuild-daily, or weectl database rebuild-daily).
+
+    To Run (stop WeeWX first):
+
+        PYTHONPATH=/home/weewx/bin python /home/weewx/bin/user/rainrate_backfill.py /home/weewx/weewx.conf --dry-run
+
+        PYTHONPATH=/home/weewx/bin python /home/weewx/bin/user/rainrate_backfill.py /home/weewx/weewx.conf --workers 4 --checkpoint /home/weewx/rainrate_backfill.json
+"""
+
+import argparse
+import datetime
+import json
+import logging
+import multiprocessing
+import os
+import time
+
+from dataclasses import dataclass
+from typing import Any, Dict, Iterator, List, Optional, Tuple
+
+import weecfg
+import weedb
+import weeutil.logger
+import weewx
+import weewx.manager
+import weewx.units
+
+from weeutil.weeutil import genDaySpans
+from weeutil.weeutil import timestamp_to_string
+from weeutil.weeutil import TimeSpan
+
+from user.rainrate import RainEntries
+from user.rainrate import RainRate
+
+log = logging.getLogger(__name__)
+
+# Seconds of archive records, before the start of a day, needed to rebuild the
+# rain entries still alive at the start of the day (entries live for 30m and
+# are spread over the archive interval).
+WARM_UP = 3600
+
+# Updates smaller than this are not written.
+TOLERANCE = 0.000001
+
+@dataclass
+class BackfillStats:
+    days   : int = 0 # days processed
+    records: int = 0 # archive records processed
+    updated: int = 0 # archive records whose rainRate was (or, in a dry run, would be) updated
+
+@dataclass
+class DayResult:
+    stop_ts: int                       # end of the day
+    records: int                       # archive records in the day
+    updates: List[Tuple[float, int]]   # (rainRate, dateTime) of the records to update
+
+def unit_factors(us_units: int) -> Tuple[float, float]:
+    """(rain to inches, inches per hour to rainRate) factors for records in
+    us_units."""
+    try:
+        rain_unit, rain_group = weewx.units.getStandardUnitType(us_units, 'rain')
+        rate_unit, rate_group = weewx.units.getStandardUnitType(us_units, 'rainRate')
+    except KeyError:
+        raise ValueError('Unknown usUnits: %s' % us_units)
+    return (weewx.units.convert((1.0, rain_unit, rain_group), 'inch')[0],
+            weewx.units.convert((1.0, 'inch_per_hour', rate_group), rate_unit)[0])
+
+def compute_rain_rates(rows: Iterator[Tuple[int, Optional[float], Optional[int], int]],
+        rain_entries: RainEntries) -> Iterator[Tuple[int, float]]:
+    """Given (dateTime, rain, interval, usUnits) archive rows in ascending
+    dateTime order, yield (dateTime, rainRate), rainRate in the row's units.
+    interval is in minutes."""
+    factors: Dict[int, Tuple[float, float]] = { weewx.US: (1.0, 1.0) }
+    for ts, rain, interval, us_units in rows:
+        if us_units not in factors:
+            factors[us_units] = unit_factors(us_units)
+        rain_factor, rate_factor = factors[us_units]
+        archive_interval = interval * 60 if interval else 300
+        if rain is not None:
+            rain *= rain_factor
+        yield ts, RainRate.archive_rain_rate(ts, rain, archive_interval, rain_entries) * rate_factor
+
+def backfill_day(dbm, span: TimeSpan, first_ts: Optional[int] = None) -> DayResult:
+    """Compute the rain rates of the archive records in span (only those at or
+    after first_ts, if given; earlier records of the day just warm up)."""
+    after = span.start if first_ts is None else first_ts - 1
+    rain_entries = RainEntries()
+    current_rates: Dict[int, Optional[float]] = {}
+    rows: List[Tuple[int, Optional[float], Optional[int], int]] = []
+    for ts, rain, interval, us_units, rain_rate in dbm.genSql(
+            'SELECT dateTime, rain, interval, usUnits, rainRate FROM %s WHERE dateTime > ? AND dateTime <= ?'
+            ' ORDER BY dateTime ASC' % dbm.table_name, (span.start - WARM_UP, span.stop)):
+        rows.append((ts, rain, interval, us_units))
+        if ts > after:
+            current_rates[ts] = rain_rate
+
+    updates: List[Tuple[float, int]] = []
+    for ts, rain_rate in compute_rain_rates(iter(rows), rain_entries):
+        if ts in current_rates:
+            current = current_rates[ts]
+            if current is None or abs(current - rain_rate) > TOLERANCE:
+                updates.append((rain_rate, ts))
+    return DayResult(stop_ts = span.stop, records = len(current_rates), updates = updates)
+
+# The database manager of a pool worker.
+_worker_dbm = None
+
+def _init_worker(manager_dict: Dict[str, Any]) -> None:
+    global _worker_dbm
+    _worker_dbm = weewx.manager.open_manager(manager_dict)
+
+def _backfill_day_in_worker(day: Tuple[TimeSpan, Optional[int]]) -> DayResult:
+    return backfill_day(_worker_dbm, *day)
+
+def write_updates(dbm, updates: List[Tuple[float, int]]) -> None:
+    """Write (rainRate, dateTime) updates in a single transaction."""
+    sql = 'UPDATE %s SET rainRate = ? WHERE dateTime = ?' % dbm.table_name
+    with weedb.Transaction(dbm.connection) as cursor:
+        if hasattr(cursor, 'executemany'):
+            cursor.executemany(sql, updates)
+        else:
+            # Not all weedb cursors expose executemany.
+            for update in updates:
+                cursor.execute(sql, update)
+
+def read_checkpoint(checkpoint: str) -> Optional[int]:
+    """Return the end of the last day written, or None if there is no checkpoint."""
+    try:
+        with open(checkpoint, 'r') as f:
+            return int(json.load(f)['last_completed'])
+    except FileNotFoundError:
+        return None
+
+def write_checkpoint(checkpoint: str, last_completed: int) -> None:
+    tmp = checkpoint + '.tmp'
+    with open(tmp, 'w') as f:
+        json.dump({ 'last_completed': last_completed }, f)
+    os.replace(tmp, checkpoint)
+
+def backfill(manager_dict: Dict[str, Any], start_ts: Optional[int] = None, stop_ts: Optional[int] = None,
+        workers: int = 1, batch_size: int = 1000, checkpoint: Optional[str] = None,
+        dry_run: bool = False) -> BackfillStats:
+    """Recompute rainRate for the archive records in [start_ts, stop_ts] (default: all
+    records) of the database described by manager_dict."""
+    stats = BackfillStats()
+    dbm = weewx.manager.open_manager(manager_dict)
+    try:
+        if start_ts is None:
+            start_ts = dbm.firstGoodStamp()
+        if stop_ts is None:
+            stop_ts = dbm.lastGoodStamp()
+        if start_ts is None or stop_ts is None:
+            log.info('No archive records to backfill.')
+            return stats
+        if checkpoint is not None:
+            last_completed = read_checkpoint(checkpoint)
+            if last_completed is not None and last_completed > start_ts:
+                log.info('Resuming after %s.' % timestamp_to_string(last_completed))
+                start_ts = last_completed + 1
+        if start_ts > stop_ts:
+            return stats
+        # A record at midnight belongs to the day ending then (which is where a start at midnight begins).
+        spans = [span for span in genDaySpans(start_ts, stop_ts) if span.stop >= start_ts]
+        # The first day is computed from its midnight, but only updated from start_ts.
+        days = [(span, start_ts if i == 0 else None) for i, span in enumerate(spans)]
+
+        pool = None
+        if workers > 1:
+            pool = multiprocessing.Pool(workers, initializer=_init_worker, initargs=(manager_dict,))
+            results = pool.imap(_backfill_day_in_worker, days)
+        else:
+            results = (backfill_day(dbm, *day) for day in days)
+
+        pending: List[Tuple[float, int]] = []
+        try:
+            # Results arrive in day order, so the checkpoint is always the end of a fully written day.
+            for result in results:
+                stats.days += 1
+                stats.records += result.records
+                stats.updated += len(result.updates)
+                pending.extend(result.updates)
+                if len(pending) >= batch_size:
+                    if not dry_run:
+                        for i in range(0, len(pending), batch_size):
+                            write_updates(dbm, pending[i:i + batch_size])
+                        if checkpoint is not None:
+                            write_checkpoint(checkpoint, result.stop_ts)
+                    pending = []
+                log.debug('Backfilled %s: %d records, %d updates.' % (
+                    timestamp_to_string(result.stop_ts), result.records, len(result.updates)))
+            if not dry_run:
+                if pending:
+                    write_updates(dbm, pending)
+                if checkpoint is not None:
+                    write_checkpoint(checkpoint, spans[-1].stop)
+        finally:
+            if pool is not None:
+                pool.close()
+                pool.join()
+    finally:
+        dbm.close()
+    return stats
+
+def to_timestamp(date_str: str) -> int:
+    return int(time.mktime(datetime.datetime.strptime(date_str, '%Y-%m-%d').timetuple()))
+
+def main() -> None:
+    parser = argparse.ArgumentParser(description='Recompute rainRate of historical archive records.')
+    parser.add_argument('config', help='Path to weewx.conf')
+    parser.add_argument('--binding', default=None, help='Data binding (default: the StdArchive binding)')
+    parser.add_argument('--from', dest='start', default=None, help='First day to backfill (YYYY-MM-DD)')
+    parser.add_argument('--to', dest='stop', default=None, help='Day after the last day to backfill (YYYY-MM-DD)')
+    parser.add_argument('--workers', type=int, default=1, help='Number of processes computing days (default: 1)')
+    parser.add_argument('--batch-size', type=int, default=1000, help='Max records updated per transaction (default: 1000)')
+    parser.add_argument('--checkpoint', default=None, help='File used to record progress and to resume from')
+    parser.add_argument('--dry-run', action='store_true', help='Compute, but do not update, the archive')
+    args = parser.parse_args()
+
+    _, config_dict = weecfg.read_config(args.config)
+    weeutil.logger.setup('rainrate_backfill', config_dict)
+    binding = args.binding or config_dict.get('StdArchive', {}).get('data_binding', 'wx_binding')
+    manager_dict = weewx.manager.get_manager_dict_from_config(config_dict, binding)
+
+    start = time.time()
+    stats = backfill(manager_dict,
+                     start_ts   = to_timestamp(args.start) if args.start else None,
+                     stop_ts    = to_timestamp(args.stop) if args.stop else None,
+                     workers    = args.workers,
+                     batch_size = args.batch_size,
+                     checkpoint = args.checkpoint,
+                     dry_run    = args.dry_run)
+    print('%s %d days, %d records, %d rainRate updates%s in %.1f seconds.' % (
+        'Checked' if args.dry_run else 'Backfilled', stats.days, stats.records, stats.updated,
+        ' needed' if args.dry_run else '', time.time() - start))
+    if stats.updated and not args.dry_run:
+        print('Rebuild the daily summaries (wee_database --rebuild-daily) to pick up the new rain rates.')
+
+if __name__ == '__main__':
+    main()
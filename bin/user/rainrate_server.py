@@ -0,0 +1,245 @@
+"""
+rainrate_server.py
+
+Copyright (C)2023 by John A Kline (john@johnkline.com)
+Distributed under the terms of the GNU Public License (GPLv3)
+
+A standalone server that computes siphon corrected rain rates for many stations,
+so that the RainRate service need not be installed on every WeeWX box.
+
+Clients connect over a Unix or TCP socket and send one JSON object per line.
+Each request gets a one line response, in order:
+
+    request : {"station": "backyard", "dateTime": 1669914670, "rain": 0.02}
+    response: {"station": "backyard", "dateTime": 1669914670, "rainRate": 0.18}
+    error   : {"error": "..."}
+
+A backlog (e.g., after a station reconnects) can be sent as one batch request:
+
+    request : {"station": "backyard", "packets": [{"dateTime": 1669914668, "rain": 0.0}, ...]}
+    response: {"station": "backyard", "rainRates": [0.0, ...]}
+
+A request longer than --max-request-bytes (default: 16 MiB, about 400,000 packets
+in a batch) is discarded and answered with {"error": "request too large"}.
+
+Each station has its own rain entries, updated with RainRate.add_packet and
+RainRate.compute_rain_rate (RainRate.add_packets for a batch) exactly as the
+RainRate service would.  Packets of
+a station must be sent in dateTime order (i.e., every loop packet, with or
+without rain).  Stations that send nothing for --idle-timeout seconds are
+evicted (their rain entries would have expired anyway).
+
+    To Run:
+
+        PYTHONPATH=/home/weewx/bin python /home/weewx/bin/user/rainrate_server.py --unix /run/rainrate/rainrate.sock
+
+        PYTHONPATH=/home/weewx/bin python /home/weewx/bin/user/rainrate_server.py --host 0.0.0.0 --port 8765
+
+    A load test client is in bin/user/rate_computer/server_loadtest.py.
+"""
+
+import argparse
+import asyncio
+import json
+import logging
+import os
+import time
+
+from dataclasses import dataclass
+from typing import Dict, List, Optional
+
+import weeutil.logger
+
+from weeutil.weeutil import to_int
+
+from user.rainrate import DEFAULT_PARAMS
+from user.rainrate import RainEntries
+from user.rainrate import RainRate
+from user.rainrate import RainRateParams
+
+log = logging.getLogger(__name__)
+
+# Responses are buffered until this many bytes are waiting to be sent.
+WRITE_HIGH_WATER = 64 * 1024
+# Longest request line accepted (a batch packet is about 40 bytes).
+DEFAULT_MAX_REQUEST_BYTES = 16 * 1024 * 1024
+TOO_LARGE_RESPONSE = b'{"error": "request too large"}\n'
+
+@dataclass
+class StationState:
+    rain_entries: RainEntries
+    last_seen   : float # time.monotonic() of the station's last packet
+
+@dataclass
+class ServerStats:
+    connections: int = 0 # connections accepted
+    packets    : int = 0 # packets processed
+    errors     : int = 0 # requests answered with an error
+    stations   : int = 0 # stations created
+    evictions  : int = 0 # stations evicted
+
+class RainRateServer:
+    def __init__(self, idle_timeout: int = 3600, params: RainRateParams = DEFAULT_PARAMS,
+            max_request_bytes: int = DEFAULT_MAX_REQUEST_BYTES):
+        self.idle_timeout = idle_timeout
+        self.params = params
+        self.max_request_bytes = max_request_bytes
+        self.stations: Dict[str, StationState] = {}
+        self.stats = ServerStats()
+
+    def process(self, station: str, pkt: Dict) -> float:
+        """Add pkt (dateTime and rain) to the station's rain entries and return
+        the station's rain rate."""
+        state = self.station_state(station)
+        RainRate.add_packet(pkt, state.rain_entries, params=self.params)
+        RainRate.compute_rain_rate(pkt, state.rain_entries, self.params)
+        self.stats.packets += 1
+        return pkt['rainRate']
+
+    def station_state(self, station: str) -> StationState:
+        """The state of station (created if new), marked as seen now."""
+        state = self.stations.get(station)
+        if state is None:
+            state = StationState(RainEntries(), 0.0)
+            self.stations[station] = state
+            self.stats.stations += 1
+            log.debug('New station: %s', station)
+        state.last_seen = time.monotonic()
+        return state
+
+    def process_batch(self, station: str, pkts: List[Dict]) -> List[float]:
+        """Add pkts (in dateTime order) to the station's rain entries and return
+        the station's rain rate after each."""
+        state = self.station_state(station)
+        self.stats.packets += RainRate.add_packets(pkts, state.rain_entries, self.params)
+        return [pkt['rainRate'] for pkt in pkts]
+
+    def handle_line(self, line: bytes) -> bytes:
+        """Return the response to a request line."""
+        try:
+            request = json.loads(line)
+            station = request['station']
+            if not isinstance(station, str):
+                raise ValueError('station must be a string')
+            if 'packets' in request:
+                pkts = [self.to_packet(p) for p in request['packets']]
+                return ('{"station": %s, "rainRates": %s}\n' % (
+                    json.dumps(station), json.dumps(self.process_batch(station, pkts)))).encode('utf-8')
+            pkt = self.to_packet(request)
+            rain_rate = self.process(station, pkt)
+            return ('{"station": %s, "dateTime": %d, "rainRate": %r}\n' % (
+                json.dumps(station), pkt['dateTime'], rain_rate)).encode('utf-8')
+        except Exception as e:
+            self.stats.errors += 1
+            log.debug('Bad request %r: %s', line, e)
+            return (json.dumps({ 'error': '%s: %s' % (type(e).__name__, e) }) + '\n').encode('utf-8')
+
+    @staticmethod
+    def to_packet(request: Dict) -> Dict:
+        """The packet (dateTime and rain) of a request."""
+        rain = request.get('rain')
+        if rain is not None and not isinstance(rain, (int, float)):
+            raise ValueError('rain must be a number or null')
+        return { 'dateTime': to_int(request['dateTime']), 'rain': rain }
+
+    async def handle_connection(self, reader: asyncio.StreamReader, writer: asyncio.StreamWriter) -> None:
+        self.stats.connections += 1
+        try:
+            while True:
+                try:
+                    line = await reader.readuntil(b'\n')
+                except asyncio.IncompleteReadError as e:
+                    # The last line, without a newline.
+                    line = e.partial
+                except asyncio.LimitOverrunError as e:
+                    await self.discard_line(reader, e.consumed)
+                    self.stats.errors += 1
+                    log.info('Discarded a request longer than %d bytes.' % self.max_request_bytes)
+                    writer.write(TOO_LARGE_RESPONSE)
+                    continue
+                if not line:
+                    break
+                if line.isspace():
+                    continue
+                writer.write(self.handle_line(line))
+                # Only wait on the socket when the client falls behind.
+                if writer.transport.get_write_buffer_size() > WRITE_HIGH_WATER:
+                    await writer.drain()
+            await writer.drain()
+        except (ConnectionError, asyncio.IncompleteReadError) as e:
+            log.info('Connection closed: %s' % e)
+        finally:
+            writer.close()
+
+    @staticmethod
+    async def discard_line(reader: asyncio.StreamReader, consumed: int) -> None:
+        """Discard an overlong line, through its newline.  consumed is the
+        LimitOverrunError's count of bytes that can be discarded now."""
+        while True:
+            await reader.readexactly(consumed)
+            try:
+                await reader.readuntil(b'\n')
+                return
+            except asyncio.LimitOverrunError as e:
+                consumed = e.consumed
+
+    def evict(self, now: Optional[float] = None) -> int:
+        """Forget stations idle for more than idle_timeout seconds.  Returns the
+        number evicted."""
+        if now is None:
+            now = time.monotonic()
+        idle = [station for station, state in self.stations.items() if now - state.last_seen > self.idle_timeout]
+        for station in idle:
+            del self.stations[station]
+        self.stats.evictions += len(idle)
+        return len(idle)
+
+    async def evict_periodically(self, interval: int) -> None:
+        while True:
+            await asyncio.sleep(interval)
+            evicted = self.evict()
+            log.info('%d stations (%d evicted), %d packets, %d errors, %d connections.' % (
+                len(self.stations), evicted, self.stats.packets, self.stats.errors, self.stats.connections))
+
+    async def serve(self, unix_path: Optional[str] = None, host: Optional[str] = None, port: Optional[int] = None,
+            evict_interval: int = 60) -> None:
+        if unix_path:
+            if os.path.exists(unix_path):
+                os.unlink(unix_path)
+            server = await asyncio.start_unix_server(self.handle_connection, path=unix_path, limit=self.max_request_bytes)
+            log.info('Listening on %s.' % unix_path)
+        else:
+            server = await asyncio.start_server(self.handle_connection, host, port, limit=self.max_request_bytes)
+            log.info('Listening on %s:%d.' % (host, port))
+        evictor = asyncio.ensure_future(self.evict_periodically(evict_interval))
+        try:
+            async with server:
+                await server.serve_forever()
+        finally:
+            evictor.cancel()
+
+def main() -> None:
+    parser = argparse.ArgumentParser(description='Compute rain rates for many stations over a socket.')
+    parser.add_argument('--unix', default=None, help='Unix socket path to listen on')
+    parser.add_argument('--host', default='127.0.0.1', help='TCP host to listen on, if no --unix (default: 127.0.0.1)')
+    parser.add_argument('--port', type=int, default=8765, help='TCP port to listen on, if no --unix (default: 8765)')
+    parser.add_argument('--idle-timeout', type=int, default=3600, help='Evict stations idle this many seconds (default: 3600)')
+    parser.add_argument('--evict-interval', type=int, default=60, help='Seconds between evictions (default: 60)')
+    parser.add_argument('--tip-size', type=float, default=DEFAULT_PARAMS.tip_size, help='Tip size (default: %(default)s)')
+    parser.add_argument('--merge-window', type=float, default=DEFAULT_PARAMS.merge_window,
+                        help='Merge tips closer than this many seconds (default: %(default)s)')
+    parser.add_argument('--max-request-bytes', type=int, default=DEFAULT_MAX_REQUEST_BYTES,
+                        help='Longest request line accepted, e.g., a batch (default: %(default)s)')
+    args = parser.parse_args()
+
+    weeutil.logger.setup('rainrate_server', {})
+    params = RainRateParams(tip_size = args.tip_size, merge_window = args.merge_window,
+                            single_tip_threshold = args.tip_size + 0.0000001)
+    server = RainRateServer(args.idle_timeout, params, args.max_request_bytes)
+    try:
+        asyncio.run(server.serve(args.unix, args.host, args.port, args.evict_interval))
+    except KeyboardInterrupt:
+        pass
+
+if __name__ == '__main__':
+    main()
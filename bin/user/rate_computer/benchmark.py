@@ -0,0 +1,275 @@
+#    Copyright (c) 2023 John A Kline <john@johnkline.com>
+#
+#    See the file LICENSE.txt for your full rights.
+#
+"""Measure the cost of the RainRate loop packet hot path.
+
+   Loop packets from the bundled storm recordings, and from synthetic long dry
+   spells and extreme cloudbursts, are replayed through a RainRate service
+   (new_loop, i.e., add_packet and compute_rain_rate) and, at the end of each
+   archive period, new_archive_record.  For each scenario, packets/sec, the
+   p50/p99 latency of new_loop and new_archive_record and the peak memory
+   allocated (measured in a separate pass, under tracemalloc) are reported.
+   Also reported is the cost per packet of new_loop in RainRate's idle state
+   (a dry packet and no rain entries), which is what most packets cost.
+
+   Results can be saved as JSON and compared against a stored baseline
+   (benchmark_baseline.json, next to this file).  A scenario regresses when its
+   packets/sec drops, or its p99 latency rises, by more than --threshold percent.
+   Regenerate the baseline (--save-baseline) when moving to a different machine.
+
+    To Run:
+
+        PYTHONPATH=/home/weewx/bin python bin/user/rate_computer/benchmark.py
+
+        PYTHONPATH=/home/weewx/bin python bin/user/rate_computer/benchmark.py --output results.json --fail-on-regression
+
+    Example output:
+
+        Scenario           Packets  Packets/sec  p50 us  p99 us  Arch p50 us  Arch p99 us  Peak KiB  vs. baseline
+        ------------------ -------  -----------  ------  ------  -----------  -----------  --------  ------------
+        dec01_tb3             9191       192499    3.41   10.32         1.11         2.15       7.1         +1.2%
+        dec03_tb3             5390       163346    4.44    7.81         1.02         2.87       5.6         -0.8%
+        .
+        .
+        .
+
+        Idle (dry, no rain entries) new_loop: 1165.7 ns/packet (baseline: 1201.3 ns)
+"""
+
+import argparse
+import json
+import logging
+import os
+import platform
+import random
+import sys
+import time
+import tracemalloc
+
+from typing import Any, Callable, Dict, List, Optional, Tuple
+
+import weewx
+
+import user.rainrate
+
+log = logging.getLogger(__name__)
+
+RATE_COMPUTER_DIR = os.path.dirname(os.path.abspath(__file__))
+DEFAULT_BASELINE = os.path.join(RATE_COMPUTER_DIR, 'benchmark_baseline.json')
+ARCHIVE_INTERVAL = 300
+
+# (dateTime, rain) pairs.
+Packets = List[Tuple[int, float]]
+
+class BenchmarkEngine:
+    """Just enough of an engine for a RainRate service to bind to."""
+    def bind(self, event_type, callback):
+        pass
+
+def read_packets(csv_file: str) -> Packets:
+    packets: Packets = []
+    with open(csv_file, 'r') as f:
+        for line in f:
+            # 1669920114,0.0,15.16
+            cols = line.split(',')
+            packets.append((int(cols[0]), float(cols[1])))
+    return packets
+
+def dry_spell(hours: int = 24) -> Packets:
+    """2s packets with no rain."""
+    start = 1669912378
+    return [(start + i * 2, 0.0) for i in range(hours * 1800)]
+
+def cloudburst(hours: int = 2) -> Packets:
+    """2s packets, with a tip in half of them and a fifth of those a siphon
+    double tip (about 10"/hr, fixed seed)."""
+    rng = random.Random(1669912378)
+    start = 1669912378
+    packets: Packets = []
+    for i in range(hours * 1800):
+        rain = 0.0
+        if rng.random() < 0.5:
+            rain = 0.02 if rng.random() < 0.2 else 0.01
+        packets.append((start + i * 2, rain))
+    return packets
+
+SCENARIOS: Dict[str, Callable[[], Packets]] = {
+    'dec01_tb3' : lambda: read_packets(os.path.join(RATE_COMPUTER_DIR, '2022Dec01_PaloAlto_0.68inch_storm_TB3.csv')),
+    'dec03_tb3' : lambda: read_packets(os.path.join(RATE_COMPUTER_DIR, '2022Dec03_PaloAlto_partial_TB3.csv')),
+    'dry_spell' : dry_spell,
+    'cloudburst': cloudburst,
+}
+
+def new_service() -> user.rainrate.RainRate:
+    config_dict = {
+        'RainRate'  : { 'enable': 'true' },
+        'StdArchive': { 'archive_interval': str(ARCHIVE_INTERVAL) },
+    }
+    return user.rainrate.RainRate(BenchmarkEngine(), config_dict)
+
+def replay(packets: Packets, timed: bool = True) -> Tuple[List[int], List[int]]:
+    """Replay packets through a new RainRate service.  Returns the new_loop and
+    new_archive_record latencies (in ns)."""
+    service = new_service()
+    loop_ns: List[int] = []
+    archive_ns: List[int] = []
+    clock = time.perf_counter_ns
+    end_of_period = -(-packets[0][0] // ARCHIVE_INTERVAL) * ARCHIVE_INTERVAL
+    period_rain = 0.0
+    for ts, rain in packets:
+        event = weewx.Event(weewx.NEW_LOOP_PACKET, packet={ 'dateTime': ts, 'usUnits': weewx.US, 'rain': rain, 'rainRate': 0.0 })
+        start = clock()
+        service.new_loop(event)
+        if timed:
+            loop_ns.append(clock() - start)
+        if ts > end_of_period:
+            # As with StdArchive, the record for a period follows the first packet of the next.
+            event = weewx.Event(weewx.NEW_ARCHIVE_RECORD, record={ 'dateTime': end_of_period, 'usUnits': weewx.US, 'rain': period_rain })
+            start = clock()
+            service.new_archive_record(event)
+            if timed:
+                archive_ns.append(clock() - start)
+            end_of_period += ARCHIVE_INTERVAL
+            period_rain = 0.0
+        period_rain += rain
+    return loop_ns, archive_ns
+
+def idle_overhead(count: int = 200000) -> Dict[str, float]:
+    """The cost, in ns per packet, of new_loop for dry packets with no rain
+    entries (i.e., RainRate's idle state).  The cost of the benchmark loop
+    itself (updating the packet) is measured separately and subtracted."""
+    service = new_service()
+    pkt: Dict[str, Any] = { 'dateTime': 0, 'usUnits': weewx.US, 'rain': 0.0, 'rainRate': 0.0 }
+    event = weewx.Event(weewx.NEW_LOOP_PACKET, packet=pkt)
+    new_loop = service.new_loop
+    clock = time.perf_counter_ns
+    start_ts = 1669912378
+
+    start = clock()
+    for ts in range(start_ts, start_ts + 2 * count, 2):
+        pkt['dateTime'] = ts
+    loop_ns = clock() - start
+
+    start = clock()
+    for ts in range(start_ts, start_ts + 2 * count, 2):
+        pkt['dateTime'] = ts
+        new_loop(event)
+    total_ns = clock() - start
+
+    return {
+        'packets'          : count,
+        'new_loop_ns'      : round((total_ns - loop_ns) / count, 1),
+        'benchmark_loop_ns': round(loop_ns / count, 1),
+    }
+
+def percentile_us(samples: List[int], p: float) -> float:
+    if not samples:
+        return 0.0
+    ordered = sorted(samples)
+    return ordered[min(len(ordered) - 1, int(p * len(ordered)))] / 1000.0
+
+def run_scenario(packets: Packets, repeat: int) -> Dict[str, Any]:
+    best: Optional[Dict[str, Any]] = None
+    for _ in range(repeat):
+        start = time.perf_counter()
+        loop_ns, archive_ns = replay(packets)
+        elapsed = time.perf_counter() - start
+        result = {
+            'packets'        : len(packets),
+            'packets_per_sec': round(len(packets) / elapsed),
+            'p50_us'         : percentile_us(loop_ns, 0.50),
+            'p99_us'         : percentile_us(loop_ns, 0.99),
+            'archive_p50_us' : percentile_us(archive_ns, 0.50),
+            'archive_p99_us' : percentile_us(archive_ns, 0.99),
+        }
+        if best is None or result['packets_per_sec'] > best['packets_per_sec']:
+            best = result
+
+    # Measure memory separately, tracemalloc slows everything down.
+    tracemalloc.start()
+    replay(packets, timed=False)
+    _, peak = tracemalloc.get_traced_memory()
+    tracemalloc.stop()
+    best['peak_kib'] = round(peak / 1024.0, 1)
+    return best
+
+def run(scenarios: List[str], repeat: int) -> Dict[str, Any]:
+    return {
+        'rainrate_version': user.rainrate.RAINRATE_VERSION,
+        'python'          : platform.python_version(),
+        'platform'        : platform.platform(),
+        'timestamp'       : int(time.time()),
+        'scenarios'       : { name: run_scenario(SCENARIOS[name](), repeat) for name in scenarios },
+    }
+
+def compare(results: Dict[str, Any], baseline: Dict[str, Any], threshold: float) -> List[str]:
+    """Return a description of each regression against baseline."""
+    regressions: List[str] = []
+    for name, result in results['scenarios'].items():
+        base = baseline.get('scenarios', {}).get(name)
+        if base is None:
+            continue
+        if result['packets_per_sec'] < base['packets_per_sec'] * (1.0 - threshold / 100.0):
+            regressions.append('%s: packets/sec %d vs. baseline %d' % (name, result['packets_per_sec'], base['packets_per_sec']))
+        if result['p99_us'] > base['p99_us'] * (1.0 + threshold / 100.0):
+            regressions.append('%s: p99 %.2fus vs. baseline %.2fus' % (name, result['p99_us'], base['p99_us']))
+    return regressions
+
+def print_results(results: Dict[str, Any], baseline: Optional[Dict[str, Any]]) -> None:
+    print('Scenario           Packets  Packets/sec  p50 us  p99 us  Arch p50 us  Arch p99 us  Peak KiB  vs. baseline')
+    print('------------------ -------  -----------  ------  ------  -----------  -----------  --------  ------------')
+    for name, r in results['scenarios'].items():
+        change = ''
+        base = baseline.get('scenarios', {}).get(name) if baseline else None
+        if base:
+            change = '%+.1f%%' % (100.0 * (r['packets_per_sec'] - base['packets_per_sec']) / base['packets_per_sec'])
+        print('%-18s %7d  %11d  %6.2f  %6.2f  %11.2f  %11.2f  %8.1f  %12s' % (
+            name, r['packets'], r['packets_per_sec'], r['p50_us'], r['p99_us'],
+            r['archive_p50_us'], r['archive_p99_us'], r['peak_kib'], change))
+    if 'idle' in results:
+        idle = results['idle']
+        change = ''
+        base = baseline.get('idle') if baseline else None
+        if base:
+            change = ' (baseline: %.1f ns)' % base['new_loop_ns']
+        print('\nIdle (dry, no rain entries) new_loop: %.1f ns/packet%s' % (idle['new_loop_ns'], change))
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Benchmark the RainRate loop packet hot path.')
+    parser.add_argument('--scenario', action='append', choices=sorted(SCENARIOS), help='Scenario to run (default: all)')
+    parser.add_argument('--repeat', type=int, default=3, help='Runs per scenario, the fastest is reported (default: 3)')
+    parser.add_argument('--output', help='Save the results to this JSON file')
+    parser.add_argument('--baseline', default=DEFAULT_BASELINE, help='Baseline JSON file to compare against')
+    parser.add_argument('--save-baseline', action='store_true', help='Save the results as the new baseline')
+    parser.add_argument('--threshold', type=float, default=25.0, help='Percent change considered a regression (default: 25)')
+    parser.add_argument('--fail-on-regression', action='store_true', help='Exit with status 1 on a regression')
+    parser.add_argument('--log-level', default='INFO', help='Log level of the service while benchmarking (default: INFO)')
+    args = parser.parse_args()
+
+    # Log as the service would, but don't measure syslog.
+    logging.basicConfig(level=args.log_level.upper(), handlers=[logging.StreamHandler(open(os.devnull, 'w'))])
+
+    results = run(args.scenario or list(SCENARIOS), args.repeat)
+    results['idle'] = min((idle_overhead() for _ in range(args.repeat)), key=lambda r: r['new_loop_ns'])
+
+    baseline: Optional[Dict[str, Any]] = None
+    if not args.save_baseline and os.path.exists(args.baseline):
+        with open(args.baseline, 'r') as f:
+            baseline = json.load(f)
+    print_results(results, baseline)
+
+    if args.output:
+        with open(args.output, 'w') as f:
+            json.dump(results, f, indent=4)
+    if args.save_baseline:
+        with open(args.baseline, 'w') as f:
+            json.dump(results, f, indent=4)
+            f.write('\n')
+
+    if baseline:
+        regressions = compare(results, baseline, args.threshold)
+        for regression in regressions:
+            print('REGRESSION: %s' % regression)
+        if regressions and args.fail_on_regression:
+            sys.exit(1)
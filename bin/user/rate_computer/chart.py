@@ -0,0 +1,324 @@
+#    Copyright (c) 2023 John A Kline <john@johnkline.com>
+#
+#    See the file LICENSE.txt for your full rights.
+#
+"""Chart the rain rates of recordings (e.g., a gauge's original rain rates,
+   the rain rates rate_computer.py computes for it and a reference gauge's rain
+   rates) as an SVG image, such as the before and after images in the README.
+
+   The recordings are csv files or storm recordings, each optionally followed by
+   :<column> (see combiner.py).  They share a time axis starting at the earliest
+   timestamp, as with combiner.py, but as each is drawn at its own timestamps
+   they are not snapped to a common grid; each is streamed and downsampled on
+   its own, so a chart holds a few thousand points however long the recordings
+   are (--method):
+       minmax: the min and max in each time bucket (the default).  Buckets start
+               1s wide and double, merging neighbours, whenever there are more
+               than two per pixel, so rows are streamed in constant memory.
+               Every spike is drawn.
+       lttb  : Largest-Triangle-Three-Buckets, keeping the point of each bucket
+               that best preserves the shape of the line.  Smoother looking,
+               but a recording is held in memory (16 bytes per row).
+
+   Most rows repeat the rain rate of the row before (it is usually dry, and
+   rates change only on a tip), which minmax skips with a single comparison, so
+   charting a year of 2s rows from a storm recording takes a few seconds (csv
+   files take longer to parse).
+
+    To Run (the original TB3 rain rates, the computed TB3 rain rates and the TB7 as a reference):
+
+        PYTHONPATH=/home/weewx/bin python bin/user/rate_computer/rate_computer.py tb3.csv --csv > tb3_computed.csv
+        python bin/user/rate_computer/chart.py tb3.csv:2 tb3_computed.csv tb7.csv:2 --label 'TB3 original' --label 'TB3 computed' --label 'TB7' --output dec01.svg
+
+    Example output (on stderr):
+
+        dec01.svg: 27952 rows, 3 series, 4185 points (minmax) in 0.05 seconds
+"""
+
+import argparse
+import math
+import os
+import sys
+import time
+
+from array import array
+from typing import Iterable, Iterator, List, Optional, Sequence, Tuple
+from xml.sax.saxutils import escape
+
+from combiner import Combiner
+from storm import StormRecording
+from storm import is_storm_file
+
+# (timestamp, rain rate)
+Point = Tuple[float, float]
+# (bucket index, time of min, min, time of max, max)
+Bucket = Tuple[int, float, float, float, float]
+
+COLORS = ['#d62728', '#1f77b4', '#2ca02c', '#ff7f0e', '#9467bd', '#8c564b', '#e377c2', '#7f7f7f']
+
+# Seconds between time axis ticks, at least MIN_TICK_PIXELS apart.
+TICK_STEPS = [60, 120, 300, 600, 900, 1800, 3600, 7200, 10800, 21600, 43200,
+              86400, 2 * 86400, 7 * 86400, 14 * 86400, 28 * 86400, 91 * 86400]
+MIN_TICK_PIXELS = 100
+
+MARGIN_LEFT = 60
+MARGIN_RIGHT = 20
+MARGIN_TOP = 40
+MARGIN_BOTTOM = 40
+
+class MinMaxBuckets:
+    """The min and max of a series (and when each occurred), per time bucket.
+    Buckets start 1s wide (bucket 0 starting at start) and double whenever
+    there are more than max_buckets."""
+    def __init__(self, start: float, max_buckets: int):
+        self.start = start
+        self.max_buckets = max_buckets
+        self.width: float = 1.0
+        self.count: int = 0
+        self.buckets: List[Bucket] = []
+
+    def add_all(self, points: Iterable[Point]) -> None:
+        """Add points (in ascending time order)."""
+        start = self.start
+        buckets = self.buckets
+        count = 0
+        index = -1
+        bucket_end = start
+        min_ts = min_rate = max_ts = max_rate = previous = 0.0
+        for ts, rate in points:
+            count += 1
+            if ts < bucket_end:
+                if rate == previous:
+                    continue
+                previous = rate
+                if rate < min_rate:
+                    min_ts, min_rate = ts, rate
+                elif rate > max_rate:
+                    max_ts, max_rate = ts, rate
+                continue
+            if index >= 0:
+                buckets.append((index, min_ts, min_rate, max_ts, max_rate))
+                while len(buckets) > self.max_buckets:
+                    self.double()
+            index = int((ts - start) // self.width)
+            if buckets and buckets[-1][0] == index:
+                # Doubling merged this point's bucket into the last one.
+                index, min_ts, min_rate, max_ts, max_rate = buckets.pop()
+                if rate < min_rate:
+                    min_ts, min_rate = ts, rate
+                elif rate > max_rate:
+                    max_ts, max_rate = ts, rate
+            else:
+                min_ts = max_ts = ts
+                min_rate = max_rate = rate
+            previous = rate
+            bucket_end = start + (index + 1) * self.width
+        if index >= 0:
+            buckets.append((index, min_ts, min_rate, max_ts, max_rate))
+        self.count += count
+
+    def double(self) -> None:
+        """Double the bucket width, merging neighbouring buckets."""
+        self.width *= 2
+        merged: List[Bucket] = []
+        for index, min_ts, min_rate, max_ts, max_rate in self.buckets:
+            index //= 2
+            if merged and merged[-1][0] == index:
+                _, other_min_ts, other_min_rate, other_max_ts, other_max_rate = merged[-1]
+                if other_min_rate <= min_rate:
+                    min_ts, min_rate = other_min_ts, other_min_rate
+                if other_max_rate >= max_rate:
+                    max_ts, max_rate = other_max_ts, other_max_rate
+                merged[-1] = (index, min_ts, min_rate, max_ts, max_rate)
+            else:
+                merged.append((index, min_ts, min_rate, max_ts, max_rate))
+        self.buckets[:] = merged
+
+    def points(self) -> List[Point]:
+        """The min and max of each bucket, in the order they occurred (rounded
+        to 6 places, hiding the float32 noise of storm recordings)."""
+        points: List[Point] = []
+        for _, min_ts, min_rate, max_ts, max_rate in self.buckets:
+            first, second = (min_ts, round(min_rate, 6)), (max_ts, round(max_rate, 6))
+            if max_ts < min_ts:
+                first, second = second, first
+            points.append(first)
+            if second != first:
+                points.append(second)
+        return points
+
+def lttb(xs: Sequence[float], ys: Sequence[float], threshold: int) -> List[Point]:
+    """Downsample to threshold points with Largest-Triangle-Three-Buckets: keep
+    the first and last points and, of each bucket in between, the point forming
+    the largest triangle with the point kept for the previous bucket and the
+    average of the next bucket."""
+    count = len(xs)
+    if threshold >= count or threshold < 3:
+        return [(x, round(y, 6)) for x, y in zip(xs, ys)]
+    points: List[Point] = [(xs[0], round(ys[0], 6))]
+    every = (count - 2) / (threshold - 2)
+    a = 0
+    for i in range(threshold - 2):
+        start = int(i * every) + 1
+        end = int((i + 1) * every) + 1
+        next_end = min(int((i + 2) * every) + 1, count)
+        next_count = next_end - end
+        avg_x = sum(xs[end:next_end]) / next_count
+        avg_y = sum(ys[end:next_end]) / next_count
+        ax, ay = xs[a], ys[a]
+        max_area = -1.0
+        chosen = start
+        for j in range(start, end):
+            area = abs((ax - avg_x) * (ys[j] - ay) - (ax - xs[j]) * (avg_y - ay))
+            if area > max_area:
+                max_area = area
+                chosen = j
+        points.append((xs[chosen], round(ys[chosen], 6)))
+        a = chosen
+    points.append((xs[-1], round(ys[-1], 6)))
+    return points
+
+def read_points(rainfile: str, column: int) -> Iterator[Point]:
+    """Lazily yield the (timestamp, column) rows of a csv file or a storm
+    recording (whose columns are timestamp, rain and rainRate)."""
+    if is_storm_file(rainfile):
+        with StormRecording(rainfile) as recording:
+            yield from zip(recording.timestamps, (recording.timestamps, recording.rains, recording.rates)[column])
+        return
+    with open(rainfile, 'r') as f:
+        for line in f:
+            cols = line.split(',')
+            yield float(cols[0]), float(cols[column])
+
+def downsample_minmax(points: Iterable[Point], start: float, pixels: int) -> Tuple[int, List[Point]]:
+    """Returns the number of points read and the points to draw."""
+    buckets = MinMaxBuckets(start, 2 * pixels)
+    buckets.add_all(points)
+    return buckets.count, buckets.points()
+
+def downsample_lttb(points: Iterable[Point], start: float, pixels: int) -> Tuple[int, List[Point]]:
+    """Returns the number of points read and the points to draw."""
+    xs, ys = array('d'), array('d')
+    for ts, rate in points:
+        xs.append(ts)
+        ys.append(rate)
+    return len(xs), lttb(xs, ys, 2 * pixels)
+
+def nice_step(span: float, ticks: int) -> float:
+    """A 1, 2, 2.5 or 5 times a power of 10 step giving about ticks ticks over span."""
+    raw = span / ticks
+    magnitude = 10 ** math.floor(math.log10(raw))
+    for multiple in (1, 2, 2.5, 5, 10):
+        if raw <= multiple * magnitude:
+            return multiple * magnitude
+    return 10 * magnitude
+
+def time_ticks(start: float, end: float, pixels: int) -> List[Tuple[float, str]]:
+    """(timestamp, label) of each time axis tick, on local time boundaries."""
+    span = max(end - start, 1.0)
+    step = TICK_STEPS[-1]
+    for candidate in TICK_STEPS:
+        if pixels * candidate / span >= MIN_TICK_PIXELS:
+            step = candidate
+            break
+    if step >= 86400:
+        fmt = '%m/%d/%y'
+    elif span > 86400:
+        fmt = '%m/%d %H:%M'
+    else:
+        fmt = '%H:%M'
+    offset = time.localtime(start).tm_gmtoff
+    ticks: List[Tuple[float, str]] = []
+    ts = -(-(start + offset) // step) * step - offset
+    while ts <= end:
+        ticks.append((ts, time.strftime(fmt, time.localtime(ts))))
+        ts += step
+    return ticks
+
+def render_svg(series: List[Tuple[str, List[Point]]], width: int, height: int, title: str,
+        y_max: Optional[float] = None) -> str:
+    """An SVG line chart of the series (label, points), all sharing the time axis."""
+    plot_width = width - MARGIN_LEFT - MARGIN_RIGHT
+    plot_height = height - MARGIN_TOP - MARGIN_BOTTOM
+    all_points = [point for _, points in series for point in points]
+    start = min((ts for ts, _ in all_points), default=0.0)
+    end = max((ts for ts, _ in all_points), default=1.0)
+    if end <= start:
+        end = start + 1.0
+    if y_max is None:
+        y_max = max((rate for _, rate in all_points), default=0.0)
+    y_step = nice_step(y_max if y_max > 0.0 else 1.0, 5)
+    y_top = max(math.ceil(y_max / y_step - 1e-9), 1) * y_step
+
+    def x(ts: float) -> float:
+        return MARGIN_LEFT + plot_width * (ts - start) / (end - start)
+
+    def y(rate: float) -> float:
+        return MARGIN_TOP + plot_height * (1.0 - min(rate, y_top) / y_top)
+
+    out: List[str] = []
+    out.append('<svg xmlns="http://www.w3.org/2000/svg" width="%d" height="%d" viewBox="0 0 %d %d" font-family="sans-serif" font-size="12">' % (width, height, width, height))
+    out.append('<rect width="100%" height="100%" fill="white"/>')
+    out.append('<text x="%d" y="%d" font-size="16" text-anchor="middle">%s</text>' % (width // 2, MARGIN_TOP // 2 + 6, escape(title)))
+    # Grid and axes
+    for i in range(int(round(y_top / y_step)) + 1):
+        rate = i * y_step
+        out.append('<line x1="%d" y1="%.1f" x2="%d" y2="%.1f" stroke="#ddd"/>' % (MARGIN_LEFT, y(rate), MARGIN_LEFT + plot_width, y(rate)))
+        out.append('<text x="%d" y="%.1f" text-anchor="end">%g</text>' % (MARGIN_LEFT - 6, y(rate) + 4, round(rate, 6)))
+    for ts, label in time_ticks(start, end, plot_width):
+        out.append('<line x1="%.1f" y1="%d" x2="%.1f" y2="%d" stroke="#ddd"/>' % (x(ts), MARGIN_TOP, x(ts), MARGIN_TOP + plot_height))
+        out.append('<text x="%.1f" y="%d" text-anchor="middle">%s</text>' % (x(ts), MARGIN_TOP + plot_height + 16, escape(label)))
+    out.append('<rect x="%d" y="%d" width="%d" height="%d" fill="none" stroke="black"/>' % (MARGIN_LEFT, MARGIN_TOP, plot_width, plot_height))
+    out.append('<text transform="translate(14,%d) rotate(-90)" text-anchor="middle">Rain rate (per hour)</text>' % (MARGIN_TOP + plot_height // 2))
+    # Series and legend
+    for i, (label, points) in enumerate(series):
+        color = COLORS[i % len(COLORS)]
+        out.append('<polyline fill="none" stroke="%s" stroke-width="1" stroke-linejoin="round" points="%s"/>' % (
+            color, ' '.join('%.1f,%.1f' % (x(ts), y(rate)) for ts, rate in points)))
+        legend_y = MARGIN_TOP + 16 + 16 * i
+        out.append('<line x1="%d" y1="%d" x2="%d" y2="%d" stroke="%s" stroke-width="2"/>' % (
+            MARGIN_LEFT + 10, legend_y - 4, MARGIN_LEFT + 30, legend_y - 4, color))
+        out.append('<text x="%d" y="%d">%s</text>' % (MARGIN_LEFT + 36, legend_y, escape(label)))
+    out.append('</svg>\n')
+    return '\n'.join(out)
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Chart the rain rates of recordings as an SVG image.')
+    parser.add_argument('files', nargs='+', help='timestamp,...,rainRate csv files (or storm recordings), each optionally followed by :<column>')
+    parser.add_argument('--output', required=True, help='SVG file to write')
+    parser.add_argument('--label', action='append', default=None, help='Legend label of a file, in order (default: the file name)')
+    parser.add_argument('--title', default=None, help='Chart title (default: the time span charted)')
+    parser.add_argument('--method', choices=['minmax', 'lttb'], default='minmax', help='Downsampling method (default: minmax)')
+    parser.add_argument('--width', type=int, default=1200, help='Width in pixels (default: 1200)')
+    parser.add_argument('--height', type=int, default=500, help='Height in pixels (default: 500)')
+    parser.add_argument('--y-max', type=float, default=None, help='Top of the rain rate axis, higher rates are clipped (default: the highest rate)')
+    parser.add_argument('--column', type=int, default=1, help='Column holding the rain rate, for files without :<column> (default: 1, the first after the timestamp)')
+    args = parser.parse_args()
+    labels = args.label or [os.path.basename(f).split('.')[0] for f in args.files]
+    if len(labels) != len(args.files):
+        parser.error('%d labels for %d files' % (len(labels), len(args.files)))
+    if args.width <= MARGIN_LEFT + MARGIN_RIGHT or args.height <= MARGIN_TOP + MARGIN_BOTTOM:
+        parser.error('--width and --height are too small')
+
+    started = time.perf_counter()
+    pixels = args.width - MARGIN_LEFT - MARGIN_RIGHT
+    specs = [Combiner.file_column(f, args.column) for f in args.files]
+    firsts = [ts for ts in (Combiner.first_timestamp(f, c) for f, c in specs) if ts is not None]
+    start = min(firsts, default=0.0)
+    downsample = downsample_lttb if args.method == 'lttb' else downsample_minmax
+    count = 0
+    points: List[List[Point]] = []
+    for f, c in specs:
+        rows, series_points = downsample(read_points(f, c), start, pixels)
+        count += rows
+        points.append(series_points)
+    title = args.title
+    if title is None:
+        timestamps = [ts for series in points for ts, _ in series]
+        title = 'Rain rates' if not timestamps else 'Rain rates, %s to %s' % (
+            time.strftime('%m/%d/%y %H:%M', time.localtime(min(timestamps))),
+            time.strftime('%m/%d/%y %H:%M', time.localtime(max(timestamps))))
+    with open(args.output, 'w') as f:
+        f.write(render_svg(list(zip(labels, points)), args.width, args.height, title, args.y_max))
+    sys.stderr.write('%s: %d rows, %d series, %d points (%s) in %.2f seconds\n' % (
+        args.output, count, len(args.files), sum(len(p) for p in points), args.method, time.perf_counter() - started))
@@ -2,15 +2,37 @@
 #
 #    See the file LICENSE.txt for your full rights.
 #
-"""Given two comma separated files, each containing a timestamp and a rainRate,
-   match up the files and print <datetime>,<file-a-rainrate>,<file-b-rainrate>
-   This program assumes 2s updates for the observations.  It will match records
-   even if the observations' timestamps from each file are off by 1s.
+"""Given any number of comma separated files, each containing a timestamp and a
+   rainRate (or storm recordings, see storm.py), match up the files and print <datetime>,<file-a-rainrate>,<file-b-rainrate>,...
+   Observations are aligned to a grid of --cadence seconds (default: 2s),
+   starting at the earliest timestamp.  An observation is matched to the nearest
+   grid time if it is off by no more than --tolerance seconds (default: 1s).
+   Where a file has no observation for a grid time, 0.0 is printed.
+
+   The files are streamed (never read into memory), so months of observations
+   from several gauges can be combined.  Each file goes through a pipeline of
+   generators:
+       read   : parse (timestamp, value) rows
+       dedupe : drop rows repeating the previous timestamp
+       jitter : drop rows squeezed in between their neighbours (e.g., the
+                middle row of rows 1s apart when the cadence is 2s)
+       snap   : move each row to its grid time (a row exactly between two grid
+                times goes to the earlier one, unless that one is taken), drop
+                rows too far from the grid or behind the previous row
+   and the snapped files are merge joined on grid time.
 
     To Run:
 
         python bin/user/rate_computer/combiner.py tb3.csv tb7.csv
 
+        python bin/user/rate_computer/combiner.py --cadence 2.5 --tolerance 1.25 tb3.csv tb7.csv other.csv
+
+    A file may be followed by :<column> to read a column other than --column,
+    e.g., the original rain rates of a loop packet recording (column 2) against
+    the rain rates computed by rate_computer.py --csv (column 1):
+
+        python bin/user/rate_computer/combiner.py tb3.csv:2 tb3_computed.csv tb7.csv:2
+
     Example output:
         .
         .
@@ -40,85 +62,156 @@
 
 """
 
+import argparse
 import datetime
 import os
 import sys
 
 from dataclasses import dataclass
-from typing import List
+from typing import Iterable, Iterator, List, Optional, Tuple
+
+from storm import StormRecording
+from storm import is_storm_file
 
 @dataclass
 class RainEvent:
-    """A list of RainEntry is kept for the last 15 minutes."""
-    timestamp: int   # timestamp when this rain occurred
+    """An observation read from one of the files."""
+    timestamp: float # timestamp of the observation
     rainRate : float # rainrate reported
 
+@dataclass
+class SnapStats:
+    """Rows dropped while snapping a file to the grid."""
+    off_grid: int = 0 # more than tolerance from a grid time
+    late    : int = 0 # at or behind the grid time of an earlier row
+
 class Combiner():
     @staticmethod
-    def read_rain_events(rainfile: str) -> List[RainEvent]:
-        rain_events: List[RainEvent] = []
+    def read_rain_events(rainfile: str, column: int = 1) -> Iterator[RainEvent]:
+        """Lazily yield the (timestamp, column) rows of a csv file or a storm
+        recording (whose columns are timestamp, rain and rainRate)."""
+        if is_storm_file(rainfile):
+            with StormRecording(rainfile) as recording:
+                for row in recording.rows():
+                    yield RainEvent(timestamp = float(row[0]), rainRate = row[column])
+            return
+        with open(rainfile, 'r') as f:
+            for line in f:
+                cols = line.split(',')
+                yield RainEvent(timestamp = float(cols[0]), rainRate = float(cols[column]))
+
+    @staticmethod
+    def dedupe(events: Iterable[RainEvent]) -> Iterator[RainEvent]:
+        """Drop rows with the same timestamp as the previous row."""
+        previous: Optional[float] = None
+        for event in events:
+            if event.timestamp != previous:
+                yield event
+            previous = event.timestamp
+
+    @staticmethod
+    def drop_jitter(events: Iterable[RainEvent], cadence: float) -> Iterator[RainEvent]:
+        """Drop a row squeezed in between its neighbours (i.e., the rows before
+        and after it are no more than cadence apart), such as the middle row of
+        rows 1s apart when the cadence is 2s."""
+        previous: Optional[RainEvent] = None
+        current: Optional[RainEvent] = None
+        for event in events:
+            if current is not None and (previous is None or event.timestamp - previous.timestamp > cadence):
+                yield current
+            previous, current = current, event
+        if current is not None:
+            yield current
+
+    @staticmethod
+    def snap(events: Iterable[RainEvent], start: float, cadence: float, tolerance: float,
+            stats: Optional[SnapStats] = None) -> Iterator[Tuple[int, float]]:
+        """Yield (slot, rainRate), where slot is the index of the grid time
+        (start + slot * cadence) nearest the row.  A row exactly between two grid
+        times goes to the earlier one unless it is already taken.  Rows more than
+        tolerance from their grid time, or at or behind the slot of an earlier
+        row, are dropped (and counted in stats)."""
+        if stats is None:
+            stats = SnapStats()
+        last_slot = -1
+        for event in events:
+            offset = (event.timestamp - start) / cadence
+            slot = int(offset)
+            if offset - slot > 0.5 or (offset - slot == 0.5 and slot <= last_slot):
+                slot += 1
+            if abs(event.timestamp - (start + slot * cadence)) > tolerance:
+                stats.off_grid += 1
+            elif slot <= last_slot:
+                stats.late += 1
+            else:
+                last_slot = slot
+                yield slot, event.rainRate
+
+    @staticmethod
+    def merge_join(series: List[Iterator[Tuple[int, float]]]) -> Iterator[Tuple[int, List[Optional[float]]]]:
+        """Merge join snapped series on slot.  Yields (slot, values) for every
+        slot from 0 through the last slot of any series, with None for a series
+        lacking that slot."""
+        heads: List[Optional[Tuple[int, float]]] = [next(s, None) for s in series]
+        slot = 0
+        while any(head is not None for head in heads):
+            values: List[Optional[float]] = []
+            for i, head in enumerate(heads):
+                if head is not None and head[0] == slot:
+                    values.append(head[1])
+                    heads[i] = next(series[i], None)
+                else:
+                    values.append(None)
+            yield slot, values
+            slot += 1
 
-        f = open(rainfile, "r")
-        lines = f.readlines()
-        for line in lines:
-            cols = line.split(',')
-            rain_events.append(RainEvent(
-                timestamp = int(cols[0]),
-                rainRate  = float(cols[1])))
-        f.close()
-        return rain_events
+    @staticmethod
+    def file_column(rainfile: str, column: int) -> Tuple[str, int]:
+        """Split a file:column spec into (file, column); column if there is no
+        :column suffix."""
+        path, sep, suffix = rainfile.rpartition(':')
+        if sep and suffix.isdigit():
+            return path, int(suffix)
+        return rainfile, column
 
+    @staticmethod
+    def first_timestamp(rainfile: str, column: int) -> Optional[float]:
+        for event in Combiner.read_rain_events(rainfile, column):
+            return event.timestamp
+        return None
+
+    @staticmethod
+    def combine(rainfiles: List[str], cadence: float = 2.0, tolerance: float = 1.0, column: int = 1,
+            stats: Optional[List[SnapStats]] = None) -> Iterator[Tuple[float, List[Optional[float]]]]:
+        """Yield (timestamp, values) for each grid time, values holding the rainRate
+        of each file (None where the file has no observation).  A file may be a
+        file:column spec."""
+        specs = [Combiner.file_column(f, column) for f in rainfiles]
+        firsts = [ts for ts in (Combiner.first_timestamp(f, c) for f, c in specs) if ts is not None]
+        if not firsts:
+            return
+        start = min(firsts)
+        if stats is None:
+            stats = [SnapStats() for _ in rainfiles]
+        series = [Combiner.snap(Combiner.drop_jitter(Combiner.dedupe(Combiner.read_rain_events(f, c)), cadence),
+                                start, cadence, tolerance, s) for (f, c), s in zip(specs, stats)]
+        for slot, values in Combiner.merge_join(series):
+            yield start + slot * cadence, values
 
 if __name__ == '__main__':
-    if len(sys.argv) != 3:
-        print('usage %s <tb3_csv> <tb7_csv>')
-        sys.exit(1)
-    tb3_filename = sys.argv[1]
-    tb7_filename = sys.argv[2]
-    tb3 = Combiner.read_rain_events(tb3_filename)
-    tb7 = Combiner.read_rain_events(tb7_filename)
-    ts = min(tb3[0].timestamp, tb7[0].timestamp)
-    i3 = 0
-    i7 = 0
-    print('Time,%s,%s' % (os.path.basename(tb3_filename).split('.')[0], os.path.basename(tb7_filename).split('.')[0]))
-    while i3 < len(tb3) or i7 < len(tb7):
-        if i3 != 0 and i3 < len(tb3) and tb3[i3 - 1].timestamp == tb3[i3].timestamp:
-            # dup tb3 timestamp
-            i3 += 1
-        if i3 != 0 and i3 < len(tb3) - 1 and tb3[i3 - 1].timestamp == tb3[i3].timestamp - 1 and tb3[i3].timestamp == tb3[i3+1].timestamp - 1:
-            # ignore one second jumps, if another one follows 1s later
-            i3 += 1
-        if i7 != 0 and i7 < len(tb7) - 1 and tb7[i7 - 1].timestamp == tb7[i7].timestamp - 1 and tb7[i7].timestamp == tb7[i7+1].timestamp - 1:
-            # ignore one second jumps, if another one follows 1s later
-            i7 += 1
-        if i7 != 0 and i7 < len(tb7) and tb7[i7 - 1].timestamp == tb7[i7].timestamp:
-            # dup tb7 timestamp
-            i7 += 1
-        if i3 >= len(tb3) and i7 >= len(tb7):
-            continue
-        if (i3 < len(tb3) and ts > (tb3[i3].timestamp + 1)) or (i7 < len(tb7) and ts > (tb7[i7].timestamp + 1)):
-            print('Houston, we have a problem: ts:%s, tb3:%d, tb7:%d' % (datetime.datetime.fromtimestamp(ts).strftime('%m/%d/%y %H:%M:%S'), tb3[i3].timestamp, tb7[i7].timestamp))
-            sys.exit(1)
-        elif i3 < len(tb3) and i7 < len(tb7) and tb3[i3].timestamp >= ts - 1 and tb3[i3].timestamp <= ts + 1 and tb7[i7].timestamp >= ts - 1 and tb7[i7].timestamp <= ts + 1:
-            # both timestamps match
-            print('%s,%5.3f,%5.3f' % (datetime.datetime.fromtimestamp(ts).strftime('%m/%d/%y %H:%M:%S'), tb3[i3].rainRate, tb7[i7].rainRate))
-            i3 += 1
-            i7 += 1
-        elif i3 < len(tb3) and tb3[i3].timestamp >= ts - 1 and tb3[i3].timestamp <= ts + 1:
-            # tb3 matches
-            # tb7 is missing because it is zero
-            print('%s,%5.3f,0.0' % (datetime.datetime.fromtimestamp(ts).strftime('%m/%d/%y %H:%M:%S'), tb3[i3].rainRate))
-            i3 += 1
-        elif i7 < len(tb7) and tb7[i7].timestamp >= ts - 1 and tb7[i7].timestamp <= ts + 1:
-            # tb7 matches
-            # tb3 is missing because it is zero
-            print('%s,0.0,%5.3f' % (datetime.datetime.fromtimestamp(ts).strftime('%m/%d/%y %H:%M:%S'), tb7[i7].rainRate))
-            i7 += 1
-        else:
-            # both tb3 and tb7 are zero
-            print('%s,0.0,0.0' % datetime.datetime.fromtimestamp(ts).strftime('%m/%d/%y %H:%M:%S'))
-            # If ts > tb3 or tb5 timestamps, we have a problem
-            if (i3 < len(tb3) and tb3[i3].timestamp < ts) or (i7 < len(tb7) and tb7[i7].timestamp < ts):
-                print('SHOULD NOT GET HERE: Houston, we have a problem: ts:%d, tb3:%d, tb7:%d' % (ts, tb3[i3].timestamp, tb7[i7].timestamp))
-                sys.exit(1)
-        ts += 2
+    parser = argparse.ArgumentParser(description='Align timestamped rain rate csv files on a common time grid.')
+    parser.add_argument('files', nargs='+', help='timestamp,rainRate csv files (or storm recordings), each optionally followed by :<column>')
+    parser.add_argument('--cadence', type=float, default=2.0, help='Seconds between grid times (default: 2)')
+    parser.add_argument('--tolerance', type=float, default=1.0, help='Max seconds an observation may be off its grid time (default: 1)')
+    parser.add_argument('--column', type=int, default=1, help='Column holding the value (default: 1, the first after the timestamp)')
+    args = parser.parse_args()
+
+    stats = [SnapStats() for _ in args.files]
+    out = sys.stdout
+    out.write('Time,%s\n' % ','.join(os.path.basename(Combiner.file_column(f, args.column)[0]).split('.')[0] for f in args.files))
+    for ts, values in Combiner.combine(args.files, args.cadence, args.tolerance, args.column, stats):
+        out.write('%s,%s\n' % (datetime.datetime.fromtimestamp(ts).strftime('%m/%d/%y %H:%M:%S'),
+                               ','.join('0.0' if value is None else '%5.3f' % value for value in values)))
+    for f, s in zip(args.files, stats):
+        if s.off_grid or s.late:
+            sys.stderr.write('%s: dropped %d rows off the grid and %d rows behind the grid.\n' % (f, s.off_grid, s.late))
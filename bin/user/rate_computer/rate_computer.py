@@ -3,16 +3,36 @@
 #    See the file LICENSE.txt for your full rights.
 #
 """Given a file of comma separated rain observations (timestamp,rain,rainRate),
-   compute rain rates and print out, for each observation time,
-   rain amount, original rain rate, the new computed rain rate.
+   or a storm recording (see storm.py) of them, compute rain rates and print
+   out, for each observation time, rain amount, original rain rate, the new
+   computed rain rate.
+
+    The file is streamed: rows are parsed lazily, replayed through the RainRate
+    algorithm (RainRate.add_rain and RainRate.rain_rate, no packet dicts) and
+    written through a single large buffered writer, so even a year of 2s
+    observations is bound by I/O rather than per row formatting.
+
+    Output formats (--format):
+        table : time, rain, original and computed rain rates (the default)
+        csv   : timestamp,computed-rain-rate
+        jsonl : one JSON object per row (dateTime, rain, rainRate, origRainRate)
+        binary: packed little endian rows of int64 timestamp, float32 rain and
+                float32 computed rain rate (struct format '<qff'), no header
+
+    --first-row and --last-row limit the rows written (1 is the first row of
+    the file).  Earlier rows are still replayed, so rain rates are the same as
+    for a full run.
 
     To Run:
 
         PYTHONPATH=/home/weewx/bin python bin/user/rate_computer/rate_computer.py bin/user/rate_computer/2022Dec01_PaloAlto_0.68inch_storm_TB3.csv
 
-    To run and print a csv file of timestamp,new-rain-rate add the --csv flag:
+    To run and print a csv file of timestamp,new-rain-rate add the --csv flag (or --format csv):
         PYTHONPATH=/home/weewx/bin python bin/user/rate_computer/rate_computer.py bin/user/rate_computer/2022Dec01_PaloAlto_0.68inch_storm_TB3.csv --csv
 
+    To write rows 1000 through 2000 as binary to a file:
+        PYTHONPATH=/home/weewx/bin python bin/user/rate_computer/rate_computer.py bin/user/rate_computer/2022Dec01_PaloAlto_0.68inch_storm_TB3.csv --format binary --first-row 1000 --last-row 2000 --output dec01.bin
+
     Example output:
 
         Time                                 Rain  Orig. Rate Comp. Rate
@@ -82,64 +102,153 @@
         .
 """
 
+import argparse
+import json
 import logging
+import struct
 import sys
+import time
 
-from dataclasses import dataclass
-from typing import List
+from typing import BinaryIO, Callable, Dict, Iterator, List, Optional, Tuple
 
 import weeutil.logger
-from weeutil.weeutil import timestamp_to_string
 
 import user.rainrate
 
+from storm import StormRecording
+from storm import is_storm_file
+
 log = logging.getLogger(__name__)
 
 # Set up logging using the defaults.
 weeutil.logger.setup('rate_computer', {})
 
-@dataclass
-class RainEvent:
-    """A list of RainEntry is kept for the last 15 minutes."""
-    timestamp: int   # timestamp when this rain occurred
-    rain     : float # amount of rain
-    rainRate : float # rainrate reported
+# (timestamp, rain, rainRate) of an observation.
+RainEvent = Tuple[int, float, float]
+
+# Bytes buffered by the writer.
+BUFFER_SIZE = 1 << 20
+# Rows formatted before they are handed to the writer.
+CHUNK_ROWS = 4096
+
+BINARY_ROW = struct.Struct('<qff')
 
 class RateComputer():
     @staticmethod
-    def read_rain_events(rainfile: str) -> List[RainEvent]:
-        rain_events: List[RainEvent] = []
+    def read_rain_events(rainfile: str) -> Iterator[RainEvent]:
+        """Lazily yield the (timestamp, rain, rainRate) rows of rainfile (csv or a
+        storm recording)."""
+        if is_storm_file(rainfile):
+            with StormRecording(rainfile) as recording:
+                yield from recording.rows()
+            return
+        with open(rainfile, 'r') as f:
+            for line in f:
+                # 1669920114,0.0,15.16
+                cols = line.split(',')
+                yield int(cols[0]), float(cols[1]), float(cols[2])
 
-        f = open(rainfile, "r")
-        lines = f.readlines()
-        for line in lines:
-            # 1669920114,0.0,15.16
-            cols = line.split(',')
-            rain_events.append(RainEvent(
-                timestamp = int(cols[0]),
-                rain      = float(cols[1]),
-                rainRate  = float(cols[2])))
-        return rain_events
+    @staticmethod
+    def compute(rain_events: Iterator[RainEvent]) -> Iterator[Tuple[int, float, float, float]]:
+        """Replay rain_events through the RainRate algorithm, yielding
+        (timestamp, rain, original rainRate, computed rainRate)."""
+        rain_entries = user.rainrate.RainEntries()
+        add_rain = user.rainrate.RainRate.add_rain
+        rain_rate = user.rainrate.RainRate.rain_rate
+        for ts, rain, original_rain_rate in rain_events:
+            add_rain(ts, rain, rain_entries)
+            yield ts, rain, original_rain_rate, rain_rate(ts, rain_entries)
 
+    @staticmethod
+    def select_rows(rows: Iterator[Tuple[int, float, float, float]], first_row: int = 1,
+            last_row: Optional[int] = None) -> Iterator[Tuple[int, float, float, float]]:
+        """Yield rows first_row through last_row (1 based, inclusive).  Rows
+        before first_row are consumed (so they are still computed), rows after
+        last_row are never read."""
+        for row_number, row in enumerate(rows, 1):
+            if last_row is not None and row_number > last_row:
+                return
+            if row_number >= first_row:
+                yield row
+
+class TimeFormatter:
+    """timestamp_to_string, with the date, hour and minute (and time zone)
+    formatted only once per minute."""
+    def __init__(self):
+        self.minute: Optional[int] = None
+        self.prefix = ''
+        self.suffix = ''
+
+    def format(self, ts: int) -> str:
+        minute = ts - ts % 60
+        if minute != self.minute:
+            self.minute = minute
+            local = time.localtime(minute)
+            self.prefix = time.strftime('%Y-%m-%d %H:%M:', local)
+            self.suffix = time.strftime(' %Z', local)
+        return '%s%02d%s (%d)' % (self.prefix, ts - minute, self.suffix, ts)
+
+def table_writer() -> Tuple[str, Callable[[Tuple[int, float, float, float]], str]]:
+    formatter = TimeFormatter()
+    def format_row(row: Tuple[int, float, float, float]) -> str:
+        return '%s  %3.2f  %9.3f  %9.3f\n' % (formatter.format(row[0]), row[1], row[2], row[3])
+    return ('Time                                 Rain  Orig. Rate Comp. Rate\n'
+            '------------------------------------ ----- ---------- ----------\n'), format_row
+
+def csv_writer() -> Tuple[str, Callable[[Tuple[int, float, float, float]], str]]:
+    return '', lambda row: '%d,%f\n' % (row[0], row[3])
+
+def jsonl_writer() -> Tuple[str, Callable[[Tuple[int, float, float, float]], str]]:
+    dumps = json.dumps
+    return '', lambda row: dumps({ 'dateTime': row[0], 'rain': row[1], 'rainRate': row[3], 'origRainRate': row[2] }) + '\n'
+
+TEXT_FORMATS: Dict[str, Callable[[], Tuple[str, Callable[[Tuple[int, float, float, float]], str]]]] = {
+    'table': table_writer,
+    'csv'  : csv_writer,
+    'jsonl': jsonl_writer,
+}
+
+def write_rows(rows: Iterator[Tuple[int, float, float, float]], out: BinaryIO, output_format: str) -> int:
+    """Write rows to out in output_format.  Returns the number of rows written."""
+    count = 0
+    if output_format == 'binary':
+        pack = BINARY_ROW.pack
+        for row in rows:
+            out.write(pack(row[0], row[1], row[3]))
+            count += 1
+        return count
+
+    header, format_row = TEXT_FORMATS[output_format]()
+    out.write(header.encode('utf-8'))
+    chunk: List[str] = []
+    for row in rows:
+        chunk.append(format_row(row))
+        if len(chunk) >= CHUNK_ROWS:
+            out.write(''.join(chunk).encode('utf-8'))
+            count += len(chunk)
+            chunk = []
+    out.write(''.join(chunk).encode('utf-8'))
+    return count + len(chunk)
 
 if __name__ == '__main__':
-    if len(sys.argv) < 2:
-        print('Usage: %s <timestamp,rain,rateRate-csv-file> [--csv]' % sys.argv[0])
-    print_csv = False
-    if len(sys.argv) == 3:
-        if sys.argv[2] == '--csv':
-            print_csv = True
-    rain_events = RateComputer.read_rain_events(sys.argv[1])
-    rain_entries: List[user.rainrate.RainEntry] = []
-    if not print_csv:
-        print('Time                                 Rain  Orig. Rate Comp. Rate')
-        print('------------------------------------ ----- ---------- ----------')
-    for event in rain_events:
-        original_rainRate = event.rainRate
-        pkt = { 'dateTime': event.timestamp, 'rain': event.rain, 'rainRate': event.rainRate }
-        user.rainrate.RainRate.add_packet(pkt, rain_entries)
-        user.rainrate.RainRate.compute_rain_rate(pkt, rain_entries)
-        if print_csv:
-            print('%d,%f' % (pkt['dateTime'], pkt['rainRate']))
-        else:
-            print('%s  %3.2f  %9.3f  %9.3f' % (timestamp_to_string(pkt['dateTime']), pkt['rain'], original_rainRate, pkt['rainRate']))
+    parser = argparse.ArgumentParser(description='Replay rain observations (timestamp,rain,rainRate csv) through the RainRate algorithm.')
+    parser.add_argument('rainfile', help='timestamp,rain,rainRate csv file (or storm recording)')
+    parser.add_argument('--format', choices=['table', 'binary'] + sorted(set(TEXT_FORMATS) - {'table'}), default='table',
+                        help='Output format (default: table)')
+    parser.add_argument('--csv', action='store_const', dest='format', const='csv', help='Same as --format csv')
+    parser.add_argument('--first-row', type=int, default=1, help='First row to write (default: 1)')
+    parser.add_argument('--last-row', type=int, default=None, help='Last row to write (default: the last row of the file)')
+    parser.add_argument('--output', default=None, help='Write to this file rather than stdout')
+    args = parser.parse_args()
+
+    rows = RateComputer.select_rows(RateComputer.compute(RateComputer.read_rain_events(args.rainfile)),
+                                    args.first_row, args.last_row)
+    if args.output:
+        out = open(args.output, 'wb', buffering=BUFFER_SIZE)
+    else:
+        sys.stdout.flush()
+        out = open(sys.stdout.fileno(), 'wb', buffering=BUFFER_SIZE, closefd=False)
+    try:
+        write_rows(rows, out, args.format)
+    finally:
+        out.close()
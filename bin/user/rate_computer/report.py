@@ -0,0 +1,214 @@
+#    Copyright (c) 2023 John A Kline <john@johnkline.com>
+#
+#    See the file LICENSE.txt for your full rights.
+#
+"""Report, storm by storm, how well the rain rates of recordings track those
+   of a reference gauge (e.g., a TB3's original and computed rain rates against
+   a TB7), as a markdown table.
+
+   The recordings (csv files or storm recordings, each optionally followed by
+   :<column>) are aligned with Combiner.combine; the last one is the reference.
+   Storms are found in the same pass: a storm starts at the first row where any
+   recording has a rain rate and ends at the last such row followed by more than
+   --dry-gap seconds (default: 1800) without one.  Rows between storms are not
+   reported.
+
+   Reported for each storm and each recording, next to the reference:
+       rain      : rain implied by the rain rates (the sum of rate * cadence),
+                   i.e., what the rates would say fell
+       peak      : highest rain rate, and lag, the minutes from the reference's
+                   peak to the recording's (negative if the recording peaks first)
+       rmse, bias: root mean square and mean of recording - reference, over
+                   rows where either has a rain rate (as with sweep.py)
+       above     : minutes above each of --thresholds (default: 0.5,1,2 per hour)
+   and, for each recording, the same over all storms (lag excepted).
+
+   Aligned rows mostly repeat the row before (rates change only on a tip), so
+   metrics are accumulated per run of identical rows rather than per row, and
+   only the storm being accumulated is held in memory, so recordings of any
+   length can be reported on.
+
+    To Run (the original TB3 rain rates, the computed TB3 rain rates and the TB7 as a reference):
+
+        PYTHONPATH=/home/weewx/bin python bin/user/rate_computer/rate_computer.py tb3.csv --csv > tb3_computed.csv
+        python bin/user/rate_computer/report.py tb3.csv:2 tb3_computed.csv tb7.csv:2 --label 'TB3 original' --label 'TB3 computed' --label 'TB7'
+
+    Example output:
+
+        |Storm|Series|Rain|Ref. Rain|Peak|Ref. Peak|Lag (min)|RMSE|Bias|>0.5 (min)|Ref. >0.5 (min)|>1 (min)|Ref. >1 (min)|>2 (min)|Ref. >2 (min)|
+        |-----|------|----|---------|----|---------|---------|----|----|----------|---------------|--------|-------------|--------|-------------|
+        |2022-12-01 08:49 (334 min)|TB3 original|1.63|0.66|16.00|1.09|-1.6|1.681|0.188|16.0|9.6|4.7|1.2|3.8|0.0|
+        |2022-12-01 08:49 (334 min)|TB3 computed|0.61|0.66|1.12|1.09|-5.5|0.064|-0.010|9.4|9.6|0.6|1.2|0.0|0.0|
+        .
+        .
+        .
+"""
+
+import argparse
+import math
+import os
+import sys
+import time
+
+from dataclasses import dataclass, field
+from typing import Iterable, Iterator, List, Optional, Tuple
+
+from combiner import Combiner
+
+@dataclass
+class SeriesStats:
+    """The metrics of one recording over one storm (or all storms)."""
+    rain       : float = 0.0             # sum of rate * cadence, in rain units
+    peak       : float = 0.0             # highest rain rate
+    peak_time  : Optional[float] = None  # when peak was first reached
+    rows       : int = 0                 # rows compared with the reference
+    sum_diff   : float = 0.0
+    sum_squares: float = 0.0
+    above      : List[int] = field(default_factory=list) # rows above each threshold
+
+    def rmse(self) -> float:
+        return math.sqrt(self.sum_squares / self.rows) if self.rows else 0.0
+
+    def bias(self) -> float:
+        return self.sum_diff / self.rows if self.rows else 0.0
+
+    def add(self, other: 'SeriesStats') -> None:
+        """Add other's sums (peak_time is not kept)."""
+        self.rain += other.rain
+        self.peak = max(self.peak, other.peak)
+        self.rows += other.rows
+        self.sum_diff += other.sum_diff
+        self.sum_squares += other.sum_squares
+        self.above = [a + b for a, b in zip(self.above, other.above)] if self.above else list(other.above)
+
+@dataclass
+class Storm:
+    start : float              # time of the first row with a rain rate
+    end   : float              # time of the last row with a rain rate
+    series: List[SeriesStats]  # of each recording, the reference last
+
+class StormAccumulator:
+    """Accumulates runs of identical aligned rows into storms."""
+    def __init__(self, series_count: int, cadence: float, dry_gap: float, thresholds: List[float]):
+        self.series_count = series_count
+        self.cadence = cadence
+        self.dry_gap = dry_gap
+        self.thresholds = thresholds
+        self.storm: Optional[Storm] = None
+
+    def add_run(self, ts: float, values: List[float], count: int) -> Optional[Storm]:
+        """Add count rows from ts (cadence apart) of values.  Returns the
+        previous storm if this run starts a new one."""
+        if not any(values):
+            return None
+        finished: Optional[Storm] = None
+        storm = self.storm
+        if storm is not None and ts - storm.end > self.dry_gap:
+            finished, storm = storm, None
+        if storm is None:
+            storm = Storm(ts, ts, [SeriesStats(above=[0] * len(self.thresholds)) for _ in range(self.series_count)])
+            self.storm = storm
+        storm.end = ts + (count - 1) * self.cadence
+        reference = values[-1]
+        rain = count * self.cadence / 3600.0
+        for value, stats in zip(values, storm.series):
+            stats.rain += value * rain
+            if value > stats.peak:
+                stats.peak, stats.peak_time = value, ts
+            for i, threshold in enumerate(self.thresholds):
+                if value > threshold:
+                    stats.above[i] += count
+            if value != 0.0 or reference != 0.0:
+                diff = value - reference
+                stats.rows += count
+                stats.sum_diff += diff * count
+                stats.sum_squares += diff * diff * count
+        return finished
+
+    def finish(self) -> Optional[Storm]:
+        storm, self.storm = self.storm, None
+        return storm
+
+def storms(rows: Iterable[Tuple[float, List[Optional[float]]]], series_count: int, cadence: float = 2.0,
+        dry_gap: float = 1800.0, thresholds: Optional[List[float]] = None) -> Iterator[Storm]:
+    """Yield the storms of aligned rows (from Combiner.combine, the reference
+    last), in one pass."""
+    accumulator = StormAccumulator(series_count, cadence, dry_gap, thresholds or [])
+    run_ts = 0.0
+    run_values: Optional[List[Optional[float]]] = None
+    run_count = 0
+    for ts, values in rows:
+        if values == run_values:
+            run_count += 1
+            continue
+        if run_values is not None:
+            storm = accumulator.add_run(run_ts, [0.0 if v is None else v for v in run_values], run_count)
+            if storm is not None:
+                yield storm
+        run_ts, run_values, run_count = ts, values, 1
+    if run_values is not None:
+        storm = accumulator.add_run(run_ts, [0.0 if v is None else v for v in run_values], run_count)
+        if storm is not None:
+            yield storm
+    storm = accumulator.finish()
+    if storm is not None:
+        yield storm
+
+def markdown_report(storm_list: List[Storm], labels: List[str], cadence: float, thresholds: List[float]) -> str:
+    """A row per storm and recording (the reference excepted), then a row per
+    recording over all storms."""
+    header = ['Storm', 'Series', 'Rain', 'Ref. Rain', 'Peak', 'Ref. Peak', 'Lag (min)', 'RMSE', 'Bias']
+    for threshold in thresholds:
+        header += ['>%g (min)' % threshold, 'Ref. >%g (min)' % threshold]
+    lines = ['|%s|' % '|'.join(header), '|%s|' % '|'.join('-' * len(h) for h in header)]
+
+    def row(storm_label: str, label: str, stats: SeriesStats, ref: SeriesStats, lag: str) -> str:
+        cols = [storm_label, label, '%.2f' % stats.rain, '%.2f' % ref.rain, '%.2f' % stats.peak, '%.2f' % ref.peak,
+                lag, '%.3f' % stats.rmse(), '%.3f' % stats.bias()]
+        for above, ref_above in zip(stats.above, ref.above):
+            cols += ['%.1f' % (above * cadence / 60.0), '%.1f' % (ref_above * cadence / 60.0)]
+        return '|%s|' % '|'.join(cols)
+
+    totals = [SeriesStats() for _ in labels]
+    for storm in storm_list:
+        storm_label = '%s (%d min)' % (time.strftime('%Y-%m-%d %H:%M', time.localtime(storm.start)),
+                                       round((storm.end - storm.start + cadence) / 60.0))
+        ref = storm.series[-1]
+        for label, stats in zip(labels[:-1], storm.series[:-1]):
+            lag = 'n/a'
+            if stats.peak_time is not None and ref.peak_time is not None:
+                lag = '%.1f' % ((stats.peak_time - ref.peak_time) / 60.0)
+            lines.append(row(storm_label, label, stats, ref, lag))
+        for total, stats in zip(totals, storm.series):
+            total.add(stats)
+    if storm_list:
+        for label, stats in zip(labels[:-1], totals[:-1]):
+            lines.append(row('All %d storms' % len(storm_list), label, stats, totals[-1], 'n/a'))
+    return '\n'.join(lines) + '\n'
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Report, storm by storm, how well rain rates track those of a reference gauge.')
+    parser.add_argument('files', nargs='+', help='timestamp,...,rainRate csv files (or storm recordings), each optionally followed by :<column>; the last is the reference')
+    parser.add_argument('--label', action='append', default=None, help='Label of a file, in order (default: the file name)')
+    parser.add_argument('--dry-gap', type=float, default=1800.0, help='Seconds without a rain rate that end a storm (default: 1800)')
+    parser.add_argument('--thresholds', default='0.5,1,2', help='Rain rates to report the minutes above (default: 0.5,1,2)')
+    parser.add_argument('--column', type=int, default=1, help='Column holding the rain rate, for files without :<column> (default: 1, the first after the timestamp)')
+    parser.add_argument('--cadence', type=float, default=2.0, help='Seconds between grid times (default: 2)')
+    parser.add_argument('--tolerance', type=float, default=1.0, help='Max seconds an observation may be off its grid time (default: 1)')
+    parser.add_argument('--output', default=None, help='Write the report to this file (default: stdout)')
+    args = parser.parse_args()
+    if len(args.files) < 2:
+        parser.error('at least one file and a reference file are required')
+    labels = args.label or [os.path.basename(Combiner.file_column(f, args.column)[0]).split('.')[0] for f in args.files]
+    if len(labels) != len(args.files):
+        parser.error('%d labels for %d files' % (len(labels), len(args.files)))
+    thresholds = [float(t) for t in args.thresholds.split(',')] if args.thresholds else []
+
+    rows = Combiner.combine(args.files, args.cadence, args.tolerance, args.column)
+    report = markdown_report(list(storms(rows, len(args.files), args.cadence, args.dry_gap, thresholds)),
+                             labels, args.cadence, thresholds)
+    if args.output:
+        with open(args.output, 'w') as f:
+            f.write(report)
+    else:
+        sys.stdout.write(report)
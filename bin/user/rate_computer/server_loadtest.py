@@ -0,0 +1,97 @@
+#    Copyright (c) 2023 John A Kline <john@johnkline.com>
+#
+#    See the file LICENSE.txt for your full rights.
+#
+"""Load test rainrate_server.py.
+
+   --stations synthetic stations (2s loop packets, a tip in one of every
+   --tip-every packets, with a fifth of them double tips) are spread over
+   --connections connections.  Each connection pipelines --window requests
+   before reading the responses.  Packets/sec and the p50/p99 round trip time
+   of a window are reported.
+
+    To Run (with the server running):
+
+        PYTHONPATH=/home/weewx/bin python bin/user/rate_computer/server_loadtest.py --unix /run/rainrate/rainrate.sock
+
+        PYTHONPATH=/home/weewx/bin python bin/user/rate_computer/server_loadtest.py --port 8765 --stations 500 --connections 20 --packets 2000
+
+    Example output:
+
+        500 stations, 20 connections, 1000000 packets in 38.21 seconds: 26171 packets/sec
+        window round trip p50: 2.31 ms, p99: 4.87 ms, errors: 0
+"""
+
+import argparse
+import asyncio
+import json
+import random
+import time
+
+from typing import List, Tuple
+
+def station_packets(station: str, count: int, tip_every: int, seed: int) -> List[bytes]:
+    rng = random.Random(seed)
+    ts = 1669912378
+    lines: List[bytes] = []
+    for _ in range(count):
+        rain = 0.0
+        if rng.randrange(tip_every) == 0:
+            rain = 0.02 if rng.random() < 0.2 else 0.01
+        lines.append(('{"station": "%s", "dateTime": %d, "rain": %s}\n' % (station, ts, rain)).encode('utf-8'))
+        ts += 2
+    return lines
+
+async def open_connection(args):
+    if args.unix:
+        return await asyncio.open_unix_connection(args.unix)
+    return await asyncio.open_connection(args.host, args.port)
+
+async def run_connection(args, stations: List[Tuple[int, str]]) -> Tuple[int, int, List[float]]:
+    """Send the packets of (seed, station) stations (interleaved, in dateTime order
+    for each station).  Returns the packets sent, errors and window round trip times."""
+    per_station = [station_packets(station, args.packets, args.tip_every, seed) for seed, station in stations]
+    lines = [line for packets in zip(*per_station) for line in packets]
+    reader, writer = await open_connection(args)
+    errors = 0
+    rtts: List[float] = []
+    for i in range(0, len(lines), args.window):
+        window = lines[i:i + args.window]
+        start = time.perf_counter()
+        writer.write(b''.join(window))
+        await writer.drain()
+        for _ in window:
+            response = await reader.readline()
+            if b'"error"' in response:
+                errors += 1
+                if errors == 1:
+                    print('First error: %s' % json.loads(response)['error'])
+        rtts.append(time.perf_counter() - start)
+    writer.close()
+    return len(lines), errors, rtts
+
+async def run(args) -> None:
+    stations = [(i, 'station%04d' % i) for i in range(args.stations)]
+    groups = [stations[i::args.connections] for i in range(args.connections)]
+    start = time.perf_counter()
+    results = await asyncio.gather(*(run_connection(args, group) for group in groups if group))
+    elapsed = time.perf_counter() - start
+    packets = sum(r[0] for r in results)
+    errors = sum(r[1] for r in results)
+    rtts = sorted(rtt for r in results for rtt in r[2])
+    print('%d stations, %d connections, %d packets in %.2f seconds: %d packets/sec' % (
+        args.stations, args.connections, packets, elapsed, packets / elapsed))
+    print('window round trip p50: %.2f ms, p99: %.2f ms, errors: %d' % (
+        1000 * rtts[len(rtts) // 2], 1000 * rtts[min(len(rtts) - 1, int(0.99 * len(rtts)))], errors))
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Load test rainrate_server.py.')
+    parser.add_argument('--unix', default=None, help='Unix socket path of the server')
+    parser.add_argument('--host', default='127.0.0.1', help='TCP host of the server, if no --unix (default: 127.0.0.1)')
+    parser.add_argument('--port', type=int, default=8765, help='TCP port of the server, if no --unix (default: 8765)')
+    parser.add_argument('--stations', type=int, default=200, help='Number of stations (default: 200)')
+    parser.add_argument('--connections', type=int, default=10, help='Number of connections (default: 10)')
+    parser.add_argument('--packets', type=int, default=1000, help='Packets per station (default: 1000)')
+    parser.add_argument('--tip-every', type=int, default=4, help='One in this many packets has rain (default: 4)')
+    parser.add_argument('--window', type=int, default=100, help='Requests sent before reading responses (default: 100)')
+    asyncio.run(run(parser.parse_args()))
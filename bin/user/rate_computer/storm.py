@@ -0,0 +1,159 @@
+#    Copyright (c) 2023 John A Kline <john@johnkline.com>
+#
+#    See the file LICENSE.txt for your full rights.
+#
+"""A compact binary format for storm recordings (timestamp,rain,rainRate rows,
+   like the bundled csv files), and a converter from csv.
+
+   The format is columnar and fixed width, little endian:
+       header   : magic b'RRST', version (uint16), reserved (uint16), row count
+                  (int64, at least 1), i.e., struct '<4sHHq' (16 bytes)
+       dateTime : row count int64 timestamps
+       rain     : row count float32 rain amounts
+       rainRate : row count float32 rain rates
+
+   StormRecording memory maps a file and exposes the columns as memoryviews
+   (no copying, so opening a multi-gigabyte recording is instant and only the
+   pages used are read).  The columns can be handed straight to
+   RainRate.compute_rain_rates (or NumPy, via numpy.frombuffer).  float32 can't
+   hold 0.01 exactly; rows() rounds rain and rainRate to 6 places, so replaying
+   rows() gives the rain rates of replaying the csv file.  (Rain in a csv file
+   that carries float noise, e.g., 0.009999999999999998, becomes 0.01, which can
+   move a rain rate that is exactly on a rounding boundary when printed.)
+
+    To Run (writes 2022Dec01_PaloAlto_0.68inch_storm_TB3.storm, etc.):
+
+        python bin/user/rate_computer/storm.py bin/user/rate_computer/*.csv
+
+        python bin/user/rate_computer/storm.py tb3.csv --output /tmp/tb3.storm
+
+    rate_computer.py and combiner.py read .storm files wherever they read csv files.
+"""
+
+import argparse
+import mmap
+import os
+import struct
+import sys
+
+from array import array
+from typing import Iterator, List, Sequence, Tuple
+
+MAGIC = b'RRST'
+VERSION = 1
+HEADER = struct.Struct('<4sHHq')
+
+# (timestamp, rain, rainRate) of a row.
+StormRow = Tuple[int, float, float]
+
+def is_storm_file(path: str) -> bool:
+    """True if path starts with the storm recording magic."""
+    with open(path, 'rb') as f:
+        return f.read(len(MAGIC)) == MAGIC
+
+class StormRecording:
+    """A memory mapped storm recording.  Close it (or use it as a context
+    manager) when done; the columns are invalid afterwards."""
+    def __init__(self, path: str):
+        self.path = path
+        self._views: List[memoryview] = []
+        with open(path, 'rb') as f:
+            self._mmap = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+        try:
+            if len(self._mmap) < HEADER.size:
+                raise ValueError('%s: too short for a storm recording' % path)
+            magic, version, _, rows = HEADER.unpack_from(self._mmap, 0)
+            if magic != MAGIC:
+                raise ValueError('%s: not a storm recording' % path)
+            if version != VERSION:
+                raise ValueError('%s: unsupported storm recording version %d' % (path, version))
+            if rows <= 0:
+                raise ValueError('%s: no rows' % path)
+            if len(self._mmap) != HEADER.size + 16 * rows:
+                raise ValueError('%s: %d bytes, expected %d for %d rows' % (path, len(self._mmap), HEADER.size + 16 * rows, rows))
+            self.count: int = rows
+            ts_end = HEADER.size + 8 * rows
+            rain_end = ts_end + 4 * rows
+            self.timestamps = self._column(HEADER.size, ts_end, 'q')
+            self.rains = self._column(ts_end, rain_end, 'f')
+            self.rates = self._column(rain_end, len(self._mmap), 'f')
+        except Exception:
+            self.close()
+            raise
+
+    def _column(self, start: int, end: int, type_code: str) -> Sequence:
+        view = memoryview(self._mmap)[start:end]
+        if sys.byteorder == 'little':
+            column = view.cast(type_code)
+            self._views += [view, column]
+            return column
+        # A big endian machine has to copy (and swap) the column.
+        column = array(type_code, view)
+        view.release()
+        column.byteswap()
+        return column
+
+    def __len__(self) -> int:
+        return self.count
+
+    def rows(self) -> Iterator[StormRow]:
+        """Yield (timestamp, rain, rainRate), rain and rainRate rounded to 6 places."""
+        for ts, rain, rate in zip(self.timestamps, self.rains, self.rates):
+            yield ts, round(rain, 6), round(rate, 6)
+
+    def close(self) -> None:
+        # The mmap can only be closed once every view of it is released.
+        for view in reversed(self._views):
+            view.release()
+        self._views = []
+        self.timestamps = self.rains = self.rates = ()
+        self._mmap.close()
+
+    def __enter__(self) -> 'StormRecording':
+        return self
+
+    def __exit__(self, *exc) -> None:
+        self.close()
+
+def write_storm(path: str, timestamps: Sequence[int], rains: Sequence[float], rates: Sequence[float]) -> None:
+    """Write equal length, non-empty columns as a storm recording (atomically)."""
+    if not len(timestamps) == len(rains) == len(rates):
+        raise ValueError('columns differ in length (%d, %d, %d)' % (len(timestamps), len(rains), len(rates)))
+    if not timestamps:
+        raise ValueError('no rows')
+    columns = [array('q', timestamps), array('f', rains), array('f', rates)]
+    if sys.byteorder != 'little':
+        for column in columns:
+            column.byteswap()
+    tmp = '%s.tmp' % path
+    with open(tmp, 'wb') as f:
+        f.write(HEADER.pack(MAGIC, VERSION, 0, len(timestamps)))
+        for column in columns:
+            column.tofile(f)
+    os.replace(tmp, path)
+
+def csv_to_storm(csv_file: str, path: str) -> int:
+    """Convert a timestamp,rain,rainRate csv file to a storm recording.
+    Returns the number of rows."""
+    timestamps, rains, rates = array('q'), array('d'), array('d')
+    with open(csv_file, 'r') as f:
+        for line in f:
+            cols = line.split(',')
+            timestamps.append(int(cols[0]))
+            rains.append(float(cols[1]))
+            rates.append(float(cols[2]))
+    write_storm(path, timestamps, rains, rates)
+    return len(timestamps)
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Convert timestamp,rain,rainRate csv files to storm recordings.')
+    parser.add_argument('files', nargs='+', help='timestamp,rain,rainRate csv files')
+    parser.add_argument('--output', default=None, help='Output file (only with a single csv file; default: the csv file with a .storm extension)')
+    args = parser.parse_args()
+    if args.output and len(args.files) > 1:
+        parser.error('--output requires a single csv file')
+
+    for csv_file in args.files:
+        output = args.output or '%s.storm' % os.path.splitext(csv_file)[0]
+        rows = csv_to_storm(csv_file, output)
+        print('%s: %d rows, %d bytes' % (output, rows, os.path.getsize(output)))
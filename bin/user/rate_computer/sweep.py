@@ -0,0 +1,231 @@
+#    Copyright (c) 2023 John A Kline <john@johnkline.com>
+#
+#    See the file LICENSE.txt for your full rights.
+#
+"""Sweep the tuning parameters of the RainRate algorithm (merge window, expiry,
+   minimum rate and single tip threshold) and score each combination against a
+   reference gauge.
+
+   Each --pair is a test csv file (timestamp,rain,rainRate, e.g., from a TB3
+   with a siphon) and a reference csv file (e.g., from a TB7 without a siphon)
+   covering the same storm.  For each combination of parameters, the test
+   file's rain is replayed through the algorithm (RainRate.compute_rain_rates)
+   and the computed rain rates are compared with the reference rain rate in
+   effect at the same time (an as-of join: the latest reference row at or
+   before the test row, no more than --max-gap seconds before it).  Rows where
+   both rates are 0.0 are ignored.  By default, the reference rain rate is the
+   rainRate column of the reference file; with --reference computed, it is the
+   reference file's rain replayed through the algorithm with default parameters.
+
+   Files are read (and the joins computed) once per worker process; the
+   combinations are spread across a pool of --workers processes.
+
+   Reported for each combination (over all pairs):
+       rmse, mae: root mean square and mean absolute error
+       bias     : mean of computed - reference
+       peak     : largest (by magnitude) difference between the peak computed
+                  and peak reference rate of a pair
+
+    To Run:
+
+        PYTHONPATH=/home/weewx/bin python bin/user/rate_computer/sweep.py
+
+        PYTHONPATH=/home/weewx/bin python bin/user/rate_computer/sweep.py --merge-window 0,1.5,2.5,3.5 --expiry 900,1800,3600 --min-rate 0,0.035,0.05 --workers 8 --output sweep.csv
+
+    Example output:
+
+        merge_window  expiry  min_rate  single_tip_threshold    rows    rmse     mae    bias    peak
+        ------------  ------  --------  --------------------  ------  ------  ------  ------  ------
+                 2.5    1800     0.035             0.0100001   14093   0.153   0.068  -0.021  -0.233
+                 3.5    1800     0.035             0.0100001   14093   0.153   0.068  -0.021  -0.233
+        .
+        .
+        .
+"""
+
+import argparse
+import itertools
+import math
+import multiprocessing
+import os
+import sys
+
+from array import array
+from dataclasses import dataclass
+from typing import List, Optional, Tuple
+
+import user.rainrate
+
+RATE_COMPUTER_DIR = os.path.dirname(os.path.abspath(__file__))
+DEFAULT_PAIRS = [
+    (os.path.join(RATE_COMPUTER_DIR, '2022Dec01_PaloAlto_0.68inch_storm_TB3.csv'),
+     os.path.join(RATE_COMPUTER_DIR, '2022Dec01_PaloAlto_0.68inch_storm_TB7.csv')),
+    (os.path.join(RATE_COMPUTER_DIR, '2022Dec03_PaloAlto_partial_TB3.csv'),
+     os.path.join(RATE_COMPUTER_DIR, '2022Dec03_PaloAlto_partial_TB7.csv')),
+]
+
+@dataclass
+class Series:
+    """A test file's observations, joined with the reference rain rates."""
+    timestamps: array # 'q'
+    rains     : array # 'd'
+    reference : array # 'd', nan where there is no reference row
+
+@dataclass
+class Score:
+    params: user.rainrate.RainRateParams
+    rows  : int = 0
+    rmse  : float = 0.0
+    mae   : float = 0.0
+    bias  : float = 0.0
+    peak  : float = 0.0
+    error : Optional[str] = None # set if the algorithm failed with these parameters
+
+def read_csv(csv_file: str) -> Tuple[array, array, array]:
+    """Return the timestamps, rain and rainRate columns of csv_file."""
+    timestamps, rains, rates = array('q'), array('d'), array('d')
+    with open(csv_file, 'r') as f:
+        for line in f:
+            cols = line.split(',')
+            timestamps.append(int(cols[0]))
+            rains.append(float(cols[1]))
+            rates.append(float(cols[2]))
+    return timestamps, rains, rates
+
+def as_of_join(timestamps: array, ref_timestamps: array, ref_values: array, max_gap: int) -> array:
+    """For each of timestamps, the latest of ref_values at or before it (and no
+    more than max_gap seconds before it), else nan."""
+    joined = array('d', [math.nan]) * len(timestamps)
+    j = -1
+    for i, ts in enumerate(timestamps):
+        while j + 1 < len(ref_timestamps) and ref_timestamps[j + 1] <= ts:
+            j += 1
+        if j >= 0 and ts - ref_timestamps[j] <= max_gap:
+            joined[i] = ref_values[j]
+    return joined
+
+def load_series(pairs: List[Tuple[str, str]], max_gap: int, reference: str) -> List[Series]:
+    series: List[Series] = []
+    for test_file, reference_file in pairs:
+        timestamps, rains, _ = read_csv(test_file)
+        ref_timestamps, ref_rains, ref_rates = read_csv(reference_file)
+        if reference == 'computed':
+            ref_rates = user.rainrate.RainRate.compute_rain_rates(ref_timestamps, ref_rains)
+        series.append(Series(timestamps, rains, as_of_join(timestamps, ref_timestamps, ref_rates, max_gap)))
+    return series
+
+def score(params: user.rainrate.RainRateParams, series: List[Series]) -> Score:
+    result = Score(params)
+    sum_squares = 0.0
+    sum_abs = 0.0
+    sum_diff = 0.0
+    try:
+        for s in series:
+            rates = user.rainrate.RainRate.compute_rain_rates(s.timestamps, s.rains, params=params)
+            peak_rate = 0.0
+            peak_reference = 0.0
+            for rate, reference in zip(rates, s.reference):
+                if math.isnan(reference) or (rate == 0.0 and reference == 0.0):
+                    continue
+                diff = rate - reference
+                result.rows += 1
+                sum_squares += diff * diff
+                sum_abs += abs(diff)
+                sum_diff += diff
+                peak_rate = max(peak_rate, rate)
+                peak_reference = max(peak_reference, reference)
+            if abs(peak_rate - peak_reference) > abs(result.peak):
+                result.peak = peak_rate - peak_reference
+    except Exception as e:
+        result.error = '%s: %s' % (type(e).__name__, e)
+        return result
+    if result.rows:
+        result.rmse = math.sqrt(sum_squares / result.rows)
+        result.mae = sum_abs / result.rows
+        result.bias = sum_diff / result.rows
+    return result
+
+# The series of a pool worker.
+_worker_series: List[Series] = []
+
+def _init_worker(pairs: List[Tuple[str, str]], max_gap: int, reference: str) -> None:
+    global _worker_series
+    _worker_series = load_series(pairs, max_gap, reference)
+
+def _score_in_worker(params: user.rainrate.RainRateParams) -> Score:
+    return score(params, _worker_series)
+
+def parameter_grid(tip_size: float, merge_windows: List[float], expiries: List[int], min_rates: List[float],
+        single_tip_thresholds: List[Optional[float]]) -> List[user.rainrate.RainRateParams]:
+    """Every combination of the parameters.  A single tip threshold of None is
+    just above tip_size."""
+    return [user.rainrate.RainRateParams(
+                tip_size             = tip_size,
+                merge_window         = merge_window,
+                single_tip_threshold = tip_size + 0.0000001 if threshold is None else threshold,
+                expiry               = expiry,
+                min_rate             = min_rate)
+            for merge_window, expiry, min_rate, threshold in itertools.product(
+                merge_windows, expiries, min_rates, single_tip_thresholds)]
+
+def sweep(pairs: List[Tuple[str, str]], grid: List[user.rainrate.RainRateParams], workers: int = 1,
+        max_gap: int = 10, reference: str = 'file') -> List[Score]:
+    """Score each of grid, returning the scores best (lowest rmse) first.  Failed
+    combinations are last."""
+    if workers > 1:
+        with multiprocessing.Pool(workers, initializer=_init_worker, initargs=(pairs, max_gap, reference)) as pool:
+            scores = pool.map(_score_in_worker, grid, chunksize=max(1, len(grid) // (workers * 4)))
+    else:
+        series = load_series(pairs, max_gap, reference)
+        scores = [score(params, series) for params in grid]
+    return sorted(scores, key=lambda s: (s.error is not None, s.rmse))
+
+def floats(value: str) -> List[float]:
+    return [float(v) for v in value.split(',')]
+
+def ints(value: str) -> List[int]:
+    return [int(v) for v in value.split(',')]
+
+def print_scores(scores: List[Score], out=sys.stdout) -> None:
+    out.write('merge_window  expiry  min_rate  single_tip_threshold    rows    rmse     mae    bias    peak\n')
+    out.write('------------  ------  --------  --------------------  ------  ------  ------  ------  ------\n')
+    for s in scores:
+        p = s.params
+        if s.error:
+            out.write('%12g  %6d  %8g  %20g  %s\n' % (p.merge_window, p.expiry, p.min_rate, p.single_tip_threshold, s.error))
+        else:
+            out.write('%12g  %6d  %8g  %20g  %6d  %6.3f  %6.3f  %6.3f  %6.3f\n' % (
+                p.merge_window, p.expiry, p.min_rate, p.single_tip_threshold, s.rows, s.rmse, s.mae, s.bias, s.peak))
+
+def write_csv(scores: List[Score], csv_file: str) -> None:
+    with open(csv_file, 'w') as f:
+        f.write('tip_size,merge_window,expiry,min_rate,single_tip_threshold,rows,rmse,mae,bias,peak,error\n')
+        for s in scores:
+            p = s.params
+            f.write('%g,%g,%d,%g,%g,%d,%f,%f,%f,%f,%s\n' % (p.tip_size, p.merge_window, p.expiry, p.min_rate,
+                p.single_tip_threshold, s.rows, s.rmse, s.mae, s.bias, s.peak, s.error or ''))
+
+if __name__ == '__main__':
+    defaults = user.rainrate.DEFAULT_PARAMS
+    parser = argparse.ArgumentParser(description='Sweep RainRate parameters, scoring them against a reference gauge.')
+    parser.add_argument('--pair', nargs=2, action='append', metavar=('TEST_CSV', 'REFERENCE_CSV'),
+                        help='Test and reference csv files (default: the bundled Dec 1 and Dec 3 TB3/TB7 storms)')
+    parser.add_argument('--tip-size', type=float, default=defaults.tip_size, help='Tip size (default: %(default)s)')
+    parser.add_argument('--merge-window', type=floats, default=[0.0, 1.5, 2.5, 3.5], help='Comma separated merge windows')
+    parser.add_argument('--expiry', type=ints, default=[900, 1800, 2700], help='Comma separated expiries')
+    parser.add_argument('--min-rate', type=floats, default=[0.0, 0.035, 0.05], help='Comma separated minimum rates')
+    parser.add_argument('--single-tip-threshold', type=floats, default=[None],
+                        help='Comma separated single tip thresholds (default: just above the tip size)')
+    parser.add_argument('--reference', choices=['file', 'computed'], default='file',
+                        help="Reference rain rate: the reference file's rainRate or computed from its rain (default: file)")
+    parser.add_argument('--max-gap', type=int, default=10, help='Max seconds a reference row may precede a test row (default: 10)')
+    parser.add_argument('--workers', type=int, default=os.cpu_count() or 1, help='Worker processes (default: number of CPUs)')
+    parser.add_argument('--top', type=int, default=None, help='Only print the best this many combinations')
+    parser.add_argument('--output', default=None, help='Also write all scores to this csv file')
+    args = parser.parse_args()
+
+    grid = parameter_grid(args.tip_size, args.merge_window, args.expiry, args.min_rate, args.single_tip_threshold)
+    scores = sweep(args.pair or DEFAULT_PAIRS, grid, args.workers, args.max_gap, args.reference)
+    print_scores(scores[:args.top] if args.top else scores)
+    if args.output:
+        write_csv(scores, args.output)
@@ -0,0 +1,325 @@
+#    Copyright (c) 2023 John A Kline <john@johnkline.com>
+#
+#    See the file LICENSE.txt for your full rights.
+#
+"""Differential fuzzing of the RainRate algorithm.
+
+Randomized streams (a few warm start archive records, then loop packets with
+bursts of tips, multi-tip packets, duplicate timestamps, long gaps, missing
+and tiny rain) are run through the frozen reference implementation
+(rainrate_reference.py) and through each engine in user.rainrate:
+
+    per_packet        : RainRate.add_packet and RainRate.compute_rain_rate
+    service           : the RainRate service's new_loop (with its idle fast path)
+    add_packets       : RainRate.add_packets (batch)
+    compute_rain_rates: RainRate.compute_rain_rates (arrays)
+
+Each packet's rain rate (and, for the per packet engines, the rain entries
+after it) must match the reference exactly; a stream that raises must raise
+the same exception type at the same packet in both.  A failing stream is
+shrunk (removing records and packets, simplifying rain amounts) to a minimal
+stream that still fails.
+
+    To Run:
+
+        PYTHONPATH=/home/weewx/bin python bin/user/tests/rainrate_fuzz.py
+
+        PYTHONPATH=/home/weewx/bin python bin/user/tests/rainrate_fuzz.py --streams 200000 --seed 7 --engine add_packets
+
+    Example output:
+
+        per_packet        : 10000 streams (312140 packets) in 2.61 seconds, 3831 streams/sec, no differences
+        service           : 10000 streams (312140 packets) in 3.90 seconds, 2564 streams/sec, no differences
+        .
+        .
+        .
+"""
+
+import argparse
+import logging
+import random
+import sys
+import time
+
+from dataclasses import dataclass
+from typing import Any, Callable, Dict, List, Optional, Tuple
+
+import weewx
+
+import user.rainrate
+import rainrate_reference
+
+from user.rainrate import DEFAULT_PARAMS
+from user.rainrate import RainRateParams
+
+ARCHIVE_INTERVAL = 300
+
+# (dateTime, rain) of warm start archive records (with rain) and of loop packets.
+Records = List[Tuple[int, float]]
+Packets = List[Tuple[int, Optional[float]]]
+
+@dataclass
+class Stream:
+    records: Records
+    packets: Packets
+
+# (timestamp, amount, expiration, dont_merge) of each entry, newest first.
+State = Tuple[Tuple[int, float, int, bool], ...]
+
+@dataclass
+class Outcome:
+    """What an engine did with a stream."""
+    rates : List[float]           # rain rate of each packet (up to the error, if any)
+    states: Optional[List[State]] # rain entries after each packet, if the engine exposes them
+    error : Optional[str]         # type of the exception raised (by packet len(rates)), if any
+    final : State                 # rain entries at the end (or when the exception was raised)
+
+@dataclass
+class Difference:
+    stream     : Stream
+    index      : int # packet at which the engine differs
+    reference  : str
+    engine     : str
+
+    def __str__(self) -> str:
+        return ('records: %r\npackets: %r\nat packet %d, reference: %s, engine: %s' % (
+            self.stream.records, self.stream.packets, self.index, self.reference, self.engine))
+
+def state_of(entries) -> State:
+    return tuple((e.timestamp, e.amount, e.expiration, e.dont_merge) for e in entries)
+
+def random_stream(rng: random.Random, max_packets: int = 60) -> Stream:
+    ts = 1669912378 + rng.randrange(ARCHIVE_INTERVAL)
+    records: Records = []
+    if rng.random() < 0.3:
+        end = ts // ARCHIVE_INTERVAL * ARCHIVE_INTERVAL
+        for i in range(rng.randint(1, 4), 0, -1):
+            if rng.random() < 0.7:
+                records.append((end - (i - 1) * ARCHIVE_INTERVAL, rng.choice([0.01, 0.01, 0.02, 0.05, 0.13, 0.003])))
+    packets: Packets = []
+    count = rng.randint(1, max_packets)
+    while len(packets) < count:
+        kind = rng.choice(['dry', 'burst', 'burst', 'multi', 'duplicate', 'gap', 'none', 'tiny'])
+        for _ in range(rng.randint(1, 8)):
+            rain: Optional[float] = 0.0
+            gap = 2
+            if kind == 'burst':
+                gap = rng.randint(1, 3)
+                rain = 0.01 if rng.random() < 0.7 else 0.0
+            elif kind == 'multi':
+                gap = rng.randint(1, 30)
+                rain = rng.choice([0.02, 0.02, 0.03, 0.04, 0.05, 0.11])
+            elif kind == 'duplicate':
+                gap = 0
+                rain = rng.choice([0.0, 0.01])
+            elif kind == 'gap':
+                gap = rng.choice([600, 1799, 1800, 1801, 3600])
+                rain = rng.choice([0.0, 0.01])
+            elif kind == 'none':
+                rain = None
+            elif kind == 'tiny':
+                gap = rng.randint(1, 60)
+                rain = rng.choice([0.001, 0.00787, 0.0100001, 0.005])
+            ts += gap
+            packets.append((ts, rain))
+    return Stream(records, packets[:count])
+
+def run_reference(stream: Stream, params: RainRateParams = DEFAULT_PARAMS) -> Outcome:
+    entries: List[rainrate_reference.ReferenceEntry] = []
+    for ts, rain in stream.records:
+        rainrate_reference.archive_records_to_rain_entries({ 'dateTime': ts, 'rain': rain }, ARCHIVE_INTERVAL, entries, params)
+    rates: List[float] = []
+    states: List[State] = []
+    try:
+        for ts, rain in stream.packets:
+            pkt = { 'dateTime': ts, 'rain': rain }
+            rainrate_reference.add_packet(pkt, entries, params=params)
+            rainrate_reference.compute_rain_rate(pkt, entries, params)
+            rates.append(pkt['rainRate'])
+            states.append(state_of(entries))
+    except Exception as e:
+        return Outcome(rates, states, type(e).__name__, state_of(entries))
+    return Outcome(rates, states, None, state_of(entries))
+
+def warm_start(stream: Stream, params: RainRateParams) -> user.rainrate.RainEntries:
+    rain_entries = user.rainrate.RainEntries()
+    for ts, rain in stream.records:
+        user.rainrate.RainRate.archive_records_to_rain_entries({ 'dateTime': ts, 'rain': rain }, ARCHIVE_INTERVAL, rain_entries, params)
+    return rain_entries
+
+def run_per_packet(stream: Stream, params: RainRateParams = DEFAULT_PARAMS) -> Outcome:
+    rain_entries = warm_start(stream, params)
+    rates: List[float] = []
+    states: List[State] = []
+    try:
+        for ts, rain in stream.packets:
+            pkt = { 'dateTime': ts, 'rain': rain }
+            user.rainrate.RainRate.add_packet(pkt, rain_entries, params=params)
+            user.rainrate.RainRate.compute_rain_rate(pkt, rain_entries, params)
+            rates.append(pkt['rainRate'])
+            states.append(state_of(rain_entries))
+    except Exception as e:
+        return Outcome(rates, states, type(e).__name__, state_of(rain_entries))
+    return Outcome(rates, states, None, state_of(rain_entries))
+
+class FuzzEngine:
+    """Just enough of an engine for a RainRate service to bind to."""
+    def bind(self, event_type, callback):
+        pass
+
+# A service for each set of params (creating one per stream would dominate the run time).
+_services: Dict[RainRateParams, user.rainrate.RainRate] = {}
+
+def run_service(stream: Stream, params: RainRateParams = DEFAULT_PARAMS) -> Outcome:
+    service = _services.get(params)
+    if service is None:
+        config_dict = {
+            'RainRate'  : { 'enable': 'true', 'gauges': { 'rain': {
+                'tip_size': repr(params.tip_size), 'merge_window': repr(params.merge_window),
+                'single_tip_threshold': repr(params.single_tip_threshold), 'expiry': str(params.expiry),
+                'min_rate': repr(params.min_rate) } } },
+            'StdArchive': { 'archive_interval': str(ARCHIVE_INTERVAL) },
+        }
+        service = user.rainrate.RainRate(FuzzEngine(), config_dict)
+        _services[params] = service
+    gauge = service.gauges[0]
+    gauge.rain_entries = warm_start(stream, gauge.params)
+    gauge.archive_rain_rates = user.rainrate.ArchiveRainRates(ARCHIVE_INTERVAL, gauge.archive_rain_rates.method)
+    rates: List[float] = []
+    states: List[State] = []
+    try:
+        for ts, rain in stream.packets:
+            pkt = { 'dateTime': ts, 'usUnits': weewx.US, 'rain': rain }
+            service.new_loop(weewx.Event(weewx.NEW_LOOP_PACKET, packet=pkt))
+            rates.append(pkt['rainRate'])
+            states.append(state_of(gauge.rain_entries))
+    except Exception as e:
+        return Outcome(rates, states, type(e).__name__, state_of(gauge.rain_entries))
+    return Outcome(rates, states, None, state_of(gauge.rain_entries))
+
+def run_add_packets(stream: Stream, params: RainRateParams = DEFAULT_PARAMS) -> Outcome:
+    rain_entries = warm_start(stream, params)
+    pkts = [{ 'dateTime': ts, 'rain': rain } for ts, rain in stream.packets]
+    error: Optional[str] = None
+    try:
+        user.rainrate.RainRate.add_packets(pkts, rain_entries, params)
+    except Exception as e:
+        error = type(e).__name__
+    rates = [pkt['rainRate'] for pkt in pkts if 'rainRate' in pkt]
+    return Outcome(rates, None, error, state_of(rain_entries))
+
+def run_compute_rain_rates(stream: Stream, params: RainRateParams = DEFAULT_PARAMS) -> Outcome:
+    rain_entries = warm_start(stream, params)
+    try:
+        rates = user.rainrate.RainRate.compute_rain_rates(
+            [ts for ts, _ in stream.packets], [rain for _, rain in stream.packets], rain_entries, params)
+    except Exception as e:
+        # The rates before the error are not returned.
+        return Outcome([], None, type(e).__name__, state_of(rain_entries))
+    return Outcome(list(rates), None, None, state_of(rain_entries))
+
+Engine = Callable[[Stream, RainRateParams], Outcome]
+
+ENGINES: Dict[str, Engine] = {
+    'per_packet'        : run_per_packet,
+    'service'           : run_service,
+    'add_packets'       : run_add_packets,
+    'compute_rain_rates': run_compute_rain_rates,
+}
+
+def compare(stream: Stream, engine: Engine, params: RainRateParams = DEFAULT_PARAMS) -> Optional[Difference]:
+    """The first difference between engine and the reference for stream, if any."""
+    expected = run_reference(stream, params)
+    actual = engine(stream, params)
+    for i, rate in enumerate(actual.rates):
+        if i >= len(expected.rates) or rate != expected.rates[i]:
+            return Difference(stream, i, 'rainRate %r' % (expected.rates[i] if i < len(expected.rates) else expected.error), 'rainRate %r' % rate)
+        if actual.states is not None and actual.states[i] != expected.states[i]:
+            return Difference(stream, i, 'entries %r' % (expected.states[i],), 'entries %r' % (actual.states[i],))
+    if actual.error != expected.error:
+        return Difference(stream, len(actual.rates), 'error %s' % expected.error, 'error %s' % actual.error)
+    if actual.error is None and len(actual.rates) != len(expected.rates):
+        return Difference(stream, len(actual.rates), '%d rates' % len(expected.rates), '%d rates' % len(actual.rates))
+    if actual.final != expected.final:
+        return Difference(stream, len(actual.rates), 'entries %r' % (expected.final,), 'entries %r' % (actual.final,))
+    return None
+
+def shrink(stream: Stream, engine: Engine, params: RainRateParams = DEFAULT_PARAMS) -> Stream:
+    """A minimal stream derived from stream (which must fail) that still fails:
+    no record or packet can be removed, nor a rain amount simplified, without
+    the failure going away."""
+    def fails(candidate: Stream) -> bool:
+        return compare(candidate, engine, params) is not None
+
+    def remove_chunks(items: List[Any], make: Callable[[List[Any]], Stream]) -> List[Any]:
+        chunk = max(1, len(items) // 2)
+        while chunk >= 1:
+            i = 0
+            while i < len(items):
+                candidate = items[:i] + items[i + chunk:]
+                if fails(make(candidate)):
+                    items = candidate
+                else:
+                    i += chunk
+            chunk //= 2
+        return items
+
+    changed = True
+    while changed:
+        before = (list(stream.records), list(stream.packets))
+        stream = Stream(remove_chunks(stream.records, lambda r: Stream(r, stream.packets)), stream.packets)
+        stream = Stream(stream.records, remove_chunks(stream.packets, lambda p: Stream(stream.records, p)))
+        for i, (ts, rain) in enumerate(stream.packets):
+            for simpler in [0.0, 0.01]:
+                if rain != simpler and (rain is None or simpler < rain):
+                    packets = stream.packets[:i] + [(ts, simpler)] + stream.packets[i + 1:]
+                    if fails(Stream(stream.records, packets)):
+                        stream = Stream(stream.records, packets)
+                        break
+        changed = before != (stream.records, stream.packets)
+    return stream
+
+@dataclass
+class FuzzResult:
+    streams   : int = 0
+    packets   : int = 0
+    seconds   : float = 0.0
+    difference: Optional[Difference] = None # the first difference found, shrunk
+
+def fuzz(engine: Engine, streams: int, seed: int = 0, params: RainRateParams = DEFAULT_PARAMS,
+        max_packets: int = 60) -> FuzzResult:
+    """Compare engine with the reference for streams random streams, stopping
+    at the first difference."""
+    rng = random.Random(seed)
+    result = FuzzResult()
+    start = time.perf_counter()
+    for _ in range(streams):
+        stream = random_stream(rng, max_packets)
+        result.streams += 1
+        result.packets += len(stream.packets)
+        if compare(stream, engine, params) is not None:
+            result.difference = compare(shrink(stream, engine, params), engine, params)
+            break
+    result.seconds = time.perf_counter() - start
+    return result
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Compare the RainRate engines with the reference implementation.')
+    parser.add_argument('--engine', action='append', choices=sorted(ENGINES), help='Engine to fuzz (default: all)')
+    parser.add_argument('--streams', type=int, default=10000, help='Streams per engine (default: 10000)')
+    parser.add_argument('--seed', type=int, default=0, help='Random seed (default: 0)')
+    parser.add_argument('--max-packets', type=int, default=60, help='Max packets in a stream (default: 60)')
+    args = parser.parse_args()
+
+    # The algorithm logs each multi-tip and merge at debug.
+    logging.disable(logging.INFO)
+    failed = False
+    for name in args.engine or list(ENGINES):
+        result = fuzz(ENGINES[name], args.streams, args.seed, max_packets=args.max_packets)
+        print('%-18s: %d streams (%d packets) in %.2f seconds, %d streams/sec, %s' % (
+            name, result.streams, result.packets, result.seconds, result.streams / result.seconds,
+            'DIFFERENCE' if result.difference else 'no differences'))
+        if result.difference:
+            print(result.difference)
+            failed = True
+    sys.exit(1 if failed else 0)
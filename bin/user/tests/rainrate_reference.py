@@ -0,0 +1,86 @@
+#    Copyright (c) 2023 John A Kline <john@johnkline.com>
+#
+#    See the file LICENSE.txt for your full rights.
+#
+"""A frozen reference implementation of the RainRate per-packet algorithm.
+
+This is the algorithm as originally written (a plain list of entries, newest
+first, with insert(0), and a recursive merge), parameterized with
+RainRateParams.  It is deliberately slow and simple.  Do not optimize it; it is
+what rainrate_fuzz.py checks the optimized code in user.rainrate against.
+"""
+
+from dataclasses import dataclass
+from typing import Any, Dict, List
+
+from weeutil.weeutil import to_int
+
+from user.rainrate import DEFAULT_PARAMS
+from user.rainrate import RainRateParams
+
+@dataclass
+class ReferenceEntry:
+    timestamp : int
+    amount    : float
+    expiration: int
+    dont_merge: bool
+
+def add_packet(pkt: Dict[str, Any], rain_entries: List[ReferenceEntry], dont_merge: bool = False,
+        params: RainRateParams = DEFAULT_PARAMS) -> None:
+    """If the pkt contains rain, add entries for it to the front of rain_entries,
+    merge double tips and delete expired entries."""
+    pkt_time: int = to_int(pkt['dateTime'])
+    if 'rain' in pkt and pkt['rain'] is not None and pkt['rain'] > 0.0:
+        pkt_rain = pkt['rain']
+        if len(rain_entries) == 0:
+            # The first tip is recorded as a single tip.
+            rain_entries.insert(0, ReferenceEntry(pkt_time, params.tip_size, pkt_time + params.expiry, dont_merge))
+        elif pkt_rain < params.single_tip_threshold:
+            rain_entries.insert(0, ReferenceEntry(pkt_time, pkt_rain, pkt_time + params.expiry, dont_merge))
+        else:
+            # Spread the rain over equally (between last tip and now).
+            number_of_tips: int = round(pkt_rain / params.tip_size)
+            interval: int = round((pkt_time - rain_entries[0].timestamp) / number_of_tips)
+            time_of_rain: int = pkt_time - (interval * (number_of_tips - 1))
+            for _ in range(number_of_tips):
+                rain_entries.insert(0, ReferenceEntry(time_of_rain, pkt_rain / number_of_tips, time_of_rain + params.expiry, dont_merge))
+                time_of_rain += interval
+    if (len(rain_entries) > 1 and not dont_merge and not rain_entries[1].dont_merge
+            and rain_entries[0].timestamp - rain_entries[1].timestamp < params.merge_window):
+        combined_pkt: Dict[str, Any] = { 'dateTime': pkt_time, 'rain': rain_entries[0].amount + rain_entries[1].amount }
+        del rain_entries[0]
+        del rain_entries[0]
+        add_packet(combined_pkt, rain_entries, dont_merge=True, params=params)
+    while len(rain_entries) > 0 and rain_entries[-1].expiration <= pkt_time:
+        del rain_entries[-1]
+
+def compute_rain_rate(pkt: Dict[str, Any], rain_entries: List[ReferenceEntry], params: RainRateParams = DEFAULT_PARAMS) -> None:
+    """Add/update rainRate in pkt."""
+    if len(rain_entries) < 2:
+        pkt['rainRate'] = 0.0
+    else:
+        rain_rate1 = 3600 * rain_entries[0].amount / (rain_entries[0].timestamp - rain_entries[1].timestamp)
+        rain_rate2 = 10000.0
+        if pkt['dateTime'] != rain_entries[0].timestamp:
+            rain_rate2 = 3600 * params.tip_size / (pkt['dateTime'] - rain_entries[0].timestamp)
+        pkt['rainRate'] = min(rain_rate1, rain_rate2)
+        if pkt['rainRate'] < params.min_rate:
+            pkt['rainRate'] = 0.0
+
+def archive_records_to_rain_entries(rec: Dict[str, Any], archive_interval: int, rain_entries: List[ReferenceEntry],
+        params: RainRateParams = DEFAULT_PARAMS) -> None:
+    """Add the rain in an archive record (records in ascending dateTime order)
+    to the front of rain_entries."""
+    archive_time = rec['dateTime']
+    archive_amt = rec['rain']
+    if archive_amt < params.single_tip_threshold:
+        # A single tip midway through the archive period.
+        rec_time = round(archive_time - (archive_interval / 2.0))
+        rain_entries.insert(0, ReferenceEntry(rec_time, archive_amt, rec_time + params.expiry, True))
+    else:
+        # Evenly spaced tips, the last one an interval before archive_time.
+        number_of_tips: int = round(archive_amt / params.tip_size)
+        interval: int = round(archive_interval / number_of_tips)
+        for i in range(number_of_tips, 0, -1):
+            time_of_rain = archive_time - interval * i
+            rain_entries.insert(0, ReferenceEntry(time_of_rain, archive_amt / number_of_tips, time_of_rain + params.expiry, True))
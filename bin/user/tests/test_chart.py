@@ -0,0 +1,99 @@
+#    Copyright (c) 2023 John A Kline <john@johnkline.com>
+#
+#    See the file LICENSE.txt for your full rights.
+#
+"""Test downsampling and drawing charts of recordings."""
+
+import logging
+import os
+import random
+import sys
+import unittest
+import xml.dom.minidom
+
+import weeutil.logger
+
+# The rate_computer tools import each other as siblings.
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.dirname(os.path.abspath(__file__))), 'rate_computer'))
+
+import chart
+
+log = logging.getLogger(__name__)
+
+# Set up logging using the defaults.
+weeutil.logger.setup('test_config', {})
+
+def random_points(seed, count):
+    """Ascending timestamps (mostly 2s apart, with gaps) and rates with long
+    runs and ties."""
+    rng = random.Random(seed)
+    points = []
+    ts = 1669912378
+    rate = 0.0
+    for _ in range(count):
+        ts += 2 if rng.random() < 0.95 else rng.randrange(3, 600)
+        if rng.random() < 0.1:
+            rate = rng.choice([0.0, 0.0, 0.18, 0.5, 1.06, 15.16])
+        points.append((ts, rate))
+    return points
+
+class ChartTests(unittest.TestCase):
+    def test_minmax(self):
+        for seed in range(5):
+            points = random_points(seed, 5000)
+            start = points[0][0] - seed
+            buckets = chart.MinMaxBuckets(start, 100)
+            buckets.add_all(points)
+            self.assertEqual(buckets.count, len(points))
+            self.assertLessEqual(len(buckets.buckets), 101)
+
+            # Brute force: the (first) min and max of each bucket, at the final width.
+            expected = {}
+            for ts, rate in points:
+                index = int((ts - start) // buckets.width)
+                if index not in expected:
+                    expected[index] = [ts, rate, ts, rate]
+                else:
+                    e = expected[index]
+                    if rate < e[1]:
+                        e[0], e[1] = ts, rate
+                    if rate > e[3]:
+                        e[2], e[3] = ts, rate
+            self.assertEqual([(index, *e) for index, e in sorted(expected.items())], buckets.buckets)
+
+            # Points are in time order, and hold the extremes.
+            drawn = buckets.points()
+            self.assertEqual([ts for ts, _ in drawn], sorted(ts for ts, _ in drawn))
+            self.assertTrue(set(drawn) <= set(points))
+            self.assertEqual(max(rate for _, rate in drawn), max(rate for _, rate in points))
+            self.assertEqual(min(rate for _, rate in drawn), min(rate for _, rate in points))
+
+    def test_lttb(self):
+        points = random_points(1, 5000)
+        xs = [ts for ts, _ in points]
+        ys = [rate for _, rate in points]
+        for threshold in [3, 100, 999]:
+            sampled = chart.lttb(xs, ys, threshold)
+            self.assertEqual(len(sampled), threshold)
+            self.assertEqual(sampled[0], points[0])
+            self.assertEqual(sampled[-1], points[-1])
+            self.assertEqual([ts for ts, _ in sampled], sorted(set(ts for ts, _ in sampled)))
+            self.assertTrue(set(sampled) <= set(points))
+        # Fewer points than the threshold are kept as is.
+        self.assertEqual(chart.lttb(xs[:10], ys[:10], 100), points[:10])
+
+    def test_svg(self):
+        series = [('TB3 <original>', [(1669912378, 0.0), (1669912380, 15.16), (1669912382, 0.18)]),
+                  ('TB7', [(1669912378, 0.0), (1669912382, 0.5)])]
+        svg = chart.render_svg(series, 400, 200, 'Dec 1 & 2')
+        doc = xml.dom.minidom.parseString(svg)
+        self.assertEqual(doc.documentElement.getAttribute('width'), '400')
+        polylines = doc.getElementsByTagName('polyline')
+        self.assertEqual([len(p.getAttribute('points').split()) for p in polylines], [3, 2])
+        texts = [t.firstChild.data for t in doc.getElementsByTagName('text')]
+        self.assertIn('Dec 1 & 2', texts)
+        self.assertIn('TB3 <original>', texts)
+        self.assertIn('20', texts)
+
+if __name__ == '__main__':
+    unittest.main()
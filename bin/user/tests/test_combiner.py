@@ -0,0 +1,103 @@
+#    Copyright (c) 2023 John A Kline <john@johnkline.com>
+#
+#    See the file LICENSE.txt for your full rights.
+#
+"""Test aligning recordings on a time grid."""
+
+import logging
+import os
+import shutil
+import sys
+import tempfile
+import unittest
+
+import weeutil.logger
+
+# The rate_computer tools import each other as siblings.
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.dirname(os.path.abspath(__file__))), 'rate_computer'))
+
+from combiner import Combiner
+from combiner import RainEvent
+from combiner import SnapStats
+
+log = logging.getLogger(__name__)
+
+# Set up logging using the defaults.
+weeutil.logger.setup('test_config', {})
+
+def events(*rows):
+    """RainEvents of (timestamp, rainRate) rows."""
+    return [RainEvent(timestamp = ts, rainRate = rate) for ts, rate in rows]
+
+class CombinerTests(unittest.TestCase):
+    def setUp(self):
+        self.tmpdir = tempfile.mkdtemp()
+
+    def tearDown(self):
+        shutil.rmtree(self.tmpdir)
+
+    def write_csv(self, name, lines):
+        path = os.path.join(self.tmpdir, name)
+        with open(path, 'w') as f:
+            f.write(''.join('%s\n' % line for line in lines))
+        return path
+
+    def test_read_rain_events(self):
+        path = self.write_csv('tb3.csv', ['1669912378,0.01,15.16', '1669912380,0.00,0.18'])
+        self.assertEqual(list(Combiner.read_rain_events(path)), events((1669912378.0, 0.01), (1669912380.0, 0.0)))
+        self.assertEqual(list(Combiner.read_rain_events(path, 2)), events((1669912378.0, 15.16), (1669912380.0, 0.18)))
+
+    def test_dedupe(self):
+        deduped = Combiner.dedupe(events((0, 0.1), (0, 0.2), (2, 0.3), (4, 0.4), (4, 0.5), (4, 0.6), (6, 0.7)))
+        self.assertEqual(list(deduped), events((0, 0.1), (2, 0.3), (4, 0.4), (6, 0.7)))
+
+    def test_drop_jitter(self):
+        # 1 and 7 are squeezed in between rows 2s apart; 4 and 6 are not.
+        kept = Combiner.drop_jitter(events((0, 0.1), (1, 0.2), (2, 0.3), (4, 0.4), (6, 0.5), (7, 0.6), (8, 0.7), (10, 0.8)), 2.0)
+        self.assertEqual([event.timestamp for event in kept], [0, 2, 4, 6, 8, 10])
+        self.assertEqual(list(Combiner.drop_jitter([], 2.0)), [])
+        self.assertEqual(list(Combiner.drop_jitter(events((0, 0.1)), 2.0)), events((0, 0.1)))
+
+    def test_snap(self):
+        stats = SnapStats()
+        snapped = Combiner.snap(events((0, 0.1), (3, 0.2), (4.9, 0.3), (5, 0.4), (9.5, 0.5), (15.5, 0.6), (15.9, 0.7)),
+                                0.0, 2.0, 1.0, stats)
+        # 3 is between slots 1 and 2 and goes to 1; 5 is between 2 and 3, but 2 is taken.
+        self.assertEqual(list(snapped), [(0, 0.1), (1, 0.2), (2, 0.3), (3, 0.4), (5, 0.5), (8, 0.6)])
+        self.assertEqual(stats, SnapStats(off_grid = 0, late = 1))
+
+        stats = SnapStats()
+        snapped = Combiner.snap(events((0, 0.1), (2.5, 0.2), (4.1, 0.3)), 0.0, 2.0, 0.25, stats)
+        self.assertEqual(list(snapped), [(0, 0.1), (2, 0.3)])
+        self.assertEqual(stats, SnapStats(off_grid = 1, late = 0))
+
+    def test_merge_join(self):
+        joined = Combiner.merge_join([iter([(0, 0.1), (2, 0.2)]), iter([(1, 0.3)]), iter([(3, 0.4)])])
+        self.assertEqual(list(joined), [(0, [0.1, None, None]), (1, [None, 0.3, None]),
+                                        (2, [0.2, None, None]), (3, [None, None, 0.4])])
+        self.assertEqual(list(Combiner.merge_join([iter([]), iter([])])), [])
+
+    def test_file_column(self):
+        self.assertEqual(Combiner.file_column('tb3.csv:2', 1), ('tb3.csv', 2))
+        self.assertEqual(Combiner.file_column('tb3.csv', 1), ('tb3.csv', 1))
+        self.assertEqual(Combiner.file_column('tb3:old.csv', 1), ('tb3:old.csv', 1))
+
+    def test_combine(self):
+        # Three files with gaps and repeated timestamps; the third's rain rate is in column 2.
+        tb3 = self.write_csv('tb3.csv', ['100,0.1', '102,0.2', '102,0.9', '104,0.3', '110,0.4'])
+        tb7 = self.write_csv('tb7.csv', ['101,1.0', '103,1.1', '108,1.2'])
+        other = self.write_csv('other.csv', ['104,0.01,2.0', '104,0.01,2.5', '106,0.00,2.1'])
+        stats = [SnapStats() for _ in range(3)]
+        combined = Combiner.combine([tb3, tb7, other + ':2'], 2.0, 1.0, 1, stats)
+        self.assertEqual(list(combined), [
+            (100.0, [0.1, 1.0, None]),
+            (102.0, [0.2, 1.1, None]),
+            (104.0, [0.3, None, 2.0]),
+            (106.0, [None, None, 2.1]),
+            (108.0, [None, 1.2, None]),
+            (110.0, [0.4, None, None])])
+        self.assertEqual(stats, [SnapStats() for _ in range(3)])
+        self.assertEqual(list(Combiner.combine([self.write_csv('empty.csv', [])])), [])
+
+if __name__ == '__main__':
+    unittest.main()
@@ -4,10 +4,25 @@
 #
 """Test computing rainrates."""
 
+import glob
 import logging
+import os
+import pstats
+import shutil
+import tempfile
+import threading
+import time
+import tracemalloc
 import unittest
 
+from unittest import mock
+
+from array import array
+
 import weeutil.logger
+import weewx
+import weewx.manager
+import weewx.units
 
 import user.rainrate
 
@@ -16,9 +31,55 @@ log = logging.getLogger(__name__)
 # Set up logging using the defaults.
 weeutil.logger.setup('test_config', {})
 
+ARCHIVE_SCHEMA = [
+    ('dateTime', 'INTEGER NOT NULL UNIQUE PRIMARY KEY'),
+    ('usUnits',  'INTEGER NOT NULL'),
+    ('interval', 'INTEGER NOT NULL'),
+    ('rain',     'REAL'),
+    ('rainRate', 'REAL'),
+    ('rain2',    'REAL'),
+]
+
+class FakeEngine:
+    """Just enough of an engine for RainRate services to bind to."""
+    def __init__(self):
+        self.callbacks = {}
+        self.service_obj = []
+
+    def bind(self, event_type, callback):
+        self.callbacks.setdefault(event_type, []).append(callback)
+
+    def dispatch(self, event):
+        for callback in self.callbacks.get(event.event_type, []):
+            callback(event)
+
+    def loop_packet(self, pkt):
+        self.dispatch(weewx.Event(weewx.NEW_LOOP_PACKET, packet=pkt))
+
+    def archive_record(self, record):
+        self.dispatch(weewx.Event(weewx.NEW_ARCHIVE_RECORD, record=record))
+
+    def pre_loop(self):
+        self.dispatch(weewx.Event(weewx.PRE_LOOP))
+
+def new_service(engine, **options):
+    config_dict = {
+        'RainRate'  : dict({ 'enable': 'true' }, **options),
+        'StdArchive': { 'archive_interval': '300' },
+    }
+    return user.rainrate.RainRate(engine, config_dict)
+
+def open_archive(recs):
+    """Return a manager for an in-memory archive containing recs."""
+    dbm = weewx.manager.Manager.open_with_create(
+        {'database_name': ':memory:', 'driver': 'weedb.sqlite'}, schema=ARCHIVE_SCHEMA)
+    for rec in recs:
+        dbm.addRecord(dict(rec, usUnits=1, interval=5), log_success=False)
+    return dbm
+
 class RainRateTests(unittest.TestCase):
     def test_add_packet(self):
-        rain_entries = []
+        rain_entries = user.rainrate.RainEntries()
         ts = 1668104200
 
         # Add 100 pkts of zero rain.  Expect no entries.
@@ -32,7 +93,7 @@ class RainRateTests(unittest.TestCase):
         pkt = { 'dateTime': ts, 'rain': 0.01, 'rainRate': 0.0 }
         user.rainrate.RainRate.add_packet(pkt, rain_entries)
         self.assertEqual(len(rain_entries), 1)
-        self.assertEqual(rain_entries[0], user.rainrate.RainEntry(expiration = ts + 1800, timestamp = ts, amount = 0.01, dont_merge = False))
+        self.assertEqual(rain_entries.newest(), user.rainrate.RainEntry(expiration = ts + 1800, timestamp = ts, amount = 0.01, dont_merge = False))
         ts += 2
 
         # Add 448 pkts of zero rain.  Entry above should still be present.
@@ -41,14 +102,14 @@ class RainRateTests(unittest.TestCase):
             user.rainrate.RainRate.add_packet(pkt, rain_entries)
             ts += 2
         self.assertEqual(len(rain_entries), 1)
-        self.assertEqual(rain_entries[0], user.rainrate.RainEntry(expiration = 1668104400 + 1800, timestamp = 1668104400, amount = 0.01, dont_merge = False))
+        self.assertEqual(rain_entries.newest(), user.rainrate.RainEntry(expiration = 1668104400 + 1800, timestamp = 1668104400, amount = 0.01, dont_merge = False))
 
         # Add a pkt of 0.01 rain.  Should now have two entries.
         pkt = { 'dateTime': ts, 'rain': 0.01, 'rainRate': 0.0 }
         user.rainrate.RainRate.add_packet(pkt, rain_entries)
         self.assertEqual(len(rain_entries), 2)
-        self.assertEqual(rain_entries[0], user.rainrate.RainEntry(expiration = ts + 1800, timestamp = ts, amount = 0.01, dont_merge = False))
-        self.assertEqual(rain_entries[1], user.rainrate.RainEntry(expiration = 1668104400 + 1800, timestamp = 1668104400, amount = 0.01, dont_merge = False))
+        self.assertEqual(rain_entries.newest(), user.rainrate.RainEntry(expiration = ts + 1800, timestamp = ts, amount = 0.01, dont_merge = False))
+        self.assertEqual(rain_entries.previous(), user.rainrate.RainEntry(expiration = 1668104400 + 1800, timestamp = 1668104400, amount = 0.01, dont_merge = False))
         ts += 2
 
         # Add a pkt of 0.00 rain. Expect first entry to still be around.
@@ -74,56 +135,82 @@ class RainRateTests(unittest.TestCase):
     def test_archive_records_to_rain_entries(self):
         archive_interval = 300
 
-        rain_entries = []
+        rain_entries = user.rainrate.RainEntries()
         rec = { 'dateTime': 1673208000, 'usUnits': 'US', 'rain': 0.05, 'rainRate': 0.60 }
         user.rainrate.RainRate.archive_records_to_rain_entries(rec, archive_interval, rain_entries)
+        entries = list(rain_entries)
         self.assertEqual(len(rain_entries), 5)
 
-        self.assertEqual(rain_entries[4].timestamp, 1673207700)
-        self.assertAlmostEqual(rain_entries[4].amount, 0.01)
-        self.assertAlmostEqual(rain_entries[4].expiration, 1673209500)
+        self.assertEqual(entries[4].timestamp, 1673207700)
+        self.assertAlmostEqual(entries[4].amount, 0.01)
+        self.assertAlmostEqual(entries[4].expiration, 1673209500)
 
-        self.assertEqual(rain_entries[3].timestamp, 1673207760)
-        self.assertAlmostEqual(rain_entries[3].amount, 0.01)
-        self.assertAlmostEqual(rain_entries[3].expiration, 1673209560)
+        self.assertEqual(entries[3].timestamp, 1673207760)
+        self.assertAlmostEqual(entries[3].amount, 0.01)
+        self.assertAlmostEqual(entries[3].expiration, 1673209560)
 
-        self.assertEqual(rain_entries[2].timestamp, 1673207820)
-        self.assertAlmostEqual(rain_entries[2].amount, 0.01)
-        self.assertAlmostEqual(rain_entries[2].expiration, 1673209620)
+        self.assertEqual(entries[2].timestamp, 1673207820)
+        self.assertAlmostEqual(entries[2].amount, 0.01)
+        self.assertAlmostEqual(entries[2].expiration, 1673209620)
 
-        self.assertEqual(rain_entries[1].timestamp, 1673207880)
-        self.assertAlmostEqual(rain_entries[1].amount, 0.01)
-        self.assertAlmostEqual(rain_entries[1].expiration, 1673209680)
+        self.assertEqual(entries[1].timestamp, 1673207880)
+        self.assertAlmostEqual(entries[1].amount, 0.01)
+        self.assertAlmostEqual(entries[1].expiration, 1673209680)
 
-        self.assertEqual(rain_entries[0].timestamp, 1673207940)
-        self.assertAlmostEqual(rain_entries[0].amount, 0.01)
-        self.assertAlmostEqual(rain_entries[0].expiration, 1673209740)
+        self.assertEqual(entries[0].timestamp, 1673207940)
+        self.assertAlmostEqual(entries[0].amount, 0.01)
+        self.assertAlmostEqual(entries[0].expiration, 1673209740)
 
-        rain_entries = []
+        rain_entries = user.rainrate.RainEntries()
         rec = { 'dateTime': 1673208000, 'usUnits': 'US', 'rain': 0.01, 'rainRate': 0.60 }
         user.rainrate.RainRate.archive_records_to_rain_entries(rec, archive_interval, rain_entries)
+        entries = list(rain_entries)
         self.assertEqual(len(rain_entries), 1)
 
-        self.assertEqual(rain_entries[0].timestamp, 1673207850)
-        self.assertAlmostEqual(rain_entries[0].amount, 0.01)
-        self.assertAlmostEqual(rain_entries[0].expiration, 1673209650)
+        self.assertEqual(entries[0].timestamp, 1673207850)
+        self.assertAlmostEqual(entries[0].amount, 0.01)
+        self.assertAlmostEqual(entries[0].expiration, 1673209650)
 
-        rain_entries = []
+        rain_entries = user.rainrate.RainEntries()
         rec = { 'dateTime': 1673208000, 'usUnits': 'US', 'rain': 0.02, 'rainRate': 0.60 }
         user.rainrate.RainRate.archive_records_to_rain_entries(rec, archive_interval, rain_entries)
+        entries = list(rain_entries)
         self.assertEqual(len(rain_entries), 2)
 
-        self.assertEqual(rain_entries[1].timestamp, 1673207700)
-        self.assertAlmostEqual(rain_entries[1].amount, 0.01)
-        self.assertAlmostEqual(rain_entries[1].expiration, 1673209500)
-
-        self.assertEqual(rain_entries[0].timestamp, 1673207850)
-        self.assertAlmostEqual(rain_entries[0].amount, 0.01)
-        self.assertAlmostEqual(rain_entries[0].expiration, 1673209650)
+        self.assertEqual(entries[1].timestamp, 1673207700)
+        self.assertAlmostEqual(entries[1].amount, 0.01)
+        self.assertAlmostEqual(entries[1].expiration, 1673209500)
+
+        self.assertEqual(entries[0].timestamp, 1673207850)
+        self.assertAlmostEqual(entries[0].amount, 0.01)
+        self.assertAlmostEqual(entries[0].expiration, 1673209650)
+
+        # Consecutive records keep the entries newest first (and so expire oldest first).
+        rain_entries = user.rainrate.RainEntries()
+        for rec in [{ 'dateTime': 1673208000, 'rain': 0.02 }, { 'dateTime': 1673208300, 'rain': 0.01 }]:
+            user.rainrate.RainRate.archive_records_to_rain_entries(rec, archive_interval, rain_entries)
+        self.assertEqual([entry.timestamp for entry in rain_entries], [1673208150, 1673207850, 1673207700])
+        self.assertEqual(rain_entries.expire(1673209650), 2)
+        self.assertEqual(rain_entries.newest().timestamp, 1673208150)
+
+
+    def test_get_archive_rain(self):
+        dbm = open_archive([
+            { 'dateTime': 1673207700, 'rain': 0.01 },
+            { 'dateTime': 1673208000, 'rain': 0.00 },
+            { 'dateTime': 1673208300, 'rain': None },
+            { 'dateTime': 1673208600, 'rain': 0.03 },
+            { 'dateTime': 1673208900, 'rain': 0.01, 'rain2': 0.2 },
+            { 'dateTime': 1673209200, 'rain': 0.00, 'rain2': 0.4 }])
+        self.assertEqual(list(user.rainrate.RainRate.get_archive_rain(dbm, 1673207700)),
+                         [(1673208600, 0.03), (1673208900, 0.01)])
+        self.assertEqual(list(user.rainrate.RainRate.get_archive_rain(dbm, 1673207700, ['rain', 'rain2'])),
+                         [(1673208600, 0.03, None), (1673208900, 0.01, 0.2), (1673209200, 0.0, 0.4)])
+        dbm.close()
 
 
     def test_compute_rain_rate(self):
-        rain_entries = []
+        rain_entries = user.rainrate.RainEntries()
         ts = 1668104200
 
         # A single tip. 0.01
@@ -188,7 +275,7 @@ class RainRateTests(unittest.TestCase):
         self.assertAlmostEqual(pkt['rainRate'], 0.31578947368)
 
     def test_compute_rain_rate2(self):
-        rain_entries = []
+        rain_entries = user.rainrate.RainEntries()
         ts = 1668104200
 
         # A 0.02 in one pkt.
@@ -260,7 +347,7 @@ class RainRateTests(unittest.TestCase):
 
 
     def test_consecutive_packet_tips(self):
-        rain_entries = []
+        rain_entries = user.rainrate.RainEntries()
         ts = 1668104200
 
         # A single tip. 0.01
@@ -310,7 +397,7 @@ class RainRateTests(unittest.TestCase):
 
 
     def test_compute_rain_rate_fade_to_zero(self):
-        rain_entries = []
+        rain_entries = user.rainrate.RainEntries()
 
         ts = 1668104200
         pkt = { 'dateTime': ts, 'rain': 0.01, 'rainRate': 0.0 }
@@ -392,7 +479,7 @@ class RainRateTests(unittest.TestCase):
 
 
     def test_compute_rain_rate_50_percent(self):
-        rain_entries = []
+        rain_entries = user.rainrate.RainEntries()
         ts = 1668104200
 
         # Every other pkt has rain.  That's 1800 pkts per hour with 900 having .01 rain.
@@ -414,7 +501,7 @@ class RainRateTests(unittest.TestCase):
         self.assertEqual(pkt['rainRate'], 9.0)
 
     def test_compute_rain_rate_one_in_15(self):
-        rain_entries = []
+        rain_entries = user.rainrate.RainEntries()
         ts = 1668104200
 
         ctr = 0
@@ -433,7 +520,7 @@ class RainRateTests(unittest.TestCase):
         self.assertAlmostEqual(pkt['rainRate'], 1.2)
 
     def test_compute_rain_rate_one_in_45(self):
-        rain_entries = []
+        rain_entries = user.rainrate.RainEntries()
         ts = 1668104200
 
         ctr = 0
@@ -458,7 +545,7 @@ class RainRateTests(unittest.TestCase):
         ...
         "2022-11-09 22:40:00",1668033600,0.01,0.0
         """
-        rain_entries = []
+        rain_entries = user.rainrate.RainEntries()
         infile = open('bin/user/tests/2022-11-rain-event.csv', 'r')
         lines = infile.readlines()
         infile.close()
@@ -475,6 +562,523 @@ class RainRateTests(unittest.TestCase):
                 highRainRate = pkt['rainRate']
         self.assertAlmostEqual(highRainRate, 0.48)
 
+    def test_archive_rain_rates_max(self):
+        archive_rain_rates = user.rainrate.ArchiveRainRates(300, 'max')
+        self.assertIsNone(archive_rain_rates.consume(1668104400))
+        for ts, rate in [(1668104102, 0.5), (1668104200, 1.5), (1668104400, 0.2), (1668104402, 9.9)]:
+            archive_rain_rates.add(ts, rate)
+        # The 9.9 belongs to the next archive period.
+        self.assertEqual(archive_rain_rates.consume(1668104400), 1.5)
+        self.assertEqual(archive_rain_rates.consume(1668104700), 9.9)
+        self.assertIsNone(archive_rain_rates.consume(1668105000))
+
+    def test_archive_rain_rates_mean(self):
+        archive_rain_rates = user.rainrate.ArchiveRainRates(300, 'mean')
+        # 1.0 for the first 240s of the period, 4.0 for the last 60s.
+        archive_rain_rates.add(1668104340, 1.0)
+        archive_rain_rates.add(1668104400, 4.0)
+        self.assertAlmostEqual(archive_rain_rates.consume(1668104400), 1.6)
+
+    def test_archive_rain_rates_p95(self):
+        archive_rain_rates = user.rainrate.ArchiveRainRates(300, 'p95')
+        ts = 1668104102
+        for i in range(150):
+            archive_rain_rates.add(ts, i / 100.0)
+            ts += 2
+        self.assertAlmostEqual(archive_rain_rates.consume(1668104400), 1.42, delta=0.02)
+
+    def test_archive_rain_rates_bounded(self):
+        archive_rain_rates = user.rainrate.ArchiveRainRates(300, 'max')
+        # An hour of loop packets with no archive records.
+        ts = 1668104102
+        for _ in range(1800):
+            archive_rain_rates.add(ts, 1.0 if ts < 1668105000 else 0.5)
+            ts += 2
+        self.assertEqual(len(archive_rain_rates.periods), user.rainrate.ArchiveRainRates.MAX_PERIODS)
+        self.assertEqual(archive_rain_rates.consume(ts), 0.5)
+
+    def test_compute_rain_rates(self):
+        for csv_file in ['bin/user/rate_computer/2022Dec01_PaloAlto_0.68inch_storm_TB3.csv',
+                         'bin/user/rate_computer/2022Dec03_PaloAlto_partial_TB3.csv']:
+            timestamps = array('q')
+            rains = array('d')
+            expected = []
+            rain_entries = user.rainrate.RainEntries()
+            with open(csv_file, 'r') as infile:
+                for line in infile:
+                    cols = line.split(',')
+                    pkt = { 'dateTime': int(cols[0]), 'rain': float(cols[1]), 'rainRate': float(cols[2]) }
+                    timestamps.append(pkt['dateTime'])
+                    rains.append(pkt['rain'])
+                    user.rainrate.RainRate.add_packet(pkt, rain_entries)
+                    user.rainrate.RainRate.compute_rain_rate(pkt, rain_entries)
+                    expected.append(pkt['rainRate'])
+            rates = user.rainrate.RainRate.compute_rain_rates(timestamps, rains)
+            self.assertEqual(list(rates), expected)
+            self.assertGreater(max(rates), 0.0)
+
+        # Missing rain is no rain.
+        rates = user.rainrate.RainRate.compute_rain_rates([1668104200, 1668104230, 1668104232, 1668104260], [0.01, None, 0.01, None])
+        self.assertEqual(list(rates), [0.0, 0.0, 1.125, 1.125])
+
+        with self.assertRaises(ValueError):
+            user.rainrate.RainRate.compute_rain_rates([1668104200], [])
+
+    def test_add_packets(self):
+        # A storm, then a burst of siphon double tips (merged) and multi-tips (spread).
+        pkts = []
+        with open('bin/user/rate_computer/2022Dec01_PaloAlto_0.68inch_storm_TB3.csv', 'r') as infile:
+            for line in infile:
+                cols = line.split(',')
+                pkts.append({ 'dateTime': int(cols[0]), 'rain': float(cols[1]) })
+        ts = pkts[-1]['dateTime']
+        for rain in [0.01, 0.01, 0.0, 0.01, 0.03, None, 0.01, 0.01, 0.01, 0.0, 0.02, 0.01]:
+            ts += 2
+            pkts.append({ 'dateTime': ts, 'rain': rain })
+
+        rain_entries = user.rainrate.RainEntries()
+        expected = []
+        for pkt in pkts:
+            pkt = dict(pkt)
+            user.rainrate.RainRate.add_packet(pkt, rain_entries)
+            user.rainrate.RainRate.compute_rain_rate(pkt, rain_entries)
+            expected.append(pkt['rainRate'])
+
+        batch_entries = user.rainrate.RainEntries()
+        self.assertEqual(user.rainrate.RainRate.add_packets(iter(pkts), batch_entries), len(pkts))
+        self.assertEqual([pkt['rainRate'] for pkt in pkts], expected)
+        self.assertEqual(list(batch_entries), list(rain_entries))
+        self.assertGreater(batch_entries.merges, 0)
+        self.assertEqual((batch_entries.tips, batch_entries.spreads, batch_entries.merges, batch_entries.expirations),
+                         (rain_entries.tips, rain_entries.spreads, rain_entries.merges, rain_entries.expirations))
+
+    def test_tip_rate(self):
+        rain_entries = user.rainrate.RainEntries()
+        rain_entries.add(user.rainrate.RainEntry(timestamp = 1668104200, amount = 0.01, expiration = 1668106000, dont_merge = False))
+        rain_entries.add(user.rainrate.RainEntry(timestamp = 1668104300, amount = 0.01, expiration = 1668106100, dont_merge = False))
+        self.assertAlmostEqual(rain_entries.tip_rate(), 0.36)
+        rain_entries.add(user.rainrate.RainEntry(timestamp = 1668104350, amount = 0.02, expiration = 1668106150, dont_merge = False))
+        self.assertAlmostEqual(rain_entries.tip_rate(), 1.44)
+        rain_entries.pop_newest()
+        self.assertAlmostEqual(rain_entries.tip_rate(), 0.36)
+        # Idle packets are a no-op.
+        user.rainrate.RainRate.add_rain(1668104400, 0.0, user.rainrate.RainEntries())
+
+    def test_params(self):
+        timestamps = [1668104200, 1668104800, 1668105400, 1668105900]
+        rains = [0.01, 0.01, 0.0, 0.0]
+        # Defaults: 0.06"/hr, fading to 0.033 (below min_rate).
+        self.assertEqual(list(user.rainrate.RainRate.compute_rain_rates(timestamps, rains)), [0.0, 0.06, 0.06, 0.0])
+        params = user.rainrate.RainRateParams(min_rate = 0.0)
+        self.assertEqual(list(user.rainrate.RainRate.compute_rain_rates(timestamps, rains, params=params)), [0.0, 0.06, 0.06, 3600 * 0.01 / 1100])
+        # With a 10m expiry, the first tip is gone by the time the second arrives.
+        params = user.rainrate.RainRateParams(expiry = 600)
+        self.assertEqual(list(user.rainrate.RainRate.compute_rain_rates(timestamps, rains, params=params)), [0.0, 0.0, 0.0, 0.0])
+
+    def test_metrics(self):
+        tmpdir = tempfile.mkdtemp()
+        try:
+            metrics_file = os.path.join(tmpdir, 'rainrate.prom')
+            engine = FakeEngine()
+            service = new_service(engine, metrics_file=metrics_file, metrics_loop_fields='true')
+            ts = 1668104200
+            for rain in [0.01, 0.0, 0.01, 0.01, 0.0, 0.02, 0.0]:
+                pkt = { 'dateTime': ts, 'usUnits': weewx.US, 'rain': rain, 'rainRate': 0.0 }
+                engine.loop_packet(pkt)
+                ts += 2
+            self.assertEqual(pkt['rainRateEntries'], 5)
+            self.assertGreater(pkt['rainRateLoopSeconds'], 0.0)
+            engine.archive_record({ 'dateTime': 1668104400, 'usUnits': weewx.US, 'rain': 0.05 })
+            service.shutDown()
+
+            with open(metrics_file, 'r') as f:
+                metrics = dict(line.rsplit(' ', 1) for line in f.read().splitlines() if not line.startswith('#'))
+            self.assertEqual(metrics['rainrate_loop_packets_total'], '7')
+            self.assertEqual(metrics['rainrate_archive_records_total'], '1')
+            self.assertEqual(metrics['rainrate_tips_total{gauge="rain"}'], '4')
+            self.assertEqual(metrics['rainrate_merges_total{gauge="rain"}'], '2')
+            self.assertEqual(metrics['rainrate_spreads_total{gauge="rain"}'], '3')
+            self.assertEqual(metrics['rainrate_rain_entries{gauge="rain"}'], '5')
+            self.assertEqual(metrics['rainrate_pending_loop_rain_rates{gauge="rain"}'], '0')
+            self.assertEqual(metrics['rainrate_new_loop_seconds_count'], '7')
+            self.assertEqual(metrics['rainrate_new_loop_seconds_bucket{le="+Inf"}'], '7')
+            self.assertEqual(metrics['rainrate_new_archive_record_seconds_count'], '1')
+        finally:
+            shutil.rmtree(tmpdir)
+
+    def test_profiler(self):
+        tmpdir = tempfile.mkdtemp()
+        try:
+            profile_dir = os.path.join(tmpdir, 'profiles')
+            sentinel = os.path.join(tmpdir, 'profile')
+            engine = FakeEngine()
+            service = new_service(engine, profile_dir=profile_dir, profile_packets='5', profile_interval='60',
+                                  tracemalloc_interval='30', profile_keep='2', profile_sentinel=sentinel, profile_signal='')
+            def loop_packets(start, count):
+                for ts in range(start, start + 2 * count, 2):
+                    engine.loop_packet({ 'dateTime': ts, 'usUnits': weewx.US, 'rain': 0.01 if ts % 20 == 0 else 0.0, 'rainRate': 0.0 })
+            def files(suffix):
+                return sorted(glob.glob(os.path.join(profile_dir, '*.%s' % suffix)))
+
+            # Nothing is sampled without the sentinel.
+            loop_packets(1668104200, 100)
+            self.assertFalse(os.path.exists(profile_dir))
+            self.assertFalse(tracemalloc.is_tracing())
+
+            open(sentinel, 'w').close()
+            loop_packets(1668104400, 100)
+            self.assertEqual(len(files('prof')), 2)
+            self.assertGreater(pstats.Stats(files('prof')[-1]).total_calls, 0)
+            self.assertEqual(len(files('tracemalloc')), 2)
+            tracemalloc.Snapshot.load(files('tracemalloc')[-1])
+            self.assertTrue(tracemalloc.is_tracing())
+
+            # Disabled (e.g., by a signal), tracing stops.
+            service.profiler.toggle(None, None)
+            loop_packets(1668104600, 1)
+            self.assertFalse(tracemalloc.is_tracing())
+            service.profiler.toggle(None, None)
+            loop_packets(1668104800, 1)
+            self.assertTrue(tracemalloc.is_tracing())
+            service.shutDown()
+            self.assertFalse(tracemalloc.is_tracing())
+            self.assertIsNone(service.profiler.profile)
+        finally:
+            tracemalloc.stop()
+            shutil.rmtree(tmpdir)
+
+    def test_log_summary_and_sampling(self):
+        engine = FakeEngine()
+        new_service(engine, log_summary_interval='60', log_sample_interval='10')
+        ts = 1668104200
+        with self.assertLogs('user.rainrate', level='INFO') as logs:
+            for i in range(60):
+                engine.loop_packet({ 'dateTime': ts, 'usUnits': weewx.US, 'rain': 0.01 if i in [2, 10, 11] else 0.0, 'rainRate': 0.0 })
+                ts += 2
+        messages = [record.getMessage() for record in logs.records]
+        self.assertEqual(len([message for message in messages if message.startswith('Sampled pkt')]), 6)
+        self.assertEqual([message for message in messages if message.startswith('In the last')],
+                         ['In the last 60 seconds, spread 1 multi-tip(s) and merged 1 double tip(s) of rain.'])
+
+    def test_gauges(self):
+        engine = FakeEngine()
+        service = new_service(engine, gauges={
+            'tb3': { 'rain_field': 'rain',  'rate_field': 'rainRate' },
+            'tb7': { 'rain_field': 'rain2', 'rate_field': 'rainRate2', 'tip_size': '0.2', 'merge_window': '0' }})
+        self.assertEqual([gauge.name for gauge in service.gauges], ['tb3', 'tb7'])
+        self.assertEqual(service.gauges[1].params, user.rainrate.RainRateParams(
+            tip_size = 0.2, merge_window = 0.0, single_tip_threshold = 0.2 + 0.0000001))
+
+        ts = 1668104200
+        for rain, rain2 in [(0.0, 0.0), (0.01, 0.2), (0.01, 0.2), (0.0, 0.0), (0.0, None)]:
+            pkt = { 'dateTime': ts, 'usUnits': weewx.US, 'rain': rain, 'rain2': rain2, 'rainRate': 0.0 }
+            engine.loop_packet(pkt)
+            ts += 2
+        # The tb3 tips are merged into a double tip, the tb7 tips are not.
+        self.assertEqual(service.gauges[0].rain_entries.merges, 1)
+        self.assertEqual(service.gauges[1].rain_entries.merges, 0)
+        self.assertEqual(len(service.gauges[1].rain_entries), 2)
+        self.assertEqual(len(service.gauges[0].rain_entries), 1)
+        self.assertEqual(pkt['rainRate'], 0.0)
+        self.assertAlmostEqual(pkt['rainRate2'], 3600 * 0.2 / 4)
+        # Both gauges are converted (e.g., by StdConvert).
+        metric = weewx.units.to_METRIC(pkt)
+        self.assertAlmostEqual(metric['rainRate2'], 3600 * 0.2 / 4 * 2.54)
+        self.assertAlmostEqual(metric['rain'], 0.0)
+        self.assertIsNone(metric['rain2'])
+        self.assertEqual(weewx.units.obs_group_dict['rain2'], 'group_rain')
+
+        record = { 'dateTime': 1668104400, 'usUnits': weewx.US, 'rain': 0.02, 'rain2': 0.4 }
+        engine.archive_record(record)
+        self.assertAlmostEqual(record['rainRate2'], 3600 * 0.2 / 2)
+        self.assertIsNotNone(record['rainRate'])
+
+    def test_snapshot(self):
+        tmpdir = tempfile.mkdtemp()
+        try:
+            snapshot_file = os.path.join(tmpdir, 'rainrate.snapshot')
+            engine = FakeEngine()
+            service = new_service(engine, snapshot_file=snapshot_file, archive_rate_method='p95')
+            # Loop packets from the start of the previous archive period into the current one.
+            ts = int(time.time()) // 300 * 300 - 298
+            rains = [0.01, 0.0, 0.0, 0.02, 0.0, 0.01, 0.0, 0.0, 0.0, 0.01]
+            for i in range(151):
+                engine.loop_packet({ 'dateTime': ts, 'usUnits': weewx.US, 'rain': rains[i % len(rains)], 'rainRate': 0.0 })
+                if ts % 300 == 2:
+                    engine.archive_record({ 'dateTime': ts - 2, 'usUnits': weewx.US, 'rain': 0.05 })
+                ts += 2
+            # Snapshots are written by a background thread, which shutDown stops.
+            self.assertTrue(service.snapshot.thread.is_alive())
+            service.shutDown()
+            self.assertIsNone(service.snapshot.thread)
+
+            # A restarted service picks up exactly where the old one left off.
+            restarted_engine = FakeEngine()
+            restarted = new_service(restarted_engine, snapshot_file=snapshot_file, archive_rate_method='p95')
+            restarted_engine.pre_loop()
+            self.assertEqual(list(restarted.gauges[0].rain_entries), list(service.gauges[0].rain_entries))
+            for e in [engine, restarted_engine]:
+                e.pkt = { 'dateTime': ts, 'usUnits': weewx.US, 'rain': 0.01, 'rainRate': 0.0 }
+                e.loop_packet(e.pkt)
+                e.record = { 'dateTime': -(-ts // 300) * 300, 'usUnits': weewx.US, 'rain': 0.05 }
+                e.archive_record(e.record)
+            self.assertEqual(restarted_engine.pkt['rainRate'], engine.pkt['rainRate'])
+            self.assertEqual(restarted_engine.record['rainRate'], engine.record['rainRate'])
+            restarted.shutDown()
+
+            # Stale snapshots are ignored.
+            service.snapshot.write(service.gauges, int(time.time()) - 1000)
+            stale = new_service(FakeEngine(), snapshot_file=snapshot_file)
+            with self.assertLogs('user.rainrate', level='INFO') as logs:
+                self.assertFalse(stale.load_snapshot(int(time.time())))
+            self.assertIn('ignoring it', logs.output[0])
+
+            # As are corrupt ones.
+            with open(snapshot_file, 'wb') as f:
+                f.write(user.rainrate.RainRateSnapshot.pack(service.gauges, int(time.time()))[:-3])
+            self.assertFalse(stale.load_snapshot(int(time.time())))
+            self.assertEqual(len(stale.gauges[0].rain_entries), 0)
+        finally:
+            shutil.rmtree(tmpdir)
+
+    def test_rolling_totals(self):
+        engine = FakeEngine()
+        new_service(engine, rolling_windows=['60', '300'], intensity_window='600')
+        ts = 1668104200
+        tips = { 1668104210: 0.01, 1668104220: 0.02, 1668104400: 0.01 }
+        pkts = {}
+        for _ in range(400):
+            pkt = { 'dateTime': ts, 'usUnits': weewx.US, 'rain': tips.get(ts, 0.0), 'rainRate': 0.0 }
+            engine.loop_packet(pkt)
+            pkts[ts] = pkt
+            ts += 2
+        def totals(ts):
+            return [round(pkts[ts][field], 6) for field in ['rain_1m', 'rain_5m', 'rainIntensity']]
+        self.assertEqual(totals(1668104200), [0.0, 0.0, 0.0])
+        self.assertEqual(totals(1668104220), [0.03, 0.03, 0.18])
+        self.assertEqual(totals(1668104270), [0.02, 0.03, 0.18])
+        self.assertEqual(totals(1668104280), [0.0, 0.03, 0.18])
+        self.assertEqual(totals(1668104400), [0.01, 0.04, 0.24])
+        self.assertEqual(totals(1668104510), [0.0, 0.03, 0.24])
+        self.assertEqual(totals(1668104520), [0.0, 0.01, 0.24])
+        self.assertEqual(totals(1668104810), [0.0, 0.0, 0.18])
+        self.assertEqual(totals(1668104820), [0.0, 0.0, 0.06])
+        self.assertEqual(pkts[1668104820]['rain_1m'], 0.0)
+
+        # The new fields are converted along with rain and rainRate (e.g., by StdConvert).
+        metric = weewx.units.to_METRIC(pkts[1668104400])
+        self.assertEqual(metric['usUnits'], weewx.METRIC)
+        self.assertAlmostEqual(metric['rain_5m'], 0.04 * 2.54)
+        self.assertAlmostEqual(metric['rain_1m'], 0.01 * 2.54)
+        self.assertAlmostEqual(metric['rainIntensity'], 0.24 * 2.54)
+
+    def test_recorder(self):
+        tmpdir = tempfile.mkdtemp()
+        try:
+            engine = FakeEngine()
+            config_dict = {
+                'RainRate'        : { 'enable': 'true', 'gauges': { 'tb3': {}, 'tb7': { 'rain_field': 'rain2', 'rate_field': 'rainRate2' } } },
+                'RainRateRecorder': { 'enable': 'true', 'directory': tmpdir, 'flush_interval': '0.01' },
+                'StdArchive'      : { 'archive_interval': '300' },
+            }
+            engine.service_obj.append(user.rainrate.RainRate(engine, config_dict))
+            recorder = user.rainrate.RainRateRecorder(engine, config_dict)
+            engine.service_obj.append(recorder)
+
+            # Across midnight (local time).
+            midnight = int(time.mktime((2022, 12, 2, 0, 0, 0, 0, 0, -1)))
+            expected = { 'tb3': [], 'tb7': [] }
+            for i, ts in enumerate(range(midnight - 10, midnight + 10, 2)):
+                pkt = { 'dateTime': ts, 'usUnits': weewx.US, 'rain': 0.01 if i % 3 == 0 else 0.0, 'rainRate': 1.5,
+                        'rain2': None if i == 0 else 0.01 * (i % 2) }
+                engine.loop_packet(pkt)
+                expected['tb3'].append('%d,%r,1.5,%r' % (ts, pkt['rain'], pkt['rainRate']))
+                expected['tb7'].append('%d,%r,0.0,%r' % (ts, pkt['rain2'] or 0.0, pkt['rainRate2']))
+                if i == 3:
+                    time.sleep(0.05)
+            recorder.shutDown()
+
+            for gauge in ['tb3', 'tb7']:
+                lines = []
+                for day in ['20221201', '20221202']:
+                    with open(os.path.join(tmpdir, '%s-%s.csv' % (gauge, day)), 'r') as f:
+                        day_lines = f.read().splitlines()
+                    self.assertEqual(len(day_lines), 5)
+                    lines += day_lines
+                self.assertEqual(lines, expected[gauge])
+            self.assertEqual((recorder.written, recorder.dropped), (10, 0))
+            self.assertFalse(recorder.thread.is_alive())
+        finally:
+            shutil.rmtree(tmpdir)
+
+    def warm_start_service(self, tmpdir, **options):
+        """A service whose archive (a sqlite file in tmpdir) has rain in the last 15 minutes."""
+        now = int(time.time()) // 300 * 300
+        dbm = weewx.manager.Manager.open_with_create(
+            {'database_name': os.path.join(tmpdir, 'weewx.sdb'), 'driver': 'weedb.sqlite'}, schema=ARCHIVE_SCHEMA)
+        for ts, rain in [(now - 600, 0.02), (now - 300, 0.0), (now, 0.01)]:
+            dbm.addRecord({ 'dateTime': ts, 'usUnits': 1, 'interval': 5, 'rain': rain }, log_success=False)
+        dbm.close()
+        config_dict = {
+            'RainRate'     : dict({ 'enable': 'true' }, **options),
+            'StdArchive'   : { 'archive_interval': '300' },
+            'DataBindings' : { 'wx_binding': { 'database': 'archive_sqlite', 'manager': 'weewx.manager.Manager',
+                                               'table_name': 'archive' } },
+            'Databases'    : { 'archive_sqlite': { 'database_name': os.path.join(tmpdir, 'weewx.sdb'), 'driver': 'weedb.sqlite' } },
+        }
+        engine = FakeEngine()
+        return engine, user.rainrate.RainRate(engine, config_dict), now
+
+    def test_async_warm_start(self):
+        tmpdir = tempfile.mkdtemp()
+        try:
+            engine, service, now = self.warm_start_service(tmpdir)
+            # Hold the fetch until the loop packets have been buffered.
+            release = threading.Event()
+            get_archive_rain = user.rainrate.RainRate.get_archive_rain
+            def slow_get_archive_rain(dbm, earliest_time, rain_fields):
+                release.wait()
+                return get_archive_rain(dbm, earliest_time, rain_fields)
+            with mock.patch.object(user.rainrate.RainRate, 'get_archive_rain', staticmethod(slow_get_archive_rain)):
+                engine.pre_loop()
+                packets = [(now + 2, 0.01), (now + 4, 0.0), (now + 6, 0.01), (now + 8, 0.0)]
+                for ts, rain in packets[:3]:
+                    engine.loop_packet({ 'dateTime': ts, 'usUnits': weewx.US, 'rain': rain, 'rainRate': 0.0 })
+                self.assertEqual(len(service.warm_start.packets), 3)
+                release.set()
+                service.warm_start.thread.join()
+            pkt = { 'dateTime': packets[3][0], 'usUnits': weewx.US, 'rain': packets[3][1], 'rainRate': 0.0 }
+            engine.loop_packet(pkt)
+            self.assertIsNone(service.warm_start)
+
+            # The same as fetching the archive rain before the first loop packet.
+            rain_entries = user.rainrate.RainEntries()
+            user.rainrate.RainRate.archive_rain_to_rain_entries(now - 600, 0.02, 300, rain_entries)
+            user.rainrate.RainRate.archive_rain_to_rain_entries(now, 0.01, 300, rain_entries)
+            for ts, rain in packets:
+                user.rainrate.RainRate.add_rain(ts, rain, rain_entries)
+            self.assertEqual(list(service.gauges[0].rain_entries), list(rain_entries))
+            self.assertEqual(pkt['rainRate'], user.rainrate.RainRate.rain_rate(packets[3][0], rain_entries))
+        finally:
+            shutil.rmtree(tmpdir)
+
+    def test_snapshot_during_warm_start(self):
+        tmpdir = tempfile.mkdtemp()
+        try:
+            # No snapshot is written (periodically or at shutdown) while the warm start is pending.
+            os.mkdir(os.path.join(tmpdir, 'pending'))
+            snapshot_file = os.path.join(tmpdir, 'pending', 'rainrate.snapshot')
+            engine, service, now = self.warm_start_service(os.path.join(tmpdir, 'pending'), snapshot_file=snapshot_file)
+            release = threading.Event()
+            get_archive_rain = user.rainrate.RainRate.get_archive_rain
+            def slow_get_archive_rain(dbm, earliest_time, rain_fields):
+                release.wait()
+                return get_archive_rain(dbm, earliest_time, rain_fields)
+            with mock.patch.object(user.rainrate.RainRate, 'get_archive_rain', staticmethod(slow_get_archive_rain)):
+                engine.pre_loop()
+                engine.loop_packet({ 'dateTime': now + 2, 'usUnits': weewx.US, 'rain': 0.01, 'rainRate': 0.0 })
+                self.assertFalse(service.warm_start.done.is_set())
+                service.shutDown()
+                self.assertFalse(os.path.exists(snapshot_file))
+                release.set()
+                service.warm_start.thread.join()
+
+            # Once the warm start is done, snapshots are written.
+            os.mkdir(os.path.join(tmpdir, 'done'))
+            snapshot_file = os.path.join(tmpdir, 'done', 'rainrate.snapshot')
+            engine, service, now = self.warm_start_service(os.path.join(tmpdir, 'done'), snapshot_file=snapshot_file)
+            engine.pre_loop()
+            service.warm_start.thread.join()
+            engine.loop_packet({ 'dateTime': now + 2, 'usUnits': weewx.US, 'rain': 0.01, 'rainRate': 0.0 })
+            self.assertIsNone(service.warm_start)
+            service.shutDown()
+            written, states = service.snapshot.read()
+            self.assertEqual(list(states['rain'][0]), list(service.gauges[0].rain_entries))
+            self.assertGreater(len(service.gauges[0].rain_entries), 1)
+        finally:
+            shutil.rmtree(tmpdir)
+
+    def test_sync_warm_start(self):
+        tmpdir = tempfile.mkdtemp()
+        try:
+            engine, service, now = self.warm_start_service(tmpdir, async_warm_start='false')
+            engine.db_binder = weewx.manager.DBBinder(service.config_dict)
+            engine.pre_loop()
+            engine.db_binder.close()
+            self.assertIsNone(service.warm_start)
+            self.assertEqual([entry.timestamp for entry in service.gauges[0].rain_entries], [now - 150, now - 750, now - 900])
+        finally:
+            shutil.rmtree(tmpdir)
+
+    def test_catch_up(self):
+        tmpdir = tempfile.mkdtemp()
+        try:
+            # The driver replays the last two records (already saved to the archive) after pre_loop,
+            # while the warm start fetch is pending.
+            engine, service, now = self.warm_start_service(tmpdir)
+            release = threading.Event()
+            get_archive_rain = user.rainrate.RainRate.get_archive_rain
+            def slow_get_archive_rain(dbm, earliest_time, rain_fields):
+                release.wait()
+                return get_archive_rain(dbm, earliest_time, rain_fields)
+            with mock.patch.object(user.rainrate.RainRate, 'get_archive_rain', staticmethod(slow_get_archive_rain)):
+                engine.pre_loop()
+                records = [{ 'dateTime': now - 300, 'usUnits': weewx.US, 'interval': 5, 'rain': 0.0 },
+                           { 'dateTime': now, 'usUnits': weewx.US, 'interval': 5, 'rain': 0.01 }]
+                for record in records:
+                    engine.archive_record(record)
+                release.set()
+                service.warm_start.thread.join()
+            self.assertEqual(records[0]['rainRate'], 0.0)
+            self.assertEqual(records[1]['rainRate'], 0.0)
+            pkt = { 'dateTime': now + 2, 'usUnits': weewx.US, 'rain': 0.01, 'rainRate': 0.0 }
+            engine.loop_packet(pkt)
+
+            # The caught up record is only counted once.
+            rain_entries = user.rainrate.RainEntries()
+            user.rainrate.RainRate.archive_rain_to_rain_entries(now - 600, 0.02, 300, rain_entries)
+            user.rainrate.RainRate.archive_rain_to_rain_entries(now, 0.01, 300, rain_entries)
+            user.rainrate.RainRate.add_rain(now + 2, 0.01, rain_entries)
+            self.assertEqual(list(service.gauges[0].rain_entries), list(rain_entries))
+            self.assertEqual(pkt['rainRate'], user.rainrate.RainRate.rain_rate(now + 2, rain_entries))
+            self.assertGreater(pkt['rainRate'], 0.0)
+            self.assertIsNone(service.catch_up_rows)
+
+            # Records that do have loop packets are not caught up on.
+            record = { 'dateTime': now + 300, 'usUnits': weewx.US, 'interval': 5, 'rain': 0.01 }
+            engine.archive_record(record)
+            self.assertEqual(record['rainRate'], pkt['rainRate'])
+            self.assertEqual(len(service.gauges[0].rain_entries), len(rain_entries))
+
+            # Caught up on before pre_loop (e.g., RainRate runs after StdArchive), synchronously.
+            os.mkdir(os.path.join(tmpdir, 'sync'))
+            engine, service, now = self.warm_start_service(os.path.join(tmpdir, 'sync'), async_warm_start='false')
+            engine.archive_record({ 'dateTime': now, 'usUnits': weewx.US, 'interval': 5, 'rain': 0.01 })
+            engine.db_binder = weewx.manager.DBBinder(service.config_dict)
+            engine.pre_loop()
+            engine.db_binder.close()
+            self.assertEqual([entry.timestamp for entry in service.gauges[0].rain_entries], [now - 150, now - 750, now - 900])
+        finally:
+            shutil.rmtree(tmpdir)
+
+    def test_async_warm_start_timeout(self):
+        tmpdir = tempfile.mkdtemp()
+        try:
+            engine, service, now = self.warm_start_service(tmpdir, warm_start_timeout='0')
+            release = threading.Event()
+            with mock.patch.object(user.rainrate.RainRate, 'get_archive_rain', staticmethod(lambda *args: release.wait() and [])):
+                engine.pre_loop()
+                thread = service.warm_start.thread
+                time.sleep(0.01)
+                with self.assertLogs('user.rainrate', level='ERROR'):
+                    engine.loop_packet({ 'dateTime': now + 2, 'usUnits': weewx.US, 'rain': 0.01, 'rainRate': 0.0 })
+                self.assertIsNone(service.warm_start)
+                release.set()
+                thread.join()
+            self.assertEqual(len(service.gauges[0].rain_entries), 1)
+        finally:
+            shutil.rmtree(tmpdir)
+
 
 if __name__ == '__main__':
     unittest.main()
@@ -0,0 +1,151 @@
+#    Copyright (c) 2023 John A Kline <john@johnkline.com>
+#
+#    See the file LICENSE.txt for your full rights.
+#
+"""Test backfilling archive rain rates."""
+
+import logging
+import os
+import shutil
+import tempfile
+import time
+import unittest
+
+import weedb
+import weeutil.logger
+import weewx
+import weewx.manager
+
+import user.rainrate
+import user.rainrate_backfill
+
+log = logging.getLogger(__name__)
+
+# Set up logging using the defaults.
+weeutil.logger.setup('test_config', {})
+
+ARCHIVE_SCHEMA = [
+    ('dateTime', 'INTEGER NOT NULL UNIQUE PRIMARY KEY'),
+    ('usUnits',  'INTEGER NOT NULL'),
+    ('interval', 'INTEGER NOT NULL'),
+    ('rain',     'REAL'),
+    ('rainRate', 'REAL'),
+]
+
+# Two days of 5m records, with a storm spanning midnight (local time) of the first day.
+START_TS = 1672560000 # 2023-01-01 00:00:00 PST
+RAIN = { 1672644300: 0.01, 1672644600: 0.02, 1672644900: 0.05, 1672645200: 0.01,
+         1672646100: 0.03, 1672646400: 0.01, 1672647000: 0.02, 1672648800: 0.01 }
+
+class RainRateBackfillTests(unittest.TestCase):
+    def setUp(self):
+        self.tz = os.environ.get('TZ')
+        os.environ['TZ'] = 'America/Los_Angeles'
+        time.tzset()
+        self.tmpdir = tempfile.mkdtemp()
+        self.manager_dict = {
+            'table_name'   : 'archive',
+            'manager'      : 'weewx.manager.Manager',
+            'schema'       : ARCHIVE_SCHEMA,
+            'database_dict': { 'database_name': os.path.join(self.tmpdir, 'weewx.sdb'), 'driver': 'weedb.sqlite' },
+        }
+        with weewx.manager.open_manager(self.manager_dict, initialize=True) as dbm:
+            for ts in range(START_TS + 300, START_TS + 2 * 86400 + 300, 300):
+                dbm.addRecord({ 'dateTime': ts, 'usUnits': 1, 'interval': 5,
+                                'rain': RAIN.get(ts, 0.0), 'rainRate': 9.9 if ts in RAIN else 0.0 }, log_success=False)
+
+    def tearDown(self):
+        shutil.rmtree(self.tmpdir)
+        if self.tz is None:
+            del os.environ['TZ']
+        else:
+            os.environ['TZ'] = self.tz
+        time.tzset()
+
+    def expected_rain_rates(self):
+        rain_entries = user.rainrate.RainEntries()
+        rates = {}
+        for ts in range(START_TS + 300, START_TS + 2 * 86400 + 300, 300):
+            rates[ts] = user.rainrate.RainRate.archive_rain_rate(ts, RAIN.get(ts, 0.0), 300, rain_entries)
+        return rates
+
+    def archive_rain_rates(self):
+        with weewx.manager.open_manager(self.manager_dict) as dbm:
+            return dict(dbm.genSql('SELECT dateTime, rainRate FROM archive'))
+
+    def test_dry_run(self):
+        stats = user.rainrate_backfill.backfill(self.manager_dict, dry_run=True)
+        self.assertEqual(stats.days, 2)
+        self.assertEqual(stats.records, 576)
+        initial = self.archive_rain_rates()
+        self.assertEqual(stats.updated, len([ts for ts, rate in self.expected_rain_rates().items() if rate != initial[ts]]))
+        self.assertGreater(stats.updated, len(RAIN))
+        self.assertEqual(initial[1672644600], 9.9)
+
+    def test_backfill(self):
+        expected = self.expected_rain_rates()
+        self.assertGreater(expected[1672646400], 0.0)
+        for workers in [1, 2]:
+            stats = user.rainrate_backfill.backfill(self.manager_dict, workers=workers, batch_size=4)
+            self.assertEqual(stats.records, 576)
+            self.assertEqual(self.archive_rain_rates(), expected)
+        # Nothing left to do.
+        self.assertEqual(stats.updated, 0)
+
+    def test_checkpoint(self):
+        checkpoint = os.path.join(self.tmpdir, 'checkpoint.json')
+        stats = user.rainrate_backfill.backfill(self.manager_dict, stop_ts=START_TS + 86400, checkpoint=checkpoint)
+        self.assertEqual(user.rainrate_backfill.read_checkpoint(checkpoint), START_TS + 86400)
+        # Resume, only the second day is left.
+        stats = user.rainrate_backfill.backfill(self.manager_dict, checkpoint=checkpoint)
+        self.assertEqual(stats.days, 1)
+        self.assertEqual(self.archive_rain_rates(), self.expected_rain_rates())
+
+    def test_start(self):
+        # A backfill from the middle of a day leaves the earlier records of the day alone.
+        expected = self.expected_rain_rates()
+        stats = user.rainrate_backfill.backfill(self.manager_dict, start_ts=1672646100)
+        self.assertEqual(stats.records, len([ts for ts in expected if ts >= 1672646100]))
+        actual = self.archive_rain_rates()
+        self.assertEqual(actual[1672644600], 9.9)
+        self.assertEqual(actual[1672646100], expected[1672646100])
+        self.assertEqual(actual[1672646400], expected[1672646400])
+
+    def test_first_record_at_midnight(self):
+        with weewx.manager.open_manager(self.manager_dict) as dbm:
+            dbm.addRecord({ 'dateTime': START_TS, 'usUnits': 1, 'interval': 5, 'rain': 0.02, 'rainRate': 9.9 }, log_success=False)
+        stats = user.rainrate_backfill.backfill(self.manager_dict)
+        self.assertEqual(stats.records, 577)
+        rain_entries = user.rainrate.RainEntries()
+        rate = user.rainrate.RainRate.archive_rain_rate(START_TS, 0.02, 300, rain_entries)
+        self.assertGreater(rate, 0.0)
+        self.assertEqual(self.archive_rain_rates()[START_TS], rate)
+
+    def test_metric(self):
+        # The same storm in mm (METRICWX); rain rates are written in mm/hr.
+        self.manager_dict['database_dict']['database_name'] = os.path.join(self.tmpdir, 'metric.sdb')
+        with weewx.manager.open_manager(self.manager_dict, initialize=True) as dbm:
+            for ts in range(START_TS + 300, START_TS + 2 * 86400 + 300, 300):
+                dbm.addRecord({ 'dateTime': ts, 'usUnits': weewx.METRICWX, 'interval': 5,
+                                'rain': RAIN.get(ts, 0.0) * 25.4, 'rainRate': 0.0 }, log_success=False)
+        user.rainrate_backfill.backfill(self.manager_dict)
+        actual = self.archive_rain_rates()
+        for ts, rate in self.expected_rain_rates().items():
+            self.assertAlmostEqual(actual[ts], rate * 25.4, places=4)
+
+    def test_oversized_rain(self):
+        # 10" in a 5m record is more tips than seconds; the tips are spread 1s apart.
+        rows = [(START_TS + 300, 0.01, 5, weewx.US), (START_TS + 600, 10.0, 5, weewx.US), (START_TS + 900, 0.0, 5, weewx.US)]
+        rates = list(user.rainrate_backfill.compute_rain_rates(iter(rows), user.rainrate.RainEntries()))
+        self.assertEqual([ts for ts, _ in rates], [ts for ts, _, _, _ in rows])
+        self.assertGreater(rates[1][1], 0.0)
+
+        with weewx.manager.open_manager(self.manager_dict) as dbm:
+            with weedb.Transaction(dbm.connection) as cursor:
+                cursor.execute('UPDATE archive SET rain = 10.0 WHERE dateTime = ?', (1672644600,))
+        stats = user.rainrate_backfill.backfill(self.manager_dict)
+        self.assertEqual(stats.records, 576)
+        self.assertGreater(self.archive_rain_rates()[1672644600], 0.0)
+
+if __name__ == '__main__':
+    unittest.main()
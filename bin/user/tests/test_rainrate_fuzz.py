@@ -0,0 +1,37 @@
+#    Copyright (c) 2023 John A Kline <john@johnkline.com>
+#
+#    See the file LICENSE.txt for your full rights.
+#
+"""Compare the RainRate engines with the reference implementation on random streams."""
+
+import dataclasses
+import logging
+import unittest
+
+import weeutil.logger
+
+import rainrate_fuzz
+
+log = logging.getLogger(__name__)
+
+# Set up logging using the defaults.
+weeutil.logger.setup('test_config', {})
+
+class RainRateFuzzTests(unittest.TestCase):
+    def test_engines(self):
+        for name, engine in rainrate_fuzz.ENGINES.items():
+            result = rainrate_fuzz.fuzz(engine, 1000, seed=1668104200)
+            self.assertIsNone(result.difference, '%s differs from the reference:\n%s' % (name, result.difference))
+
+    def test_shrink(self):
+        # An engine that merges tips 3s apart is caught, and shrunk to a couple of tips.
+        def wide_merge(stream, params):
+            return rainrate_fuzz.run_per_packet(stream, dataclasses.replace(params, merge_window=3.5))
+        result = rainrate_fuzz.fuzz(wide_merge, 1000, seed=1668104200)
+        self.assertIsNotNone(result.difference)
+        self.assertEqual(result.difference.stream.records, [])
+        self.assertLessEqual(len(result.difference.stream.packets), 3)
+        self.assertEqual(result.difference.index, len(result.difference.stream.packets) - 1)
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,129 @@
+#    Copyright (c) 2023 John A Kline <john@johnkline.com>
+#
+#    See the file LICENSE.txt for your full rights.
+#
+"""Test the multi-station rain rate server."""
+
+import asyncio
+import json
+import logging
+import os
+import shutil
+import tempfile
+import unittest
+
+import weeutil.logger
+
+import user.rainrate
+import user.rainrate_server
+
+log = logging.getLogger(__name__)
+
+# Set up logging using the defaults.
+weeutil.logger.setup('test_config', {})
+
+PACKETS = [(1669914666, 0.0), (1669914668, 0.01), (1669914670, 0.0), (1669914672, 0.02), (1669914674, 0.0),
+           (1669914676, 0.01), (1669914678, 0.01), (1669914680, None), (1669914682, 0.0)]
+
+class RainRateServerTests(unittest.TestCase):
+    def test_server(self):
+        tmpdir = tempfile.mkdtemp()
+        try:
+            path = os.path.join(tmpdir, 'rainrate.sock')
+            server = user.rainrate_server.RainRateServer()
+
+            async def exchange():
+                listener = await asyncio.start_unix_server(server.handle_connection, path=path)
+                async with listener:
+                    reader, writer = await asyncio.open_unix_connection(path)
+                    # Two stations, interleaved; the second sees all but the first tip.
+                    for ts, rain in PACKETS:
+                        writer.write(b'%s\n' % json.dumps({ 'station': 'a', 'dateTime': ts, 'rain': rain }).encode('utf-8'))
+                        writer.write(b'%s\n' % json.dumps({ 'station': 'b', 'dateTime': ts, 'rain': 0.0 if ts == 1669914668 else rain }).encode('utf-8'))
+                    writer.write(b'not json\n{"dateTime": 1669914684}\n')
+                    await writer.drain()
+                    responses = [json.loads(await reader.readline()) for _ in range(2 * len(PACKETS) + 2)]
+                    writer.close()
+                return responses
+            responses = asyncio.run(exchange())
+
+            for station, rains in [('a', [rain for _, rain in PACKETS]),
+                                   ('b', [0.0 if ts == 1669914668 else rain for ts, rain in PACKETS])]:
+                rain_entries = user.rainrate.RainEntries()
+                expected = []
+                for (ts, _), rain in zip(PACKETS, rains):
+                    pkt = { 'dateTime': ts, 'rain': rain }
+                    user.rainrate.RainRate.add_packet(pkt, rain_entries)
+                    user.rainrate.RainRate.compute_rain_rate(pkt, rain_entries)
+                    expected.append({ 'station': station, 'dateTime': ts, 'rainRate': pkt['rainRate'] })
+                self.assertEqual([r for r in responses if r.get('station') == station], expected)
+            self.assertIn('error', responses[-2])
+            self.assertIn('KeyError', responses[-1]['error'])
+            self.assertEqual(server.stats.packets, 2 * len(PACKETS))
+            self.assertEqual(server.stats.errors, 2)
+        finally:
+            shutil.rmtree(tmpdir)
+
+    def test_batch(self):
+        server = user.rainrate_server.RainRateServer()
+        for ts, rain in PACKETS[:3]:
+            server.handle_line(b'%s\n' % json.dumps({ 'station': 'a', 'dateTime': ts, 'rain': rain }).encode('utf-8'))
+        response = json.loads(server.handle_line(b'%s\n' % json.dumps({ 'station': 'a', 'packets': [
+            { 'dateTime': ts, 'rain': rain } for ts, rain in PACKETS[3:] ] }).encode('utf-8')))
+
+        rain_entries = user.rainrate.RainEntries()
+        expected = []
+        for ts, rain in PACKETS:
+            pkt = { 'dateTime': ts, 'rain': rain }
+            user.rainrate.RainRate.add_packet(pkt, rain_entries)
+            user.rainrate.RainRate.compute_rain_rate(pkt, rain_entries)
+            expected.append(pkt['rainRate'])
+        self.assertEqual(response, { 'station': 'a', 'rainRates': expected[3:] })
+        self.assertEqual(server.stats.packets, len(PACKETS))
+        self.assertIn('error', json.loads(server.handle_line(b'{"station": "a", "packets": [{"rain": 0.01}]}')))
+
+    def test_large_batch(self):
+        tmpdir = tempfile.mkdtemp()
+        try:
+            path = os.path.join(tmpdir, 'rainrate.sock')
+            packets = [{ 'dateTime': 1669914666 + 2 * i, 'rain': 0.01 if i % 7 == 0 else 0.0 } for i in range(3000)]
+            batch = json.dumps({ 'station': 'a', 'packets': packets }).encode('utf-8')
+            self.assertGreater(len(batch), 64 * 1024)
+
+            async def exchange(server):
+                serving = asyncio.ensure_future(server.serve(unix_path=path))
+                while not os.path.exists(path):
+                    await asyncio.sleep(0.01)
+                reader, writer = await asyncio.open_unix_connection(path)
+                writer.write(batch + b'\n{"station": "b", "dateTime": 1669914666, "rain": 0.0}\n')
+                await writer.drain()
+                responses = [json.loads(await reader.readline()) for _ in range(2)]
+                writer.close()
+                serving.cancel()
+                return responses
+
+            server = user.rainrate_server.RainRateServer()
+            responses = asyncio.run(exchange(server))
+            self.assertEqual(len(responses[0]['rainRates']), 3000)
+            self.assertEqual(responses[1]['station'], 'b')
+
+            # Too large is answered with an error, and the connection carries on.
+            os.unlink(path)
+            server = user.rainrate_server.RainRateServer(max_request_bytes=64 * 1024)
+            responses = asyncio.run(exchange(server))
+            self.assertEqual(responses[0], { 'error': 'request too large' })
+            self.assertEqual(responses[1]['station'], 'b')
+            self.assertEqual(server.stats.errors, 1)
+        finally:
+            shutil.rmtree(tmpdir)
+
+    def test_evict(self):
+        server = user.rainrate_server.RainRateServer(idle_timeout=1800)
+        server.handle_line(b'{"station": "a", "dateTime": 1669914666, "rain": 0.01}')
+        server.handle_line(b'{"station": "b", "dateTime": 1669914666, "rain": 0.01}')
+        server.stations['a'].last_seen -= 1801
+        self.assertEqual(server.evict(), 1)
+        self.assertEqual(list(server.stations), ['b'])
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,103 @@
+#    Copyright (c) 2023 John A Kline <john@johnkline.com>
+#
+#    See the file LICENSE.txt for your full rights.
+#
+"""Test replaying recordings through the RainRate algorithm."""
+
+import io
+import json
+import logging
+import os
+import shutil
+import sys
+import tempfile
+import time
+import unittest
+
+import weeutil.logger
+
+# The rate_computer tools import each other as siblings.
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.dirname(os.path.abspath(__file__))), 'rate_computer'))
+
+import rate_computer
+
+from rate_computer import RateComputer
+
+log = logging.getLogger(__name__)
+
+# Set up logging using the defaults.
+weeutil.logger.setup('test_config', {})
+
+# Tips 120s, then 60s apart.
+RECORDING = ['1669912378,0.00,0.0', '1669912380,0.01,0.0', '1669912500,0.01,0.3', '1669912560,0.01,0.6', '1669912562,0.00,0.6']
+
+# (timestamp, rain, original rainRate, computed rainRate) of RECORDING.
+ROWS = [(1669912378, 0.0, 0.0, 0.0), (1669912380, 0.01, 0.0, 0.0), (1669912500, 0.01, 0.3, 0.3),
+        (1669912560, 0.01, 0.6, 0.6), (1669912562, 0.0, 0.6, 0.6)]
+
+class RateComputerTests(unittest.TestCase):
+    def setUp(self):
+        self.tmpdir = tempfile.mkdtemp()
+        self.path = os.path.join(self.tmpdir, 'tb3.csv')
+        with open(self.path, 'w') as f:
+            f.write(''.join('%s\n' % line for line in RECORDING))
+
+    def tearDown(self):
+        shutil.rmtree(self.tmpdir)
+
+    def write(self, output_format, rows=None):
+        out = io.BytesIO()
+        if rows is None:
+            rows = RateComputer.compute(RateComputer.read_rain_events(self.path))
+        self.assertEqual(rate_computer.write_rows(rows, out, output_format), len(ROWS))
+        return out.getvalue()
+
+    def test_compute(self):
+        self.assertEqual(list(RateComputer.compute(RateComputer.read_rain_events(self.path))), ROWS)
+
+    def test_select_rows(self):
+        self.assertEqual(list(RateComputer.select_rows(iter(ROWS))), ROWS)
+        self.assertEqual(list(RateComputer.select_rows(iter(ROWS), 2, 3)), ROWS[1:3])
+        self.assertEqual(list(RateComputer.select_rows(iter(ROWS), 5)), ROWS[4:])
+        self.assertEqual(list(RateComputer.select_rows(iter(ROWS), 6)), [])
+        # Rows after last_row are never read.
+        rows = iter(ROWS)
+        self.assertEqual(list(RateComputer.select_rows(rows, 1, 2)), ROWS[:2])
+        self.assertEqual(next(rows), ROWS[3])
+
+    def test_table(self):
+        lines = self.write('table').decode('utf-8').splitlines()
+        self.assertEqual(len(lines), 2 + len(ROWS))
+        self.assertTrue(lines[0].startswith('Time'))
+        for line, row in zip(lines[2:], ROWS):
+            when = time.localtime(row[0])
+            self.assertTrue(line.startswith(time.strftime('%Y-%m-%d %H:%M:%S ', when)), line)
+            self.assertTrue(line.endswith('(%d)  %3.2f  %9.3f  %9.3f' % row), line)
+
+    def test_csv(self):
+        self.assertEqual(self.write('csv').decode('utf-8').splitlines(), [
+            '1669912378,0.000000', '1669912380,0.000000', '1669912500,0.300000', '1669912560,0.600000', '1669912562,0.600000'])
+
+    def test_jsonl(self):
+        records = [json.loads(line) for line in self.write('jsonl').decode('utf-8').splitlines()]
+        self.assertEqual(records, [{ 'dateTime': ts, 'rain': rain, 'rainRate': rate, 'origRainRate': orig_rate }
+                                   for ts, rain, orig_rate, rate in ROWS])
+
+    def test_binary(self):
+        data = self.write('binary')
+        self.assertEqual(len(data), rate_computer.BINARY_ROW.size * len(ROWS))
+        unpacked = list(rate_computer.BINARY_ROW.iter_unpack(data))
+        self.assertEqual([ts for ts, _, _ in unpacked], [row[0] for row in ROWS])
+        for (_, rain, rate), row in zip(unpacked, ROWS):
+            self.assertAlmostEqual(rain, row[1], places=6)
+            self.assertAlmostEqual(rate, row[3], places=6)
+
+    def test_chunks(self):
+        # More rows than are formatted at a time.
+        rows = [(1669912378 + 2 * i, 0.0, 0.0, 0.0) for i in range(rate_computer.CHUNK_ROWS * 2 + 1)]
+        out = io.BytesIO()
+        self.assertEqual(rate_computer.write_rows(iter(rows), out, 'csv'), len(rows))
+        self.assertEqual(len(out.getvalue().splitlines()), len(rows))
+
+if __name__ == '__main__':
+    unittest.main()
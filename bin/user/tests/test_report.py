@@ -0,0 +1,108 @@
+#    Copyright (c) 2023 John A Kline <john@johnkline.com>
+#
+#    See the file LICENSE.txt for your full rights.
+#
+"""Test the per-storm accuracy report."""
+
+import logging
+import os
+import random
+import sys
+import unittest
+
+import weeutil.logger
+
+# The rate_computer tools import each other as siblings.
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.dirname(os.path.abspath(__file__))), 'rate_computer'))
+
+import report
+
+log = logging.getLogger(__name__)
+
+# Set up logging using the defaults.
+weeutil.logger.setup('test_config', {})
+
+START = 1669912378
+THRESHOLDS = [0.5, 1.0]
+
+def grid_rows(values):
+    """Aligned rows, 2s apart, of a list of (recording, reference) values."""
+    return [(START + 2 * i, list(v)) for i, v in enumerate(values)]
+
+def wet_dry(*runs):
+    """(recording, reference) values of runs of (count, rate), both gauges alike."""
+    return [(rate, rate) for count, rate in runs for _ in range(count)]
+
+class ReportTests(unittest.TestCase):
+    def test_dry_gap(self):
+        # Rain for 10 rows, then 29 dry rows (58s), then rain: 60s after the last wet row.
+        rows = grid_rows(wet_dry((10, 0.5), (29, 0.0), (10, 0.5)))
+        self.assertEqual(len(list(report.storms(rows, 2, dry_gap=60))), 1)
+        split = list(report.storms(rows, 2, dry_gap=58))
+        self.assertEqual(len(split), 2)
+        self.assertEqual((split[0].start, split[0].end), (START, START + 18))
+        self.assertEqual((split[1].start, split[1].end), (START + 78, START + 96))
+
+    def test_run_length(self):
+        # Storms accumulated per run equal storms accumulated per row.
+        rng = random.Random(1669912378)
+        values = []
+        for _ in range(20):
+            # A wet spell (with some dry rows), then a dry spell of 60 to 240 seconds.
+            rates = [0.0, 0.0]
+            for _ in range(rng.randrange(100, 400)):
+                for i in range(2):
+                    if rng.random() < 0.05:
+                        rates[i] = rng.choice([0.0, 0.18, 0.5, 1.06, 2.5])
+                values.append(tuple(rates))
+            values += [(0.0, 0.0)] * rng.randrange(30, 120)
+        rows = grid_rows(values)
+        by_run = list(report.storms(rows, 2, dry_gap=120, thresholds=THRESHOLDS))
+        accumulator = report.StormAccumulator(2, 2.0, 120, THRESHOLDS)
+        by_row = []
+        for ts, row_values in rows:
+            storm = accumulator.add_run(ts, row_values, 1)
+            if storm is not None:
+                by_row.append(storm)
+        by_row.append(accumulator.finish())
+        self.assertGreater(len(by_run), 2)
+        self.assertEqual(len(by_run), len(by_row))
+        for run_storm, row_storm in zip(by_run, by_row):
+            self.assertEqual((run_storm.start, run_storm.end), (row_storm.start, row_storm.end))
+            for run_stats, row_stats in zip(run_storm.series, row_storm.series):
+                self.assertAlmostEqual(run_stats.rain, row_stats.rain)
+                self.assertAlmostEqual(run_stats.rmse(), row_stats.rmse())
+                self.assertAlmostEqual(run_stats.bias(), row_stats.bias())
+                self.assertEqual(run_stats.above, row_stats.above)
+                self.assertEqual((run_stats.peak, run_stats.peak_time), (row_stats.peak, row_stats.peak_time))
+
+    def test_report(self):
+        # The recording peaks 2 minutes before the reference, and reads high.
+        values = [(0.5, 0.25)] * 30 + [(2.0, 0.25)] * 30 + [(0.5, 0.25)] * 30 + [(0.5, 1.5)] * 30 + [(0.0, 0.0)] * 900 + [(1.0, 1.0)] * 30
+        storm_list = list(report.storms(grid_rows(values), 2, dry_gap=1800, thresholds=THRESHOLDS))
+        self.assertEqual(len(storm_list), 2)
+        lines = report.markdown_report(storm_list, ['TB3', 'TB7'], 2.0, THRESHOLDS).splitlines()
+        self.assertEqual(lines[0], '|Storm|Series|Rain|Ref. Rain|Peak|Ref. Peak|Lag (min)|RMSE|Bias|>0.5 (min)|Ref. >0.5 (min)|>1 (min)|Ref. >1 (min)|')
+        self.assertEqual(len(lines), 2 + 2 + 1)
+        first = lines[2].split('|')[2:-1]
+        # Rain: (0.5 * 90 + 2.0 * 30) rows * 2s, vs. (0.25 * 90 + 1.5 * 30) rows * 2s.
+        self.assertEqual(first[:5], ['TB3', '%.2f' % (105 * 2 / 3600.0), '%.2f' % (67.5 * 2 / 3600.0), '2.00', '1.50'])
+        self.assertEqual(first[5], '-2.0')
+        self.assertEqual(float(first[7]), round((0.25 * 60 + 1.75 * 30 - 1.0 * 30) / 120, 3))
+        # Minutes above 0.5 and 1.0 (more than, not equal to).
+        self.assertEqual(first[8:], ['1.0', '1.0', '1.0', '1.0'])
+        second = lines[3].split('|')[2:-1]
+        self.assertEqual(second[5:8], ['0.0', '0.000', '0.000'])
+        totals = lines[4].split('|')[1:-1]
+        self.assertEqual(totals[0], 'All 2 storms')
+        self.assertEqual(totals[1:5], ['TB3', '%.2f' % (135 * 2 / 3600.0), '%.2f' % (97.5 * 2 / 3600.0), '2.00'])
+        self.assertEqual(totals[6], 'n/a')
+        self.assertEqual(totals[9:], ['2.0', '2.0', '1.0', '1.0'])
+
+    def test_no_rain(self):
+        storm_list = list(report.storms(grid_rows([(0.0, None)] * 100), 2, thresholds=THRESHOLDS))
+        self.assertEqual(storm_list, [])
+        self.assertEqual(len(report.markdown_report(storm_list, ['TB3', 'TB7'], 2.0, THRESHOLDS).splitlines()), 2)
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,93 @@
+#    Copyright (c) 2023 John A Kline <john@johnkline.com>
+#
+#    See the file LICENSE.txt for your full rights.
+#
+"""Test the storm recording format."""
+
+import io
+import logging
+import os
+import shutil
+import struct
+import sys
+import tempfile
+import unittest
+
+import weeutil.logger
+
+# The rate_computer tools import each other as siblings.
+RATE_COMPUTER_DIR = os.path.join(os.path.dirname(os.path.dirname(os.path.abspath(__file__))), 'rate_computer')
+sys.path.insert(0, RATE_COMPUTER_DIR)
+
+import rate_computer
+import storm
+
+log = logging.getLogger(__name__)
+
+# Set up logging using the defaults.
+weeutil.logger.setup('test_config', {})
+
+DEC01_TB3 = os.path.join(RATE_COMPUTER_DIR, '2022Dec01_PaloAlto_0.68inch_storm_TB3.csv')
+
+class StormTests(unittest.TestCase):
+    def setUp(self):
+        self.tmpdir = tempfile.mkdtemp()
+        self.path = os.path.join(self.tmpdir, 'test.storm')
+
+    def tearDown(self):
+        shutil.rmtree(self.tmpdir)
+
+    def test_round_trip(self):
+        timestamps = [1669912378, 1669912380, 1669912382, 1669912384]
+        rains = [0.0, 0.01, 0.02, 0.009999999999999998]
+        rates = [0.0, 15.16, 0.18, 1.06]
+        storm.write_storm(self.path, timestamps, rains, rates)
+        self.assertTrue(storm.is_storm_file(self.path))
+        self.assertFalse(storm.is_storm_file(DEC01_TB3))
+        self.assertEqual(os.path.getsize(self.path), storm.HEADER.size + 16 * len(timestamps))
+        with storm.StormRecording(self.path) as recording:
+            self.assertEqual(len(recording), 4)
+            self.assertEqual(list(recording.timestamps), timestamps)
+            # float32 can't hold 0.01, rows() rounds it away.
+            self.assertNotEqual(recording.rains[1], 0.01)
+            self.assertEqual(list(recording.rows()), [
+                (1669912378, 0.0, 0.0), (1669912380, 0.01, 15.16), (1669912382, 0.02, 0.18), (1669912384, 0.01, 1.06)])
+        with self.assertRaises(ValueError):
+            storm.write_storm(self.path, timestamps, rains[:3], rates)
+
+    def test_empty(self):
+        with self.assertRaisesRegex(ValueError, 'no rows'):
+            storm.write_storm(self.path, [], [], [])
+        self.assertFalse(os.path.exists(self.path))
+
+    def test_bad_files(self):
+        good = storm.HEADER.pack(storm.MAGIC, storm.VERSION, 0, 1) + struct.pack('<qff', 1669912378, 0.01, 0.0)
+        for data, message in [
+                (b'RRS', 'too short'),
+                (b'XXXX' + good[4:], 'not a storm recording'),
+                (storm.HEADER.pack(storm.MAGIC, storm.VERSION + 1, 0, 1) + good[storm.HEADER.size:], 'unsupported'),
+                (storm.HEADER.pack(storm.MAGIC, storm.VERSION, 0, 0), 'no rows'),
+                (good[:-1], 'expected'),
+                (good + b'\0', 'expected')]:
+            with open(self.path, 'wb') as f:
+                f.write(data)
+            with self.assertRaisesRegex(ValueError, message):
+                storm.StormRecording(self.path)
+        with open(self.path, 'wb') as f:
+            f.write(good)
+        with storm.StormRecording(self.path) as recording:
+            self.assertEqual(list(recording.rows()), [(1669912378, 0.01, 0.0)])
+
+    def test_rate_computer(self):
+        # rate_computer.py computes the same rain rates from a storm recording as from its csv file.
+        self.assertEqual(storm.csv_to_storm(DEC01_TB3, self.path), 9191)
+        outputs = []
+        for rainfile in [DEC01_TB3, self.path]:
+            out = io.BytesIO()
+            rows = rate_computer.RateComputer.compute(rate_computer.RateComputer.read_rain_events(rainfile))
+            self.assertEqual(rate_computer.write_rows(rows, out, 'csv'), 9191)
+            outputs.append(out.getvalue())
+        self.assertEqual(outputs[0], outputs[1])
+
+if __name__ == '__main__':
+    unittest.main()
@@ -31,7 +31,7 @@ def loader():
 class RainRateInstaller(ExtensionInstaller):
     def __init__(self):
         super(RainRateInstaller, self).__init__(
-            version = "0.32",
+            version = "0.33",
             name = 'rainrate',
             description = 'Inserts/updates rainRate observations in loop packets.',
             author = "John A Kline",
@@ -45,5 +45,7 @@ class RainRateInstaller(ExtensionInstaller):
             files = [
                 ('bin/user', [
                     'bin/user/rainrate.py',
+                    'bin/user/rainrate_backfill.py',
+                    'bin/user/rainrate_server.py',
                     ]),
             ])